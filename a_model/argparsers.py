@@ -2,6 +2,7 @@ import argparse
 import datetime
 
 from . import reports
+from .company.sampling import SAMPLINGS
 
 
 # cherry picked from http://stackoverflow.com/a/8527629/564709
@@ -50,6 +51,48 @@ class SyncParser(BaseParser):
             action=DefaultListAction,
             default=DefaultListAction.CHOICES,
         )
+        self.add_argument(
+            '--sessions',
+            metavar='N',
+            type=int,
+            help='the number of browser sessions that download reports',
+            default=2,
+        )
+        self.add_argument(
+            '--max-per-host',
+            metavar='N',
+            type=int,
+            help='the maximum number of sessions that load pages at a time',
+            default=2,
+        )
+        self.add_argument(
+            '--quickbooks-url',
+            metavar='URL',
+            help=(
+                'download reports from URL instead of quickbooks online, for '
+                'example from a local server with canned report pages'
+            ),
+            default=reports.base.QUICKBOOKS_ROOT_URL,
+        )
+        self.add_argument(
+            '--reclose-months',
+            metavar='M',
+            type=int,
+            help=(
+                'only download the last M months of the P&L and balance '
+                'sheet (the months that can still change when the books are '
+                'closed) and merge them into the local cache'
+            ),
+            default=3,
+        )
+        self.add_argument(
+            '--full-refresh',
+            action='store_true',
+            help=(
+                'download the full history of every report and sync every '
+                'report with gdrive, even if it has not changed'
+            ),
+        )
 
 
 class SimulationNamespace(argparse.Namespace):
@@ -60,10 +103,28 @@ class SimulationNamespace(argparse.Namespace):
             'verbose': self.verbose,
             'ontime_payment': self.ontime_payment,
             'ontime_completion': self.ontime_completion,
+            'seed': self.seed,
+            'workers': self.workers,
+            'tolerance': self.tolerance,
+            'bonus_pool_tolerance': self.bonus_pool_tolerance,
+            'max_seconds': self.max_seconds,
+            'revenue_kernel': self.revenue_kernel,
+            'sampling': self.sampling,
         }
 
 
+class SweepNamespace(SimulationNamespace):
+    def parameter_grid(self):
+        grid = {}
+        for parameter in SweepParser.PARAMETERS:
+            values = getattr(self, parameter)
+            if values:
+                grid[parameter] = values
+        return grid
+
+
 class SimulationParser(BaseParser):
+    namespace_class = SimulationNamespace
 
     def __init__(self, *args, **kwargs):
         super(SimulationParser, self).__init__(*args, **kwargs)
@@ -79,7 +140,10 @@ class SimulationParser(BaseParser):
             '--n-universes',
             metavar='U',
             type=int,
-            help='the number of universes to simulate',
+            help=(
+                'the number of universes to simulate (the maximum number when '
+                'using --tolerance, --bonus-pool-tolerance or --max-seconds)'
+            ),
             default=1000,
         )
         self.add_argument(
@@ -97,6 +161,68 @@ class SimulationParser(BaseParser):
             action="store_true",
             help='equivalent to --ontime-payment --ontime-completion',
         )
+        self.add_argument(
+            '--revenue-kernel',
+            choices=('invoices', 'buckets'),
+            help=(
+                'draw payment delays for every invoice or for buckets of '
+                'invoices that are due in the same month with the same '
+                'balance (faster with many invoices)'
+            ),
+            default='invoices',
+        )
+        self.add_argument(
+            '--sampling',
+            choices=SAMPLINGS,
+            help=(
+                'draw the random numbers for universes independently '
+                '(pseudo), in mirror image pairs (antithetic) or from a '
+                'scrambled Sobol sequence (sobol) for more accurate results '
+                'with fewer universes'
+            ),
+            default='pseudo',
+        )
+        self.add_argument(
+            '--seed',
+            metavar='S',
+            type=int,
+            help=(
+                'seed the random numbers to make simulations reproducible. '
+                'seeded simulations are saved and reused by later scripts '
+                'with the same inputs'
+            ),
+        )
+        self.add_argument(
+            '--workers',
+            metavar='N',
+            type=int,
+            help='the number of processes to simulate universes in parallel',
+            default=1,
+        )
+        self.add_argument(
+            '--tolerance',
+            metavar='P',
+            type=float,
+            help=(
+                'simulate universes until the 95%% confidence interval of '
+                'every outcome probability is within +/- P'
+            ),
+        )
+        self.add_argument(
+            '--bonus-pool-tolerance',
+            metavar='DOLLARS',
+            type=float,
+            help=(
+                'simulate universes until the 95%% confidence interval of the '
+                'bonus pool percentiles is within +/- DOLLARS'
+            ),
+        )
+        self.add_argument(
+            '--max-seconds',
+            metavar='T',
+            type=float,
+            help='stop simulating universes after T seconds',
+        )
         self.add_argument(
             '-v', '--verbose',
             action="store_true",
@@ -105,7 +231,7 @@ class SimulationParser(BaseParser):
 
     def parse_args(self):
         namespace = super(SimulationParser, self).parse_args(
-            namespace=SimulationNamespace()
+            namespace=self.namespace_class()
         )
         if namespace.ontime:
             namespace.ontime_completion = namespace.ontime
@@ -113,6 +239,85 @@ class SimulationParser(BaseParser):
         return namespace
 
 
+class CashInBankParser(SimulationParser):
+
+    def __init__(self, *args, **kwargs):
+        super(CashInBankParser, self).__init__(*args, **kwargs)
+        self.add_argument(
+            '--tilt',
+            metavar='T',
+            type=float,
+            help=(
+                'also estimate the outcome probabilities at the end of the '
+                'year with confidence intervals by importance sampling '
+                'universes that are tilted T standard deviations toward bad '
+                'months (useful for rare outcomes, try 1 or 2)'
+            ),
+        )
+        self.add_argument(
+            '--streaming',
+            action="store_true",
+            help=(
+                'summarize universes as they are simulated instead of keeping '
+                'them all in memory (plots percentiles instead of universes)'
+            ),
+        )
+
+
+class SweepParser(SimulationParser):
+    namespace_class = SweepNamespace
+
+    # the config.ini parameters that can be swept
+    PARAMETERS = (
+        'before_tax_annual_salary',
+        'n_months_before_tax_bonus',
+        'n_months_buffer',
+        'fraction_profit_for_dividends',
+        'tax_rate',
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(SweepParser, self).__init__(*args, **kwargs)
+        for parameter in self.PARAMETERS:
+            self.add_argument(
+                '--' + parameter.replace('_', '-'),
+                metavar='X',
+                type=float,
+                nargs='+',
+                help='values of %s to evaluate' % parameter,
+            )
+        self.add_argument(
+            '--month',
+            metavar='M',
+            type=int,
+            help='the month to evaluate outcomes in (default to last month)',
+        )
+        self.add_argument(
+            '-o', '--output-csv',
+            default='parameter_sweep.csv',
+            help='the output spreadsheet with one row per grid point',
+        )
+
+
+class SamplingDiagnosticParser(SimulationParser):
+
+    def __init__(self, *args, **kwargs):
+        super(SamplingDiagnosticParser, self).__init__(*args, **kwargs)
+        self.add_argument(
+            '--n-replications',
+            metavar='R',
+            type=int,
+            help='the number of times to simulate with each sampling strategy',
+            default=10,
+        )
+        self.add_argument(
+            '--month',
+            metavar='M',
+            type=int,
+            help='the month to evaluate outcomes in (default to last month)',
+        )
+
+
 class HiringParser(SimulationParser):
 
     def __init__(self, *args, **kwargs):
@@ -1,10 +1,15 @@
 import os
 import ConfigParser
 import datetime
+import contextlib
 
+import numpy
+
+from .. import decorators
 from .. import reports
 from .. import utils
 from ..person import Person
+from .headcount import HeadcountTimeline
 
 
 class BaseCompany(object):
@@ -18,6 +23,8 @@ class BaseCompany(object):
         config_filename = os.path.join(utils.DROPBOX_ROOT, 'config.ini')
         self.config = ConfigParser.ConfigParser()
         self.config.read(config_filename)
+        self._parameter_overrides = {}
+        self._parameters_version = 0
 
         # make sure the data_root exists
         if not os.path.exists(utils.DATA_ROOT):
@@ -36,6 +43,8 @@ class BaseCompany(object):
 
         # iterate over the config to instantiate each person
         self.people = []
+        self._headcount = None
+        self._people_version = 0
         if add_people:
             for person in self.roster.iter_people():
                 self.add_person(person)
@@ -45,8 +54,39 @@ class BaseCompany(object):
 
     def __getattr__(self, name):
         """This just accesses the value from the config.ini directly"""
+        # special methods (like the ones pickle looks for) are never
+        # parameters in the config.ini
+        if name.startswith('__'):
+            raise AttributeError(name)
+        overrides = self.__dict__.get('_parameter_overrides', {})
+        if name in overrides:
+            return overrides[name]
         return self.config.getfloat('parameters', name)
 
+    @contextlib.contextmanager
+    def override_parameters(self, **parameters):
+        """temporarily replace the values of `parameters` from the config.ini,
+        for example to evaluate a different salary or cash buffer
+        """
+        for name in parameters:
+            if not self.config.has_option('parameters', name):
+                raise ValueError('%s is not a config.ini parameter' % name)
+        previous_overrides = self._parameter_overrides
+        self._parameter_overrides = dict(previous_overrides)
+        self._parameter_overrides.update(
+            (name, float(value)) for name, value in parameters.iteritems()
+        )
+        self._invalidate_parameters()
+        try:
+            yield
+        finally:
+            self._parameter_overrides = previous_overrides
+            self._invalidate_parameters()
+
+    def _invalidate_parameters(self):
+        self._parameters_version += 1
+        self.__dict__.pop('_annual_cash_goals', None)
+
     #                                                             MANAGE PEOPLE
     def add_person(self, person_or_name, *args, **kwargs):
         if isinstance(person_or_name, Person):
@@ -55,31 +95,85 @@ class BaseCompany(object):
         else:
             person = Person(self, person_or_name, *args, **kwargs)
         self.people.append(person)
+        self._invalidate_people()
         return person
 
+    def _invalidate_people(self):
+        self._headcount = None
+        self._people_version += 1
+        self.__dict__.pop('_annual_cash_goals', None)
+
+    @contextlib.contextmanager
+    def additional_people(self, people):
+        """temporarily add `people` (or names of people) to the company, for
+        example to evaluate a hiring scenario
+        """
+        n_people = len(self.people)
+        for person in people:
+            self.add_person(person)
+        try:
+            yield
+        finally:
+            del self.people[n_people:]
+            self._invalidate_people()
+
+    @property
+    def headcount(self):
+        """`HeadcountTimeline` with everyone at Datascope from the beginning of
+        our financial reports until a few years from now. It is rebuilt
+        whenever people are added.
+        """
+        if self._headcount is None:
+            self._headcount = HeadcountTimeline(
+                self.people,
+                self.profit_loss.start_date,
+                datetime.date(self.today.year + 3, 12, 31),
+            )
+        return self._headcount
+
+    def _iter_indexed_people(self, matrix, date):
+        for i in self.headcount.iter_indices(matrix, date):
+            yield self.people[i]
+
     def iter_people(self, date=None):
         """iterate over all active people at Datascope on `date`."""
-        for person in self.people:
-            if date is None or person.is_active(date):
-                yield person
+        if date is not None and self.headcount.get_column(date) is not None:
+            return self._iter_indexed_people(self.headcount.active, date)
+        return (
+            person for person in self.people
+            if date is None or person.is_active(date)
+        )
 
     def iter_people_and_partners(self, date=None):
         """iterate over all active people and partners at Datascope on `date`.
         """
-        for person in self.iter_people():
-            if date is None or person.is_active_or_partner(date):
-                yield person
+        if date is not None and self.headcount.get_column(date) is not None:
+            return self._iter_indexed_people(
+                self.headcount.active_or_partner, date,
+            )
+        return (
+            person for person in self.iter_people()
+            if date is None or person.is_active_or_partner(date)
+        )
 
     def iter_partners(self, date):
-        for person in self.iter_people():
-            if person.is_partner(date):
-                yield person
+        if self.headcount.get_column(date) is not None:
+            return self._iter_indexed_people(self.headcount.partner, date)
+        return (
+            person for person in self.iter_people()
+            if person.is_partner(date)
+        )
 
     def iter_401k_eligible(self, date):
-        for person in self.iter_people(date):
-            dt = date - person.start_date
-            if float(dt.days) / 30 > 6 and person.fraction_time == 1:
-                yield person
+        if self.headcount.get_column(date) is not None:
+            return self._iter_indexed_people(
+                self.headcount.eligible_401k, date,
+            )
+        return (
+            person for person in self.iter_people(date)
+            if float((date - person.start_date).days) / 30 > 6 and
+            person.fraction_time == 1
+        )
 
     def _person_counter(self, iterator):
         count = 0.0
@@ -87,19 +181,42 @@ class BaseCompany(object):
             count += person.fraction_time
         return count
 
+    def _indexed_person_counter(self, counts, date, iterator):
+        column = self.headcount.get_column(date)
+        if column is None:
+            return self._person_counter(iterator(date))
+        return float(counts[column])
+
     def n_people(self, date):
         """number of people that are active datascopers"""
-        return self._person_counter(self.iter_people(date))
+        return self._indexed_person_counter(
+            self.headcount.n_people, date, self.iter_people,
+        )
+
+    def n_people_array(self, dates):
+        """number of people that are active datascopers on each of `dates`"""
+        columns = self.headcount.get_columns(dates)
+        if columns is None:
+            return numpy.array([self.n_people(date) for date in dates])
+        return self.headcount.n_people[columns]
 
     def n_people_and_partners(self, date):
         """number of people or partners at Datacope"""
-        return self._person_counter(self.iter_people_and_partners(date))
+        return self._indexed_person_counter(
+            self.headcount.n_people_and_partners, date,
+            self.iter_people_and_partners,
+        )
 
     def n_partners(self, date):
-        return self._person_counter(self.iter_partners(date))
+        return self._indexed_person_counter(
+            self.headcount.n_partners, date, self.iter_partners,
+        )
 
     def n_people_401k_eligible(self, date):
-        return self._person_counter(self.iter_401k_eligible(date))
+        return self._indexed_person_counter(
+            self.headcount.n_people_401k_eligible, date,
+            self.iter_401k_eligible,
+        )
 
     #                                                                  BENEFITS
     def get_401k_contribution(self, date):
@@ -108,11 +225,26 @@ class BaseCompany(object):
         return self.n_people_401k_eligible(date) * self.retirement_contribution
 
     #                                                          BASIC FINANCIALS
+    def get_derived_version(self):
+        """version of the data that the historical cost metrics and the
+        simulation context are derived from (see `decorators.derived`)
+        """
+        return (
+            self.profit_loss.get_derived_version(),
+            self.balance_sheet.get_derived_version(),
+            self.unpaid_invoices.get_derived_version(),
+            self.invoice_projections.get_derived_version(),
+            self._people_version,
+            self._parameters_version,
+        )
+
+    @decorators.derived
     def average_historical_costs(self):
         """Estimate rough monthly costs for Datascope"""
         _, costs = zip(*self.profit_loss.get_historical_costs())
         return sum(costs) / len(costs)
 
+    @decorators.derived
     def get_historical_per_person_costs(self):
         """Get the historical per-person costs after removing things like fixed
         costs (see `ProfitLoss.get_historical_fixed_costs` for details) and
@@ -123,22 +255,27 @@ class BaseCompany(object):
         """
 
         # calculate the variable cost
-        historical_costs = self.profit_loss.get_historical_costs()
-        dates, costs = zip(*historical_costs)
-        fixed_costs = self.profit_loss.get_historical_fixed_costs()
-        _, fixed_costs = zip(*fixed_costs)
-        retirement_costs = self.profit_loss.get_historical_retirement_costs()
-        _, retirement_costs = zip(*retirement_costs)
-        iterator = zip(dates, costs, fixed_costs, retirement_costs)
-        variable_costs = []
-        for date, cost, fixed_cost, retirement_cost in iterator:
-            # TODO: this should also omit bonuses and old-style tax payments as
-            # those are accounted for elsewhere
-            variable_costs.append((date, cost - fixed_cost - retirement_cost))
-        historical_per_person_costs = []
-        for date, variable_cost in variable_costs:
-            per_person_cost = variable_cost / self.n_people(date)
-            historical_per_person_costs.append(per_person_cost)
+        profit_loss = self.profit_loss
+        dates, costs = profit_loss.get_historical_costs_series()
+        _, fixed_costs = profit_loss.get_historical_series(
+            profit_loss.OTHER_FIXED_COST_ROWS + profit_loss.OFFICE_COST_ROWS,
+        )
+        _, retirement_costs = profit_loss.get_historical_series(
+            ('401(k) Profit Sharing Contribution',),
+        )
+        # TODO: this should also omit bonuses and old-style tax payments as
+        # those are accounted for elsewhere
+        variable_costs = costs - fixed_costs - retirement_costs
+
+        # dividing by a headcount of zero would silently feed inf or nan into
+        # every cash buffer and goal
+        n_people = self.n_people_array(dates)
+        if not n_people.all():
+            date = dates[numpy.flatnonzero(n_people == 0)[0]]
+            raise ZeroDivisionError(
+                'nobody worked at Datascope in %s' % date.strftime('%b %Y')
+            )
+        historical_per_person_costs = (variable_costs / n_people).tolist()
 
         return historical_per_person_costs
 
@@ -161,6 +298,11 @@ class BaseCompany(object):
         cost = self.average_historical_costs()
         return (revenue - cost) / revenue
 
+    @decorators.derived
+    def get_average_per_person_cost(self):
+        per_person_costs = self.get_historical_per_person_costs()
+        return sum(per_person_costs) / len(per_person_costs)
+
     def get_cash_buffer(self, date=None):
         """get the cash buffer. without a specific `date` to calculate the
         number of people, just assume the overall average historical cost
@@ -170,12 +312,20 @@ class BaseCompany(object):
         else:
             n_people = self.n_people(date)
             fixed_cost = self.profit_loss.get_average_fixed_cost()
-            per_person_costs = \
-                self.get_historical_per_person_costs()
-            per_person_cost = sum(per_person_costs) / len(per_person_costs)
+            per_person_cost = self.get_average_per_person_cost()
             cost = fixed_cost + n_people * per_person_cost
         return self.n_months_buffer * cost
 
+    def get_cash_buffers(self, dates):
+        """get the cash buffer on each of `dates` at once. this is the same as
+        `get_cash_buffer` for each date, but looks up the headcount and the
+        historical costs only once
+        """
+        fixed_cost = self.profit_loss.get_average_fixed_cost()
+        per_person_cost = self.get_average_per_person_cost()
+        n_people = self.n_people_array(dates)
+        return self.n_months_buffer * (fixed_cost + n_people * per_person_cost)
+
     def average_tax_rate(self, date):
         """calculate the mean tax rate across all active datascopers"""
         tax_rate = 0.0
@@ -0,0 +1,450 @@
+import collections
+
+import numpy
+
+
+def get_monthly_cash(dates, revenues, costs, cash, ytd_revenue, ytd_cost,
+                     ytd_tax_draws, tax_rate, fraction_profit_for_dividends,
+                     cash_buffers):
+    """Run the books for many universes at once. `revenues` and `costs` have
+    shape (n_universes, n_months) and `dates` and `cash_buffers` have the date
+    and the cash buffer (which is only needed in December) for each month. This
+    returns the monthly cash with shape (n_universes, n_months), the bonus pool
+    (or None if there is no December) and a dictionary of quarterly tax draws
+    keyed by month, both with one entry per universe.
+    """
+    revenues = numpy.asarray(revenues, dtype=float)
+    costs = numpy.array(costs, dtype=float)
+    assert revenues.shape == costs.shape
+    n_universes, n_months = revenues.shape
+    cash = numpy.full(n_universes, cash, dtype=float)
+    ytd_revenue = numpy.full(n_universes, ytd_revenue, dtype=float)
+    ytd_cost = numpy.full(n_universes, ytd_cost, dtype=float)
+    ytd_tax_draws = numpy.full(n_universes, ytd_tax_draws, dtype=float)
+    tax_months = set([1, 4, 6, 9])
+    quarterly_taxes = dict((month, None) for month in tax_months)
+    monthly_cash = numpy.zeros((n_universes, n_months))
+    bonus_pool = None
+    for month, date in enumerate(dates):
+
+        # quarterly tax draws only decrease the cash in the bank; they do not
+        # count as a cost for datascope. the tax draw in january is for Q4 of
+        # the previous year so we reset the ytd_* values below. we pay taxes
+        # on our ytd profit but without also paying duplicate taxes on the
+        # previous quarters
+        if date.month in tax_months:
+            ytd_profit = numpy.maximum(0.0, ytd_revenue - ytd_cost)
+            quarterly_tax = tax_rate * ytd_profit - ytd_tax_draws
+            quarterly_tax = numpy.maximum(0.0, quarterly_tax)
+            quarterly_taxes[date.month] = quarterly_tax
+            cash -= quarterly_tax
+            ytd_tax_draws += quarterly_tax
+
+        # pay bonuses at the end of December. can instead count this in
+        # January if it looks like Datascope's profits will grow in the next
+        # year, but this gives us the flexibility to pay bonuses early if
+        # appropriate. bonus calculation has to happen here to have access to
+        # the net cash in the bank at the end of the month. bonus counts as an
+        # expense and reduces our tax burden. taxes have already been paid on
+        # dividends and are just drawn from the bank.
+        if date.month == 12:
+            # TODO: this currently calculates things in a very conservative
+            # way by calculating taxes BEFORE calculating the bonus. half of
+            # the bonus_pool counts as a cost for the business, which would
+            # reduce our Q4 tax burden if we actually pay bonuses in december.
+            #
+            # TODO: have command line option to do bonuses after the new year
+            _ytd_revenue = ytd_revenue + revenues[:, month]
+            _ytd_cost = ytd_cost + costs[:, month]
+            _ytd_profit = numpy.maximum(0.0, _ytd_revenue - _ytd_cost)
+            q4_tax = tax_rate * _ytd_profit - ytd_tax_draws
+            q4_tax = numpy.maximum(0.0, q4_tax)
+            eom_cash = cash + revenues[:, month] - costs[:, month] - q4_tax
+            bonus_pool = numpy.maximum(0.0, eom_cash - cash_buffers[month])
+            f = fraction_profit_for_dividends
+            costs[:, month] += (1.0 - f) * bonus_pool
+            cash -= f * bonus_pool
+
+        # pay all normal expenses and add revenues for the month
+        cash -= costs[:, month]
+        cash += revenues[:, month]
+        ytd_cost += costs[:, month]
+        ytd_revenue += revenues[:, month]
+
+        # reset the ytd calculations as necessary to make the tax calculations
+        # correct
+        if date.month == 12:
+            ytd_revenue = numpy.zeros(n_universes)
+            ytd_cost = numpy.zeros(n_universes)
+            ytd_tax_draws = numpy.zeros(n_universes)
+
+        # record and return the cash in the bank at the end of the month
+        monthly_cash[:, month] = cash
+
+    return monthly_cash, bonus_pool, quarterly_taxes
+
+
+def tilt_probabilities(probabilities, values, tilts):
+    """Exponentially tilt the `probabilities` of `values` by each of `tilts`,
+    so that value v is drawn with a probability proportional to p(v) *
+    exp(tilt * v). This returns an array with the tilted probabilities for
+    every tilt in each row and is used for importance sampling (see
+    `SimulationContext.simulate_weighted_monthly_cash`).
+    """
+    log_tilted = numpy.log(probabilities) + \
+        numpy.outer(tilts, numpy.asarray(values, dtype=float))
+    tilted = numpy.exp(log_tilted - log_tilted.max(axis=1)[:, numpy.newaxis])
+    return tilted / tilted.sum(axis=1)[:, numpy.newaxis]
+
+
+def draw_tilted(random_state, n_universes, probabilities, tilted,
+                log_weights):
+    """Draw an index into each row of the `tilted` probabilities (see
+    `tilt_probabilities`) for `n_universes` universes by inversion and add the
+    log likelihood ratios of the draws under the untilted `probabilities` to
+    `log_weights`. This returns an array with shape (n_universes, number of
+    rows).
+    """
+    n_draws = len(tilted)
+    u = random_state.random_sample((n_universes, n_draws))
+    thresholds = numpy.cumsum(tilted, axis=1)[:, :-1]
+    draws = (u[:, :, numpy.newaxis] >= thresholds).sum(axis=2)
+    log_ratios = numpy.log(probabilities) - numpy.log(tilted)
+    log_weights += log_ratios[numpy.arange(n_draws), draws].sum(axis=1)
+    return draws
+
+
+def bucket_invoices(invoice_months, invoice_balances, n_unpaid):
+    """Aggregate invoices that are expected in the same month, have the same
+    delay distribution (the first `n_unpaid` invoices only have payment delays
+    and the rest also have completion delays) and have the same balance. The
+    delays of the invoices in a bucket are then interchangeable. This returns
+    the month, balance, number of invoices and whether the invoices are
+    projected for each bucket.
+    """
+    invoice_months = numpy.asarray(invoice_months, dtype=int)
+    invoice_balances = numpy.asarray(invoice_balances, dtype=float)
+    projected = numpy.arange(len(invoice_months)) >= n_unpaid
+    order = numpy.lexsort((invoice_balances, projected, invoice_months))
+    months = invoice_months[order]
+    balances = invoice_balances[order]
+    projected = projected[order]
+    is_first = numpy.ones(len(order), dtype=bool)
+    is_first[1:] = (months[1:] != months[:-1]) | \
+        (projected[1:] != projected[:-1]) | (balances[1:] != balances[:-1])
+    first = numpy.flatnonzero(is_first)
+    counts = numpy.diff(numpy.append(first, len(order)))
+    return months[first], balances[first], counts, projected[first]
+
+
+_SimulationContext = collections.namedtuple('SimulationContext', [
+    'start_date',
+    'dates',
+    'ledger_dates',
+    'n_people',
+    'consistent_costs',
+    'fixed_cost',
+    'per_person_costs',
+    'invoice_months',
+    'invoice_balances',
+    'n_unpaid',
+    'bucket_months',
+    'bucket_balances',
+    'bucket_counts',
+    'bucket_projected',
+    'cash',
+    'ytd_revenue',
+    'ytd_cost',
+    'ytd_tax_draws',
+    'tax_rate',
+    'fraction_profit_for_dividends',
+    'cash_buffers',
+])
+
+
+class SimulationContext(_SimulationContext):
+    """Everything that is needed to simulate the finances of a company for the
+    next `n_months`, compiled once by
+    `ForecastCompanyMixin.compile_simulation_context`:
+
+    * `dates` are the future months and `ledger_dates` are the dates that the
+      books are run on (see `get_monthly_cash`)
+    * `n_people` and `consistent_costs` are the headcount and big, consistently
+      timed expenses (401(k) contributions) in each month
+    * `fixed_cost` and `per_person_costs` are the costs that are resampled.
+      the per-person costs are sorted so that they can be resampled by
+      inversion (see `sampling`)
+    * `invoice_months` and `invoice_balances` are the months in which each
+      invoice is expected to be paid without any noise. the first `n_unpaid`
+      invoices are unpaid invoices, the rest are projected invoices
+    * `bucket_*` are the invoices aggregated by `bucket_invoices`
+    * `cash`, `ytd_*`, `tax_rate`, `fraction_profit_for_dividends` and
+      `cash_buffers` are the starting point and parameters for the books
+
+    A context is immutable (all arrays are read-only), so it can be shared by
+    every universe and shipped to worker processes once. The `random_state`
+    of the simulation methods is either a `numpy.random.RandomState` or a
+    sampler with the same `randint`, `random_sample` and `multinomial`
+    methods (see `sampling.get_sampler`).
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        for value in args + tuple(kwargs.values()):
+            if isinstance(value, numpy.ndarray):
+                value.flags.writeable = False
+        return super(SimulationContext, cls).__new__(cls, *args, **kwargs)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def n_months(self):
+        return len(self.dates)
+
+    def simulate_delays(self, random_state, shape, ontime, tilts=None,
+                        log_weights=None):
+        """Simulate the number of months of delay for a batch of invoices. This
+        mirrors the `ontime_*_noise` functions in
+        `ForecastCompanyMixin.simulate_revenues`. With `tilts` for every
+        invoice, the delays are drawn from the tilted distributions (see
+        `tilt_probabilities`) and their log likelihood ratios are added to
+        `log_weights`.
+        """
+        if ontime:
+            return numpy.zeros(shape, dtype=int)
+        if tilts is None:
+            return random_state.randint(0, 3, size=shape)
+        probabilities = self.get_delay_probabilities(ontime)
+        tilted = tilt_probabilities(
+            probabilities, numpy.arange(len(probabilities)), tilts,
+        )
+        return draw_tilted(
+            random_state, shape[0], probabilities, tilted, log_weights,
+        )
+
+    def simulate_revenues(self, random_state, n_universes, tilt=None,
+                          log_weights=None, **kwargs):
+        """Simulate revenues for `n_universes` universes at once. This has the
+        same noise model as `ForecastCompanyMixin.simulate_revenues` but
+        returns an array with shape (n_universes, n_months). The
+        `revenue_kernel` keyword argument is either 'invoices' to draw the
+        delay of every invoice (the default) or 'buckets' to draw the delays
+        for buckets of invoices (see `simulate_bucketed_revenues`). A positive
+        `tilt` (per dollar, see `get_tilt_scale`) draws longer delays for
+        larger invoices and adds the log likelihood ratios of the draws to
+        `log_weights` (see `simulate_delays`).
+        """
+        revenue_kernel = kwargs.get('revenue_kernel', 'invoices')
+        if revenue_kernel == 'buckets':
+            return self.simulate_bucketed_revenues(
+                random_state, n_universes, tilt=tilt,
+                log_weights=log_weights, **kwargs
+            )
+        elif revenue_kernel != 'invoices':
+            raise ValueError(
+                'revenue_kernel must be either "invoices" or "buckets"'
+            )
+        ontime_payment = kwargs.get('ontime_payment', False)
+        ontime_completion = kwargs.get('ontime_completion', False)
+
+        # add payment noise to everything and completion noise to the
+        # projected invoices
+        n_invoices = len(self.invoice_months)
+        shape = (n_universes, n_invoices)
+        tilts = None
+        if tilt is not None:
+            tilts = tilt * self.get_tilted_balances()
+        month = self.invoice_months + self.simulate_delays(
+            random_state, shape, ontime_payment, tilts, log_weights,
+        )
+        month[:, self.n_unpaid:] += self.simulate_delays(
+            random_state, (n_universes, n_invoices - self.n_unpaid),
+            ontime_completion,
+            None if tilts is None else tilts[self.n_unpaid:], log_weights,
+        )
+
+        # sum all of the balances that hit in the simulation time window for
+        # each universe in one shot
+        n_months = self.n_months
+        universe = numpy.arange(n_universes)[:, numpy.newaxis]
+        in_window = month < n_months
+        index = (universe * n_months + month)[in_window]
+        weights = numpy.broadcast_to(self.invoice_balances, shape)[in_window]
+        revenues = numpy.bincount(
+            index, weights=weights, minlength=n_universes * n_months,
+        )
+        return revenues.reshape(n_universes, n_months)
+
+    def get_delay_probabilities(self, ontime):
+        """probability of a delay of 0, 1 or 2 months (see `simulate_delays`)
+        """
+        if ontime:
+            return numpy.ones(1)
+        return numpy.ones(3) / 3.0
+
+    def simulate_bucketed_revenues(self, random_state, n_universes,
+                                   tilt=None, log_weights=None, **kwargs):
+        """Simulate revenues like `simulate_revenues`, but draw the delays for
+        each bucket of invoices (see `bucket_invoices`) instead of for each
+        invoice, so the time scales with the number of distinct months and
+        balances instead of the number of invoices.
+
+        The invoices in a bucket have the same balance and delay distribution,
+        so the number of them that are delayed by each number of months is a
+        multinomial draw. This is exactly the same distribution as independent
+        delays for every invoice. Projected invoices have the sum of a
+        completion and a payment delay, so their delay probabilities are the
+        convolution of the two. A `tilt` tilts the delay probabilities of
+        every invoice in a bucket like `simulate_revenues`.
+        """
+        payment = self.get_delay_probabilities(
+            kwargs.get('ontime_payment', False),
+        )
+        completion = self.get_delay_probabilities(
+            kwargs.get('ontime_completion', False),
+        )
+        projected_delays = numpy.convolve(completion, payment)
+
+        n_months = self.n_months
+        revenues = numpy.zeros((n_universes, n_months))
+        buckets = zip(
+            self.bucket_months, self.bucket_balances, self.bucket_counts,
+            self.bucket_projected,
+        )
+        for month, balance, n, projected in buckets:
+            if not balance or not 0 <= month < n_months:
+                continue
+            delays = projected_delays if projected else payment
+            if tilt is not None:
+                tilted = tilt_probabilities(
+                    delays, numpy.arange(len(delays)), [tilt * balance],
+                )[0]
+                counts = random_state.multinomial(n, tilted, size=n_universes)
+                log_weights += numpy.dot(counts, numpy.log(delays / tilted))
+            else:
+                counts = random_state.multinomial(
+                    n, delays, size=n_universes,
+                )
+            window = min(len(delays), n_months - month)
+            revenues[:, month:month+window] += counts[:, :window] * balance
+        return revenues
+
+    def simulate_per_person_cost_samples(self, random_state, n_universes,
+                                         tilt=None, log_weights=None):
+        """Resample the per-person costs independently for every universe and
+        month. A positive `tilt` (per dollar, see `get_tilt_scale`) resamples
+        higher costs more often in months with more people and adds the log
+        likelihood ratios of the samples to `log_weights`.
+        """
+        n_costs = len(self.per_person_costs)
+        if tilt is None:
+            return self.per_person_costs[random_state.randint(
+                0, n_costs, size=(n_universes, self.n_months),
+            )]
+        probabilities = numpy.ones(n_costs) / n_costs
+        tilted = tilt_probabilities(
+            probabilities, self.per_person_costs, tilt * self.n_people,
+        )
+        return self.per_person_costs[draw_tilted(
+            random_state, n_universes, probabilities, tilted, log_weights,
+        )]
+
+    def get_costs(self, per_person_cost_samples):
+        """Calculate the costs for each universe and month from the resampled
+        per-person costs. This is the only part of the cost simulation that
+        depends on who is at Datascope.
+        """
+        return self.fixed_cost + self.n_people * per_person_cost_samples + \
+            self.consistent_costs
+
+    def simulate_costs(self, random_state, n_universes, **kwargs):
+        """Simulate costs for `n_universes` universes at once. This has the
+        same cost model as `ForecastCompanyMixin.simulate_costs` but returns
+        an array with shape (n_universes, n_months).
+        """
+        return self.get_costs(self.simulate_per_person_cost_samples(
+            random_state, n_universes,
+        ))
+
+    def get_monthly_cash(self, revenues, costs):
+        """Run the books (see `get_monthly_cash`) from the current cash in the
+        bank
+        """
+        return get_monthly_cash(
+            self.ledger_dates, revenues, costs, self.cash, self.ytd_revenue,
+            self.ytd_cost, self.ytd_tax_draws, self.tax_rate,
+            self.fraction_profit_for_dividends, self.cash_buffers,
+        )
+
+    def simulate_monthly_cash(self, random_state, n_universes, **kwargs):
+        """Simulate the monthly cash, bonus pool and quarterly taxes for
+        `n_universes` universes at once
+        """
+        return self.get_monthly_cash(
+            self.simulate_revenues(random_state, n_universes, **kwargs),
+            self.simulate_costs(random_state, n_universes, **kwargs),
+        )
+
+    def get_tilted_balances(self):
+        """the balance of every invoice that can be paid within the simulation
+        time window and zero for the others, which can not affect the cash in
+        the bank no matter how long they are delayed
+        """
+        return numpy.where(
+            self.invoice_months < self.n_months, self.invoice_balances, 0.0,
+        )
+
+    def get_tilt_scale(self, tilt, **kwargs):
+        """Convert a `tilt` in standard deviations to a tilt per dollar. The
+        draws are tilted in proportion to how many dollars they take out of
+        the bank: a month of delay for an invoice delays its balance and a
+        dollar of per-person cost costs a dollar for every person. Tilting
+        the total of those dollars by `tilt` of its standard deviations keeps
+        the likelihood ratios from degenerating no matter how many invoices or
+        months there are.
+        """
+        probabilities = self.get_delay_probabilities(False)
+        delays = numpy.arange(len(probabilities))
+        delay_variance = numpy.dot(probabilities, delays ** 2) - \
+            numpy.dot(probabilities, delays) ** 2
+        balances = self.get_tilted_balances()
+        variance = 0.0
+        if not kwargs.get('ontime_payment', False):
+            variance += delay_variance * numpy.sum(balances ** 2)
+        if not kwargs.get('ontime_completion', False):
+            variance += delay_variance * \
+                numpy.sum(balances[self.n_unpaid:] ** 2)
+        variance += self.per_person_costs.var() * numpy.sum(self.n_people ** 2)
+        if not variance:
+            return 0.0
+        return tilt / numpy.sqrt(variance)
+
+    def simulate_weighted_monthly_cash(self, random_state, n_universes,
+                                       tilt=1.0, **kwargs):
+        """Importance sample `n_universes` universes that are biased toward
+        bad months. The payment and completion delays are tilted toward longer
+        delays and the per-person costs toward higher costs so that the money
+        that they take out of the bank increases by `tilt` standard deviations
+        (see `get_tilt_scale`). This returns the monthly cash, bonus pool and
+        quarterly taxes like `simulate_monthly_cash` and the likelihood ratio
+        weight of every universe, which makes weighted averages over the
+        universes unbiased estimates for the untilted model.
+        """
+        scale = self.get_tilt_scale(tilt, **kwargs)
+        log_weights = numpy.zeros(n_universes)
+        revenues = self.simulate_revenues(
+            random_state, n_universes, tilt=scale, log_weights=log_weights,
+            **kwargs
+        )
+        costs = self.get_costs(self.simulate_per_person_cost_samples(
+            random_state, n_universes, tilt=scale, log_weights=log_weights,
+        ))
+        monthly_cash, bonus_pool, quarterly_taxes = self.get_monthly_cash(
+            revenues, costs,
+        )
+        return monthly_cash, bonus_pool, quarterly_taxes, \
+            numpy.exp(log_weights)
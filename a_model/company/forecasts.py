@@ -1,14 +1,173 @@
+import os
+import sys
+import time
 import random
 import collections
+import itertools
+import multiprocessing
+import hashlib
+import json
+import shutil
+import tempfile
 
 from dateutil.relativedelta import relativedelta
 import numpy
+import scipy.stats
+
+from . import summaries
+from .context import SimulationContext, bucket_invoices, get_monthly_cash
+from .goals import OUTCOMES
+from .results import SimulationResult
+from .sampling import SAMPLINGS, get_sampler
+from .. import decorators
+from .. import utils
+
+
+# keyword arguments of the simulations that do not change the simulated
+# universes and are therefore left out of `get_simulation_key`
+_UNKEYED_KWARGS = ('verbose', 'workers')
+
+# the simulation context that is used by each worker process when simulations
+# are run in parallel. it is set once per worker by `_initialize_worker` so
+# that it isn't shipped to the workers with every batch of universes
+_worker_context = None
+
+
+def _initialize_worker(context):
+    global _worker_context
+    _worker_context = context
+
+
+def _simulate_batch_in_worker(args):
+    function, seed, universe, n_universes, kwargs = args
+    return function(_worker_context, seed, universe, n_universes, **kwargs)
+
+
+def _simulate_seeded_batch_monthly_cash(context, seed, universe, n_universes,
+                                        sampling='pseudo', **kwargs):
+    """Simulate the batch of `n_universes` universes that starts with
+    `universe`. The random numbers only depend on `seed` and `universe`, so a
+    batch gives the same result no matter which process simulates it (see
+    `sampling.get_sampler`).
+    """
+    random_state = get_sampler(sampling, seed, universe, n_universes)
+    return context.simulate_monthly_cash(random_state, n_universes, **kwargs)
+
+
+def _simulate_seeded_batch_weighted_monthly_cash(context, seed, universe,
+                                                 n_universes,
+                                                 sampling='pseudo', **kwargs):
+    """Importance sample the batch of `n_universes` universes that starts with
+    `universe` (see `SimulationContext.simulate_weighted_monthly_cash`)
+    """
+    random_state = get_sampler(sampling, seed, universe, n_universes)
+    return context.simulate_weighted_monthly_cash(
+        random_state, n_universes, **kwargs
+    )
+
+
+def _simulate_seeded_batch_scenarios(contexts, seed, universe, n_universes,
+                                     sampling='pseudo', **kwargs):
+    """Simulate the batch of `n_universes` universes that starts with
+    `universe` for the simulation `contexts` of several scenarios (different
+    headcounts or config.ini parameters). The revenue and per-person cost noise
+    does not depend on either, so it is drawn once and shared by every
+    scenario.
+    """
+    random_state = get_sampler(sampling, seed, universe, n_universes)
+    revenues = contexts[0].simulate_revenues(
+        random_state, n_universes, **kwargs
+    )
+    per_person_cost_samples = contexts[0].simulate_per_person_cost_samples(
+        random_state, n_universes,
+    )
+    return [
+        context.get_monthly_cash(
+            revenues, context.get_costs(per_person_cost_samples),
+        )
+        for context in contexts
+    ]
+
+
+def _remove_expired_simulations(root):
+    """remove the simulations in `root` that were saved more than
+    `utils.MAX_CACHE_AGE` seconds ago
+    """
+    if not os.path.exists(root):
+        os.makedirs(root)
+    now = time.time()
+    for name in os.listdir(root):
+        dirname = os.path.join(root, name)
+        if now - os.path.getmtime(dirname) > utils.MAX_CACHE_AGE:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+
+def _concatenate_batches(batches):
+    """Stitch together the (monthly cash, bonus pool, quarterly taxes) arrays
+    from several batches of universes
+    """
+    monthly_cash_outputs = []
+    bonus_pool_outputs = []
+    quarterly_tax_outputs = collections.defaultdict(list)
+    for monthly_cash, bonus_pool, quarterly_taxes in batches:
+        monthly_cash_outputs.append(monthly_cash)
+        bonus_pool_outputs.append(bonus_pool)
+        for month in quarterly_taxes:
+            quarterly_tax_outputs[month].append(quarterly_taxes[month])
+
+    def concatenate(arrays):
+        if arrays[0] is None:
+            return None
+        return numpy.concatenate(arrays)
+    quarterly_tax_outputs = dict(
+        (month, concatenate(arrays))
+        for month, arrays in quarterly_tax_outputs.iteritems()
+    )
+    return (
+        numpy.concatenate(monthly_cash_outputs),
+        concatenate(bonus_pool_outputs),
+        quarterly_tax_outputs,
+    )
+
+
+def _get_single_universe(results):
+    """Convert the (monthly cash, bonus pool, quarterly taxes) arrays for a
+    single universe to a list, a float and a dictionary of floats
+    """
+    monthly_cash, bonus_pool, quarterly_taxes = results
+    if bonus_pool is not None:
+        bonus_pool = float(bonus_pool[0])
+    for month, quarterly_tax in quarterly_taxes.iteritems():
+        if quarterly_tax is not None:
+            quarterly_taxes[month] = float(quarterly_tax[0])
+    return monthly_cash[0].tolist(), bonus_pool, quarterly_taxes
 
 
 class ForecastCompanyMixin(object):
     """This Mixin holds everything related to forecasting cashflow into the
     future"""
 
+    # number of universes that are simulated at once by the numpy engine. this
+    # keeps the size of the (universes x invoices) noise arrays reasonable and
+    # is also the unit of work for parallel simulations. changing this changes
+    # the random numbers that are drawn for a particular seed.
+    UNIVERSE_BATCH_SIZE = 2000
+
+    # the reports that the simulations depend on (see `get_simulation_key`)
+    SIMULATION_REPORTS = (
+        'profit_loss',
+        'balance_sheet',
+        'unpaid_invoices',
+        'invoice_projections',
+        'roster',
+    )
+
+    def get_payment_terms(self):
+        """Number of months between sending an invoice and its due date"""
+        # TODO: could probably get this from quickbooks some how, or perhaps we
+        # could infer this from the due date on invoices?
+        return 1
+
     # @read_or_run
     def simulate_revenues(self, universe, n_months, **kwargs):
         """Simulate revenues from accounts receivable data.
@@ -35,24 +194,21 @@ class ForecastCompanyMixin(object):
                 return 0
             return random.randint(0, 2)
 
-        def payment_terms():
-            # TODO: could probably get this from quickbooks some how, or
-            # perhaps we could infer this from the due date on invoices?
-            return 1
+        # months in which each invoice is expected to be paid without any
+        # noise (see `compile_simulation_context`)
+        context = self.compile_simulation_context(n_months)
+        months = context.invoice_months.tolist()
+        balances = context.invoice_balances.tolist()
+        n_unpaid = context.n_unpaid
 
         # revenue from accounts receiveable is, all things considered,
         # extremely certain. The biggest question here is whether people will
         # pay on time.
-        for date, balance in self.unpaid_invoices:
-            months_from_now = self._get_months_from_now(date) - 1
-
-            # we are presumably actively bugging people about overdue invoices,
-            # so these should be paid relatively soon
-            months_from_now = max(0, months_from_now)
+        for month, balance in zip(months[:n_unpaid], balances[:n_unpaid]):
 
             # add this balance to the revenues if the revenue hits in the
             # simulation time window
-            month = months_from_now + ontime_payment_noise()
+            month += ontime_payment_noise()
             if month < n_months:
                 revenues[month] += balance
 
@@ -60,10 +216,8 @@ class ForecastCompanyMixin(object):
         # are two sources of variability: (i) whether the work is deemed done
         # in time to receive payment by the specified date and (ii) whether our
         # clients pay on time.
-        for date, balance in self.invoice_projections:
-            months_from_now = self._get_months_from_now(date)
-            month = months_from_now + payment_terms() + \
-                ontime_completion_noise() + ontime_payment_noise()
+        for month, balance in zip(months[n_unpaid:], balances[n_unpaid:]):
+            month += ontime_completion_noise() + ontime_payment_noise()
             if month < n_months:
                 revenues[month] += balance
         return revenues
@@ -73,11 +227,12 @@ class ForecastCompanyMixin(object):
         """Simulate datascope's costs over time
         """
 
-        # get fixed costs from P&L and treat it like a constant. only use the
-        # last 12 months of historical per-person costs to better calibrate for
-        # recent changes in expenses.
-        fixed_cost = self.profit_loss.get_average_fixed_cost()
-        per_person_costs = self.get_historical_per_person_costs()[-12:]
+        # fixed costs come from the P&L and are treated like a constant. only
+        # the last 12 months of historical per-person costs are used to better
+        # calibrate for recent changes in expenses (see
+        # `compile_simulation_context`)
+        context = self.compile_simulation_context(n_months)
+        per_person_costs = context.per_person_costs.tolist()
 
         # variable costs (i) scale with the number of people and (ii) vary
         # quite a bit more.
@@ -85,113 +240,563 @@ class ForecastCompanyMixin(object):
             return n_people * random.choice(per_person_costs)
 
         costs = [0.0] * n_months
-        for month, date in enumerate(self.iter_future_months(n_months)):
-            n_people = self.n_people(date)
-            costs[month] += fixed_cost + variable_cost(n_people)
+        for month, n_people in enumerate(context.n_people):
+            costs[month] += context.fixed_cost + variable_cost(n_people)
 
             # handle big, consistently timed expenses here
-            if date.month == 12:
-                costs[month] += self.get_401k_contribution(date)
+            costs[month] += context.consistent_costs[month]
         return costs
 
+    @decorators.derived
+    def compile_simulation_context(self, n_months):
+        """Compile everything that is needed to simulate the next `n_months`
+        into an immutable `SimulationContext`. This collects the headcount,
+        invoices, costs and config parameters once so that simulating each
+        universe, in this process or in a worker process, does not need to
+        touch the reports or the config.ini again. The context is recompiled
+        when any of the reports it reads are reloaded or people are added.
+        """
+        start_date = next(self.iter_future_months(1))
+        dates = list(self.iter_future_months(n_months))
+        ledger_dates = [
+            start_date + relativedelta(months=month)
+            for month in range(n_months)
+        ]
+
+        # months in which each invoice is expected to be paid without any
+        # noise. we are presumably actively bugging people about overdue
+        # invoices, so these should be paid relatively soon. projected invoices
+        # are paid after the payment terms
+        invoice_months, invoice_balances = [], []
+        for date, balance in self.unpaid_invoices:
+            invoice_months.append(max(0, self._get_months_from_now(date) - 1))
+            invoice_balances.append(balance)
+        n_unpaid = len(invoice_months)
+        for date, balance in self.invoice_projections:
+            invoice_months.append(
+                self._get_months_from_now(date) + self.get_payment_terms()
+            )
+            invoice_balances.append(balance)
+        invoice_months = numpy.array(invoice_months, dtype=int)
+        invoice_balances = numpy.array(invoice_balances, dtype=float)
+        bucket_months, bucket_balances, bucket_counts, bucket_projected = \
+            bucket_invoices(invoice_months, invoice_balances, n_unpaid)
+
+        # TODO get Lyuda / Matt to help us have a quickbooks report that makes
+        # it easy to get this information directly from quickbooks instead of
+        # having to enter it by hand in the config.ini
+        return SimulationContext(
+            start_date=start_date,
+            dates=tuple(dates),
+            ledger_dates=tuple(ledger_dates),
+            n_people=numpy.array(self.n_people_array(dates), dtype=float),
+            consistent_costs=numpy.array([
+                self.get_401k_contribution(date) if date.month == 12 else 0.0
+                for date in dates
+            ]),
+            fixed_cost=self.profit_loss.get_average_fixed_cost(),
+            per_person_costs=numpy.sort(
+                self.get_historical_per_person_costs()[-12:]
+            ),
+            invoice_months=invoice_months,
+            invoice_balances=invoice_balances,
+            n_unpaid=n_unpaid,
+            bucket_months=bucket_months,
+            bucket_balances=bucket_balances,
+            bucket_counts=bucket_counts,
+            bucket_projected=bucket_projected,
+            cash=self.balance_sheet.get_current_cash_in_bank(),
+            ytd_revenue=self.profit_loss.get_ytd_revenue(),
+            ytd_cost=self.profit_loss.get_ytd_cost(),
+            ytd_tax_draws=self.ytd_tax_draws,
+            tax_rate=self.tax_rate,
+            fraction_profit_for_dividends=self.fraction_profit_for_dividends,
+            cash_buffers=self._get_december_cash_buffers(ledger_dates),
+        )
+
+    def _get_december_cash_buffers(self, dates):
+        """the cash buffer on each of `dates` in December (when bonuses are
+        paid) and NaN otherwise
+        """
+        return numpy.array([
+            self.get_cash_buffer(date) if date.month == 12 else numpy.nan
+            for date in dates
+        ])
+
+    def simulate_revenues_array(self, random_state, n_universes, n_months,
+                                **kwargs):
+        """Simulate revenues for `n_universes` universes at once. This has the
+        same noise model as `simulate_revenues` but returns an array with shape
+        (n_universes, n_months).
+        """
+        context = self.compile_simulation_context(n_months)
+        return context.simulate_revenues(random_state, n_universes, **kwargs)
+
+    def simulate_costs_array(self, random_state, n_universes, n_months,
+                             **kwargs):
+        """Simulate costs for `n_universes` universes at once. This has the
+        same cost model as `simulate_costs` but returns an array with shape
+        (n_universes, n_months).
+        """
+        context = self.compile_simulation_context(n_months)
+        return context.simulate_costs(random_state, n_universes, **kwargs)
+
     def get_monthly_cash(self, start_date, revenues, costs, cash=None,
                          ytd_revenue=None, ytd_cost=None, ytd_tax_draws=None):
         """This function takes some predefined revenues, costs, and any other
         relevant financial information and computes the monthly_cash
         """
         assert len(revenues) == len(costs)
+        return _get_single_universe(self.get_monthly_cash_array(
+            start_date, [revenues], [costs], cash=cash,
+            ytd_revenue=ytd_revenue, ytd_cost=ytd_cost,
+            ytd_tax_draws=ytd_tax_draws,
+        ))
+
+    def get_monthly_cash_array(self, start_date, revenues, costs, cash=None,
+                               ytd_revenue=None, ytd_cost=None,
+                               ytd_tax_draws=None):
+        """This is the same as `get_monthly_cash` for many universes at once.
+        `revenues` and `costs` have shape (n_universes, n_months) and the
+        monthly cash, bonus pool and quarterly taxes are arrays that have one
+        entry per universe (see `context.get_monthly_cash`).
+        """
+        n_months = numpy.shape(revenues)[1]
         if cash is None:
             cash = self.balance_sheet.get_current_cash_in_bank()
         if ytd_revenue is None:
             ytd_revenue = self.profit_loss.get_ytd_revenue()
         if ytd_cost is None:
             ytd_cost = self.profit_loss.get_ytd_cost()
-
-        # TODO get Lyuda / Matt to help us have a quickbooks report that makes
-        # it easy to get this information directly from quickbooks instead of
-        # having to enter it by hand in the config.ini
         if ytd_tax_draws is None:
             ytd_tax_draws = self.ytd_tax_draws
-        tax_months = set([1, 4, 6, 9])
-        quarterly_taxes = dict((month, None) for month in tax_months)
-        monthly_cash = []
-        bonus_pool = None
-        for month in range(len(revenues)):
-            date = start_date + relativedelta(months=month)
-
-            # quarterly tax draws only decrease the cash in the bank; they do
-            # not count as a cost for datascope. the tax draw in january is for
-            # Q4 of the previous year so we reset the ytd_* values below. we
-            # pay taxes on our ytd profit but without also paying duplicate
-            # taxes on the previous quarters
-            if date.month in tax_months:
-                ytd_profit = max([0.0, ytd_revenue - ytd_cost])
-                quarterly_tax = self.tax_rate * ytd_profit - ytd_tax_draws
-                quarterly_tax = max([0.0, quarterly_tax])
-                quarterly_taxes[date.month] = quarterly_tax
-                cash -= quarterly_tax
-                ytd_tax_draws += quarterly_tax
-
-            # pay bonuses at the end of December. can instead count this in
-            # January if it looks like Datascope's profits will grow in the
-            # next year, but this gives us the flexibility to pay bonuses early
-            # if appropriate. bonus calculation has to happen here to have
-            # access to the net cash in the bank at the end of the month. bonus
-            # counts as an expense and reduces our tax burden. taxes have
-            # already been paid on dividends and are just drawn from the bank.
-            if date.month == 12:
-                # TODO: this currently calculates things in a very conservative
-                # way by calculating taxes BEFORE calculating the bonus. half
-                # of the bonus_pool counts as a cost for the business, which
-                # would reduce our Q4 tax burden if we actually pay bonuses in
-                # december.
-                #
-                # TODO: have command line option to do bonuses after the new
-                # year
-                _ytd_revenue = ytd_revenue + revenues[month]
-                _ytd_cost = ytd_cost + costs[month]
-                _ytd_profit = max([0.0, _ytd_revenue - _ytd_cost])
-                q4_tax = self.tax_rate * _ytd_profit - ytd_tax_draws
-                q4_tax = max([0.0, q4_tax])
-                eom_cash = cash + revenues[month] - costs[month] - q4_tax
-                buffer = self.get_cash_buffer(date)
-                bonus_pool = max([0.0, eom_cash - buffer])
-                f = self.fraction_profit_for_dividends
-                costs[month] += (1.0 - f) * bonus_pool
-                cash -= f * bonus_pool
-
-            # pay all normal expenses and add revenues for the month
-            cash -= costs[month]
-            cash += revenues[month]
-            ytd_cost += costs[month]
-            ytd_revenue += revenues[month]
-
-            # reset the ytd calculations as necessary to make the tax
-            # calculations correct
-            if date.month == 12:
-                ytd_revenue, ytd_cost = 0.0, 0.0
-                ytd_tax_draws = 0.0
+        dates = [
+            start_date + relativedelta(months=month)
+            for month in range(n_months)
+        ]
+        return get_monthly_cash(
+            dates, revenues, costs, cash, ytd_revenue, ytd_cost,
+            ytd_tax_draws, self.tax_rate, self.fraction_profit_for_dividends,
+            self._get_december_cash_buffers(dates),
+        )
 
-            # record and return the cash in the bank at the end of the month
-            monthly_cash.append(cash)
+    def _simulate_single_universe_monthly_cash(self, universe, n_months,
+                                               seed=None, **kwargs):
+        if seed is not None:
+            random.seed(seed << 32 | universe)
+        context = self.compile_simulation_context(n_months)
+        return _get_single_universe(context.get_monthly_cash(
+            [self.simulate_revenues(universe, n_months, **kwargs)],
+            [self.simulate_costs(universe, n_months, **kwargs)],
+        ))
 
-        return monthly_cash, bonus_pool, quarterly_taxes
+    def _iter_batches(self, function, context, n_months, n_universes,
+                      verbose=False, seed=None, workers=1, tolerance=None,
+                      bonus_pool_tolerance=None, max_seconds=None,
+                      streaming_summaries=None, **kwargs):
+        """Iterate over the results of `function` for every batch of universes,
+        in order. `function` is called with the simulation `context` (see
+        `compile_simulation_context`), the `seed`, the first universe in the
+        batch and the number of universes in the batch.
 
-    def _simulate_single_universe_monthly_cash(self, universe, n_months,
-                                               **kwargs):
-        for start_date in self.iter_future_months(1):
+        Universes are simulated in batches of `UNIVERSE_BATCH_SIZE` that are
+        seeded by (`seed`, first universe in the batch). Batches are spread
+        across a pool of `workers` processes when `workers > 1` and the results
+        are identical regardless of the number of workers.
+
+        Specifying a `tolerance` for the outcome probabilities, a
+        `bonus_pool_tolerance` (in dollars) for the bonus pool percentiles, or
+        a time budget of `max_seconds` turns on sequential sampling. Batches
+        are then simulated until every 95% confidence interval is narrower
+        than +/- its tolerance or time runs out, and `n_universes` is the
+        maximum number of universes to simulate. Each batch is added to
+        `streaming_summaries` (one `summaries.SimulationSummary` per simulated
+        scenario), which are created as necessary to check for convergence.
+        The number of universes and the achieved error are reported on stderr
+        and can be looked up on the summaries or on the `SimulationResult`s
+        (see `summaries.get_precision_str`).
+        """
+        has_tolerance = \
+            tolerance is not None or bonus_pool_tolerance is not None
+        adaptive = has_tolerance or max_seconds is not None
+        if seed is None:
+            seed = random.randint(0, 2 ** 32 - 1)
+        tasks = []
+        for universe in range(0, n_universes, self.UNIVERSE_BATCH_SIZE):
+            n_batch = min(self.UNIVERSE_BATCH_SIZE, n_universes - universe)
+            tasks.append((function, seed, universe, n_batch, kwargs))
+
+        # the simulation context is sent to each worker once when the pool is
+        # created instead of being pickled with every batch
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(
+                min(workers, len(tasks)),
+                initializer=_initialize_worker,
+                initargs=(context,),
+            )
+            batches = pool.imap(_simulate_batch_in_worker, tasks)
+        else:
+            batches = (
+                function(context, seed, universe, n_batch, **kwargs)
+                for function, seed, universe, n_batch, kwargs in tasks
+            )
+        t0 = time.time()
+        try:
+            for task, batch in itertools.izip(tasks, batches):
+                if verbose:
+                    print >> sys.stderr, "simulation %d" % task[2]
+
+                # scenario methods return a list of results for each batch
+                results = batch if isinstance(batch, list) else [batch]
+                if streaming_summaries is None and adaptive:
+                    streaming_summaries = [
+                        self._new_summary(n_months) for result in results
+                    ]
+                for summary, result in zip(streaming_summaries or [], results):
+                    summary.update(*result, classify=self.classify_outcomes)
+                yield batch
+
+                # stop once the results are precise enough or we are out of
+                # time
+                if adaptive:
+                    elapsed = time.time() - t0
+                    outcome_error = max(
+                        summary.get_outcome_error()
+                        for summary in streaming_summaries
+                    )
+                    bonus_pool_error = max(
+                        summary.get_bonus_pool_error()
+                        for summary in streaming_summaries
+                    )
+                    converged = has_tolerance and \
+                        (tolerance is None or outcome_error <= tolerance) and \
+                        (bonus_pool_tolerance is None or
+                         bonus_pool_error <= bonus_pool_tolerance)
+                    out_of_time = \
+                        max_seconds is not None and elapsed >= max_seconds
+                    if converged or out_of_time or task is tasks[-1]:
+                        print >> sys.stderr, (
+                            "simulated %d universes in %.1f seconds; outcome "
+                            "probabilities +/- %.3f, bonus pool percentiles "
+                            "+/- %s"
+                        ) % (
+                            streaming_summaries[0].n_universes, elapsed,
+                            outcome_error,
+                            utils.currency_str(bonus_pool_error),
+                        )
+                        break
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def simulate_monthly_cash_array(self, n_months=12, n_universes=1000,
+                                    **kwargs):
+        """Simulate finances for all universes at once with numpy. This returns
+        the monthly cash as an array with shape (n_universes, n_months), the
+        bonus pool as an array with shape (n_universes,) (or None if there is
+        no December in the simulation) and a dictionary of quarterly tax draws
+        keyed by month with arrays of shape (n_universes,). See `_iter_batches`
+        for how the `seed` and `workers` keyword arguments are used and
+        `sampling` for the strategies that the `sampling` keyword argument
+        selects.
+        """
+        return _concatenate_batches(self._iter_batches(
+            _simulate_seeded_batch_monthly_cash,
+            self.compile_simulation_context(n_months), n_months, n_universes,
+            **kwargs
+        ))
+
+    def simulate_headcount_scenarios(self, scenarios, n_months=12,
+                                     n_universes=1000, **kwargs):
+        """Compare the cash in the bank for several headcount `scenarios` with
+        common random numbers. Each scenario is a list of people (or names of
+        people) to add to the current roster. The revenue and per-person cost
+        noise is drawn once per universe and reused for every scenario, so only
+        the headcount-dependent costs, taxes and bonuses are recomputed and the
+        differences between scenarios are not swamped by simulation noise.
+
+        This returns a list with a `results.SimulationResult` for each
+        scenario. The cash buffer and cash goal grow with the headcount, so the
+        outcomes of each scenario are classified, and its convergence is
+        checked, with the thresholds of its own roster.
+        """
+        contexts, outcome_thresholds, scenario_summaries = [], [], []
+        for people in scenarios:
+            with self.additional_people(people):
+                contexts.append(self.compile_simulation_context(n_months))
+                outcome_thresholds.append(
+                    self._get_outcome_threshold_lookup(n_months)
+                )
+                scenario_summaries.append(self._new_summary(n_months))
+
+        def simulate():
+            batches = self._iter_batches(
+                _simulate_seeded_batch_scenarios, contexts, n_months,
+                n_universes, streaming_summaries=scenario_summaries,
+                **kwargs
+            )
+            return [
+                self._get_simulation_result(
+                    n_months, *_concatenate_batches(scenario_batches),
+                    get_outcome_thresholds=get_outcome_thresholds
+                )
+                for scenario_batches, get_outcome_thresholds in zip(
+                    zip(*batches), outcome_thresholds,
+                )
+            ]
+        return self._read_or_simulate(
+            'headcount_scenarios', n_months, simulate,
+            outcome_thresholds=outcome_thresholds, scenarios=scenarios,
+            n_universes=n_universes, **kwargs
+        )
+
+    def sweep_parameters(self, grid, month=None, percentiles=(2.5, 50, 97.5),
+                         n_months=12, n_universes=1000, resolution=100.0,
+                         **kwargs):
+        """Evaluate every combination of the config.ini parameters in `grid`,
+        a dictionary that maps parameter names to lists of values (see
+        `override_parameters`). Like `simulate_headcount_scenarios`, every grid
+        point shares the same revenue and per-person cost noise and the
+        universes are streamed into a `summaries.SimulationSummary` for each
+        grid point.
+
+        This returns a tidy table with one row per grid point: an ordered
+        dictionary with the parameter values, the probability of each of the
+        `OUTCOMES` in `month` (the last simulated month by default) and the
+        bonus pool `percentiles` (None when there is no December in the
+        simulation).
+        """
+        if month is None:
+            month = n_months
+        names = sorted(grid)
+        points = [
+            collections.OrderedDict(zip(names, values))
+            for values in itertools.product(*[grid[name] for name in names])
+        ]
+
+        # the cash buffers, cash goals and outcome thresholds all depend on
+        # the parameters, so each grid point gets its own context and summary
+        contexts, scenario_summaries = [], []
+        for point in points:
+            with self.override_parameters(**point):
+                contexts.append(self.compile_simulation_context(n_months))
+                scenario_summaries.append(
+                    self._new_summary(n_months, resolution=resolution)
+                )
+        batches = self._iter_batches(
+            _simulate_seeded_batch_scenarios, contexts, n_months,
+            n_universes, streaming_summaries=scenario_summaries, **kwargs
+        )
+        for batch in batches:
             pass
-        return self.get_monthly_cash(
-           start_date,
-           self.simulate_revenues(universe, n_months, **kwargs),
-           self.simulate_costs(universe, n_months, **kwargs),
+
+        table = []
+        for point, summary in zip(points, scenario_summaries):
+            row = collections.OrderedDict(point)
+            row['month'] = month
+            row['n_universes'] = summary.n_universes
+            outcomes = summary.get_outcomes_in_month(month)
+            for outcome, probability in outcomes.iteritems():
+                row[' '.join(outcome.split())] = probability
+            for p in percentiles:
+                key = 'bonus_pool_p%s' % p
+                row[key] = None
+                if summary.bonus_pool.n:
+                    row[key] = summary.bonus_pool.percentile(p)
+            table.append(row)
+        return table
+
+    def get_sampling_variance_reduction(self, samplings=SAMPLINGS,
+                                        n_replications=10, month=None,
+                                        n_months=12, n_universes=1000,
+                                        seed=None, **kwargs):
+        """Diagnose how much each of the `samplings` strategies reduces the
+        variance of the outcome probabilities in `month` (the last simulated
+        month by default). Every strategy simulates `n_universes` universes
+        `n_replications` times with the same seeds, and the variance of each
+        outcome probability across replications is compared to the variance
+        with the first strategy ('pseudo' by default). A variance reduction of
+        4 means that the strategy is as accurate as simulating four times as
+        many universes with the first strategy.
+
+        This returns a tidy table with a row for every strategy and outcome
+        with the mean and standard deviation of the probability across
+        replications and the variance reduction (None when the probability
+        does not vary).
+        """
+        if month is None:
+            month = n_months
+        if seed is None:
+            seed = random.randint(0, 2 ** 32 - 1)
+        seeds = numpy.random.RandomState(seed).randint(
+            0, 2 ** 31, size=n_replications,
         )
+        probabilities = collections.OrderedDict()
+        for strategy in samplings:
+            probabilities[strategy] = []
+            for replication_seed in seeds.tolist():
+                monthly_cash, _, _ = self.simulate_monthly_cash_array(
+                    n_months, n_universes, seed=replication_seed,
+                    sampling=strategy, **kwargs
+                )
+                outcomes = self.get_outcomes_in_month(month, monthly_cash)
+                probabilities[strategy].append(outcomes.values())
+            probabilities[strategy] = numpy.array(probabilities[strategy])
+
+        table = []
+        baseline = probabilities[samplings[0]].var(axis=0, ddof=1)
+        for strategy, values in probabilities.iteritems():
+            variances = values.var(axis=0, ddof=1)
+            for i, outcome in enumerate(outcomes):
+                variance_reduction = None
+                if variances[i] > 0:
+                    variance_reduction = baseline[i] / variances[i]
+                table.append(collections.OrderedDict([
+                    ('sampling', strategy),
+                    ('outcome', ' '.join(outcome.split())),
+                    ('mean', values[:, i].mean()),
+                    ('std', numpy.sqrt(variances[i])),
+                    ('variance_reduction', variance_reduction),
+                ]))
+        return table
+
+    def estimate_outcome_probabilities(self, month=None, tilt=1.0,
+                                       confidence=0.95, n_months=12,
+                                       n_universes=1000, **kwargs):
+        """Estimate the probability of each of the `OUTCOMES` in `month` (the
+        last simulated month by default) by importance sampling. Universes are
+        simulated with payment and completion delays and per-person costs that
+        are tilted toward bad months by `tilt` standard deviations and are
+        reweighted by their likelihood ratios (see
+        `SimulationContext.simulate_weighted_monthly_cash`). This gives
+        credible estimates of rare outcomes like 'dip into credit' and 'bye
+        bye' with far fewer universes than counting, which usually finds none
+        of them. Larger tilts sample rarer outcomes but the weights become
+        more uneven, which the effective number of universes keeps track of.
+
+        Only the first `month` months are simulated so that the tilt is not
+        spent on months that can not affect the outcomes. This returns a tidy
+        table with a row for every outcome with the estimated probability, its
+        standard error, the (Agresti-Coull) `confidence` interval and the
+        effective number of universes.
+        """
+        for key in ('tolerance', 'bonus_pool_tolerance', 'max_seconds'):
+            if kwargs.pop(key, None) is not None:
+                raise ValueError('%s can not be used to estimate outcome '
+                                 'probabilities by importance sampling' % key)
+        if month is None:
+            month = n_months
+        batches = list(self._iter_batches(
+            _simulate_seeded_batch_weighted_monthly_cash,
+            self.compile_simulation_context(month), month, n_universes,
+            tilt=tilt, **kwargs
+        ))
+        cash = numpy.concatenate([batch[0][:, month-1] for batch in batches])
+        weights = numpy.concatenate([batch[3] for batch in batches])
+        outcomes = self.classify_outcomes(
+            cash, self.get_outcome_thresholds(month),
+        )
+
+        # self-normalized importance sampling estimates, which are always
+        # between 0 and 1 and add up to 1 even when the weights are uneven
+        weights = weights / weights.sum()
+        n_effective = 1.0 / (weights ** 2).sum()
+        z = scipy.stats.norm.ppf(0.5 + confidence / 2.0)
+
+        # the confidence intervals are Agresti-Coull intervals on the
+        # effective number of universes so that they do not collapse to [0, 0]
+        # when no tilted universe lands in a rare outcome
+        n_tilde = n_effective + z * z
+        table = []
+        for i, outcome in enumerate(OUTCOMES):
+            indicators = outcomes == i
+            probability = weights[indicators].sum()
+            std_error = numpy.sqrt(
+                numpy.sum((weights * (indicators - probability)) ** 2)
+            )
+            p_tilde = (n_effective * probability + z * z / 2.0) / n_tilde
+            half_width = z * numpy.sqrt(p_tilde * (1.0 - p_tilde) / n_tilde)
+            table.append(collections.OrderedDict([
+                ('outcome', ' '.join(outcome.split())),
+                ('probability', probability),
+                ('std_error', std_error),
+                ('lower', max(0.0, p_tilde - half_width)),
+                ('upper', min(1.0, p_tilde + half_width)),
+                ('n_effective', n_effective),
+            ]))
+        return table
+
+    def _new_summary(self, n_months, resolution=100.0):
+        thresholds = [
+            self.get_outcome_thresholds(month)
+            for month in range(1, n_months+1)
+        ]
+        bonus_month = None
+        for month, date in enumerate(self.iter_future_months(n_months)):
+            if date.month == 12:
+                bonus_month = month
+        return summaries.SimulationSummary(
+            thresholds, bonus_month=bonus_month, resolution=resolution,
+        )
+
+    def summarize_monthly_cash(self, n_months=12, n_universes=1000,
+                               resolution=100.0, **kwargs):
+        """Simulate finances like `simulate_monthly_cash_array`, but stream the
+        universes into a `summaries.SimulationSummary` as they are simulated
+        instead of keeping all of them in memory. Percentiles are accurate to
+        within `resolution` dollars.
+        """
+        summary = self._new_summary(n_months, resolution=resolution)
+        batches = self._iter_batches(
+            _simulate_seeded_batch_monthly_cash,
+            self.compile_simulation_context(n_months), n_months, n_universes,
+            streaming_summaries=[summary], **kwargs
+        )
+        for batch in batches:
+            pass
+        return summary
 
     def simulate_monthly_cash(self, n_months=12, n_universes=1000,
-                              verbose=False, **kwargs):
+                              verbose=False, engine='numpy', **kwargs):
         """Simulate finances and the cash in the bank at the end of every
-        month.
+        month. By default, all of the universes are simulated at once with
+        numpy (see `simulate_monthly_cash_array`); use `engine='python'` to
+        simulate one universe at a time. The python engine reseeds the `random`
+        module for every universe when a `seed` is specified but always runs in
+        this process. This returns a `results.SimulationResult`, which is
+        reused by later simulations with the same `seed` and inputs (see
+        `_read_or_simulate`).
         """
+        def simulate():
+            return [self._simulate_monthly_cash(
+                n_months, n_universes, verbose=verbose, engine=engine,
+                **kwargs
+            )]
+        return self._read_or_simulate(
+            'monthly_cash', n_months, simulate, n_universes=n_universes,
+            engine=engine, **kwargs
+        )[0]
+
+    def _simulate_monthly_cash(self, n_months, n_universes, verbose=False,
+                               engine='numpy', **kwargs):
+        if engine == 'numpy':
+            return self._get_simulation_result(
+                n_months, *self.simulate_monthly_cash_array(
+                    n_months, n_universes, verbose=verbose, **kwargs
+                )
+            )
+        elif engine != 'python':
+            raise ValueError('engine must be either "numpy" or "python"')
+        kwargs.pop('workers', None)
+        if kwargs.pop('revenue_kernel', 'invoices') != 'invoices':
+            raise ValueError('revenue_kernel requires the numpy engine')
+        if kwargs.pop('sampling', 'pseudo') != 'pseudo':
+            raise ValueError('sampling requires the numpy engine')
+        for key in ('tolerance', 'bonus_pool_tolerance', 'max_seconds'):
+            if kwargs.pop(key, None) is not None:
+                raise ValueError('%s requires the numpy engine' % key)
+
         monthly_cash_outputs = []
         bonus_pool_outputs = []
         quarterly_tax_outputs = collections.defaultdict(list)
@@ -206,4 +811,131 @@ class ForecastCompanyMixin(object):
             bonus_pool_outputs.append(bonus_pool)
             for month in quarterly_taxes:
                 quarterly_tax_outputs[month].append(quarterly_taxes[month])
-        return monthly_cash_outputs, bonus_pool_outputs, quarterly_tax_outputs
+
+        def toarray(values):
+            if None in values:
+                return None
+            return numpy.array(values)
+        return self._get_simulation_result(
+            n_months,
+            numpy.array(monthly_cash_outputs).reshape(n_universes, n_months),
+            toarray(bonus_pool_outputs),
+            dict(
+                (month, toarray(values))
+                for month, values in quarterly_tax_outputs.iteritems()
+            ),
+        )
+
+    def get_simulation_key(self, name, n_months, **kwargs):
+        """get the key of the simulation `name` of `n_months` with the
+        simulation `kwargs` (including the seed). This is a hash of
+        everything the simulated universes depend on: the contents of the
+        `SIMULATION_REPORTS`, the config.ini parameters, today and the
+        headcount in every simulated month.
+        """
+        reports = {}
+        for report_name in self.SIMULATION_REPORTS:
+            report = getattr(self, report_name)
+            report.load_table()
+            reports[report_name] = report.content_hash
+        parameters = dict(self.config.items('parameters'))
+        parameters.update(self._parameter_overrides)
+        dates = list(self.iter_future_months(n_months))
+        inputs = {
+            'reports': reports,
+            'parameters': parameters,
+            'today': self.today.isoformat(),
+            'people': [person.name for person in self.people],
+            'n_people': self.n_people_array(dates).tolist(),
+            'universe_batch_size': self.UNIVERSE_BATCH_SIZE,
+            'n_months': n_months,
+            'kwargs': dict(
+                (key, value) for key, value in kwargs.iteritems()
+                if key not in _UNKEYED_KWARGS
+            ),
+        }
+        return '%s-%s' % (name, hashlib.sha1(
+            json.dumps(inputs, sort_keys=True)
+        ).hexdigest())
+
+    def _read_or_simulate(self, name, n_months, simulate,
+                          outcome_thresholds=None, **kwargs):
+        """Seeded simulations are reproducible, so the `SimulationResult`s
+        that `simulate` returns are saved in DATA_ROOT as .npy files. Any
+        later simulation with the same key (see `get_simulation_key`), like
+        the ones in the other scripts that `make pngs` runs, memory-maps them
+        instead of simulating them again. Saved simulations expire after
+        `utils.MAX_CACHE_AGE`. Simulations with a time budget
+        (`max_seconds`) simulate a different number of universes depending on
+        how fast the machine is, so they are never saved. Loaded results look
+        up their outcome thresholds with the functions in `outcome_thresholds`
+        (one per result, see `_get_outcome_threshold_lookup`) or with
+        `get_outcome_thresholds` by default.
+        """
+        if kwargs.get('seed') is None or \
+                kwargs.get('max_seconds') is not None:
+            return simulate()
+        try:
+            key = self.get_simulation_key(name, n_months, **kwargs)
+        except TypeError:
+            # simulations with arguments that can not be serialized (like
+            # Person objects) are never saved
+            return simulate()
+        root = os.path.join(utils.DATA_ROOT, 'simulations')
+        dirname = os.path.join(root, key)
+
+        # load the saved results, if possible and they have not expired
+        if os.path.isdir(dirname) and \
+                time.time() - os.path.getmtime(dirname) <= utils.MAX_CACHE_AGE:
+            dates = list(self.iter_future_months(n_months))
+            n_results = len(os.listdir(dirname))
+            if outcome_thresholds is None:
+                outcome_thresholds = [self.get_outcome_thresholds] * n_results
+            results = [
+                SimulationResult.load(
+                    os.path.join(dirname, str(i)), dates,
+                    get_outcome_thresholds, self.classify_outcomes,
+                )
+                for i, get_outcome_thresholds in zip(
+                    range(n_results), outcome_thresholds,
+                )
+            ]
+            if results and None not in results:
+                return results
+
+        # otherwise, simulate and save the results. they are written to a
+        # temporary directory first so that readers never see partially
+        # written results
+        results = simulate()
+        _remove_expired_simulations(root)
+        tmp_dirname = tempfile.mkdtemp(dir=root, suffix='.tmp')
+        try:
+            for i, result in enumerate(results):
+                result.save(os.path.join(tmp_dirname, str(i)))
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname, ignore_errors=True)
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            # another process saved the same simulation first
+            shutil.rmtree(tmp_dirname, ignore_errors=True)
+        return results
+
+    def _get_outcome_threshold_lookup(self, n_months):
+        """get a function that looks up the outcome thresholds of the next
+        `n_months` months like `get_outcome_thresholds`, but with the roster
+        and parameters as they are now instead of when it is called
+        """
+        thresholds = [
+            self.get_outcome_thresholds(month)
+            for month in range(1, n_months+1)
+        ]
+        return lambda month: thresholds[month-1]
+
+    def _get_simulation_result(self, n_months, monthly_cash, bonus_pool,
+                               quarterly_taxes, get_outcome_thresholds=None):
+        return SimulationResult(
+            self.iter_future_months(n_months), monthly_cash, bonus_pool,
+            quarterly_taxes,
+            get_outcome_thresholds or self.get_outcome_thresholds,
+            self.classify_outcomes,
+        )
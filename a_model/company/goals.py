@@ -1,11 +1,70 @@
+import os
 import datetime
+import multiprocessing
+import hashlib
+import json
+import tempfile
 
 import numpy
 import collections
-import scipy.optimize
 
 from .. import utils
 
+# the possible outcomes for the cash in the bank in any given month, from best
+# to worst
+OUTCOMES = (
+    '>goal bonus',
+    'buffer+bonus',
+    'buffer low,\n no bonus',
+    'dip into credit',
+    'bye bye',
+)
+
+# the company that is used by each worker process when goal seeks are run in
+# parallel (see `GoalCompanyMixin.cache_annual_cash_goals`)
+_worker_company = None
+
+
+def _initialize_worker(company):
+    global _worker_company
+    _worker_company = company
+
+
+def _get_annual_cash_goal_in_worker(year):
+    return year, _worker_company.get_annual_cash_goal(year)
+
+
+def _get_annual_cash_goals_filename():
+    return os.path.join(utils.DATA_ROOT, 'annual_cash_goals.json')
+
+
+def _load_annual_cash_goals():
+    """load the persisted goal seeks, keyed by year and a hash of the inputs
+    to the goal seek
+    """
+    try:
+        with open(_get_annual_cash_goals_filename()) as stream:
+            return json.load(stream)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_annual_cash_goal(key, annual_cash_goal):
+    """persist a goal seek. the file is rewritten through a temporary file so
+    that it is never partially written. goal seeks that run in parallel may
+    occasionally overwrite each other, in which case they are simply solved
+    again next time
+    """
+    annual_cash_goals = _load_annual_cash_goals()
+    annual_cash_goals[key] = annual_cash_goal
+    filename = _get_annual_cash_goals_filename()
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename), suffix='.tmp',
+    )
+    with os.fdopen(fd, 'w') as stream:
+        json.dump(annual_cash_goals, stream)
+    os.rename(tmp_filename, filename)
+
 
 class GoalCompanyMixin(object):
     """This Mixin holds all of the functionality related to calculating the
@@ -16,9 +75,50 @@ class GoalCompanyMixin(object):
         annual_cash_goal = dict(self.get_annual_cash_goal(date.year))
         return annual_cash_goal[date]
 
+    def cache_annual_cash_goals(self, years, workers=1):
+        """run the goal seeks for all `years` that are not already cached,
+        spread across a pool of `workers` processes when `workers > 1`
+        """
+        if not hasattr(self, '_annual_cash_goals'):
+            self._annual_cash_goals = {}
+        years = sorted(set(years) - set(self._annual_cash_goals))
+        if workers > 1 and len(years) > 1:
+            pool = multiprocessing.Pool(
+                min(workers, len(years)),
+                initializer=_initialize_worker,
+                initargs=(self,),
+            )
+            try:
+                results = pool.map(_get_annual_cash_goal_in_worker, years)
+            finally:
+                pool.terminate()
+            self._annual_cash_goals.update(results)
+        else:
+            for year in years:
+                self.get_annual_cash_goal(year)
+
+    def get_goal_timeline(self, start_date, end_date, workers=1):
+        """get the cash buffer and cash goal at the end of every month from
+        `start_date` to `end_date` in one shot. This returns the dates and
+        arrays of the cash buffers and cash goals on those dates. The buffers
+        share one headcount lookup and one cost computation and the goal seeks
+        for each year are run in parallel with `workers` processes (see
+        `cache_annual_cash_goals`).
+        """
+        dates = list(utils.iter_end_of_months(start_date, end_date))
+        years = set(date.year for date in dates)
+        self.cache_annual_cash_goals(years, workers=workers)
+        cash_goals_by_date = {}
+        for year in years:
+            cash_goals_by_date.update(self._annual_cash_goals[year])
+        cash_goals = numpy.array([cash_goals_by_date[date] for date in dates])
+        return dates, self.get_cash_buffers(dates), cash_goals
+
     def get_annual_cash_goal(self, year):
         """do a goal seek to figure out how much revenue per datascoper per
-        month we need to generate to meet our goal profitability
+        month we need to generate to meet our goal profitability. goal seeks
+        are persisted in DATA_ROOT for the inputs they were solved with (see
+        `_load_annual_cash_goals`)
         """
         if not hasattr(self, '_annual_cash_goals'):
             self._annual_cash_goals = {}
@@ -29,125 +129,172 @@ class GoalCompanyMixin(object):
         )
         t1 = datetime.date(year, 12, 31)
         cash0 = self.get_cash_buffer(t0)
-        average_tax_rate = self.average_tax_rate(t1)
 
-        # average number of people
-        n_average, n = 0.0, 0.0
-        for t in utils.iter_end_of_months(t0, t1):
-            n_average += self.n_people(t)
-            n += 1.0
-        n_average /= n
+        # number of people in every month and on average
+        n_people = self.n_people_array(
+            list(utils.iter_end_of_months(t0, t1))
+        )
+        n_average = n_people.mean()
 
         # costs are fixed for the year by the number of people
-        def constant_costs():
-            costs = []
-            fixed_cost = self.profit_loss.get_average_fixed_cost()
-            per_person_cost = numpy.mean(
-                self.get_historical_per_person_costs()
+        fixed_cost = self.profit_loss.get_average_fixed_cost()
+        per_person_cost = numpy.mean(self.get_historical_per_person_costs())
+        costs = fixed_cost + n_people * per_person_cost
+        costs[-1] += self.get_401k_contribution(t1)
+
+        # calculate the target bonus pool size that the actual bonus pool
+        # should match
+        monthly_salary = self.before_tax_annual_salary / 12.0
+        target_bonus = monthly_salary * self.n_months_before_tax_bonus
+        target_bonus_pool = n_average * target_bonus / \
+            (1.0 - self.fraction_profit_for_dividends)
+
+        def get_monthly_cash(monthly_revenues_per_person):
+            # idealized revenue streams for several amounts of revenue per
+            # person per month at once
+            revenues = numpy.outer(monthly_revenues_per_person, n_people)
+            return self.get_monthly_cash_array(
+                t0, revenues, numpy.tile(costs, (len(revenues), 1)),
+                cash=cash0, ytd_revenue=0.0, ytd_cost=0.0, ytd_tax_draws=0.0,
             )
-            for t in utils.iter_end_of_months(t0, t1):
-                n = self.n_people(t)
-                costs.append(fixed_cost + n * per_person_cost)
-            costs[-1] += self.get_401k_contribution(t1)
-            return costs
-
-        def constant_revenues(monthly_revenue_per_person):
-            revenues = []
-            for t in utils.iter_end_of_months(t0, t1):
-                n = self.n_people(t)
-                revenues.append(n * monthly_revenue_per_person)
-            return revenues
-
-        def helper(monthly_revenue_per_person):
-            # fit the eoy cash to be the same as the cash buffer. square the
-            # result to make sure the numer is positive for optimization
-            # purposes
-            revenues = constant_revenues(monthly_revenue_per_person)
-            costs = constant_costs()
-            monthly_cash, bonus_pool, quarterly_taxes = self.get_monthly_cash(
-                t0, revenues, costs, cash=cash0,
-                ytd_revenue=0.0, ytd_cost=0.0, ytd_tax_draws=0.0,
+
+        # the goal seek only depends on these inputs, so persisted results can
+        # be reused as long as they are the same
+        inputs = {
+            'cash0': cash0,
+            'n_people': n_people.tolist(),
+            'costs': costs.tolist(),
+            'target_bonus_pool': target_bonus_pool,
+            'tax_rate': self.tax_rate,
+            'fraction_profit_for_dividends':
+                self.fraction_profit_for_dividends,
+            'cash_buffer': self.get_cash_buffer(t1),
+        }
+        key = '%d-%s' % (year, hashlib.sha1(
+            json.dumps(inputs, sort_keys=True)
+        ).hexdigest())
+        persisted = _load_annual_cash_goals()
+        if key in persisted:
+            monthly_revenue_per_person = \
+                persisted[key]['monthly_revenue_per_person']
+            result = [
+                (utils.iso_date(date), cash)
+                for date, cash in persisted[key]['cash_goals']
+            ]
+        else:
+            monthly_revenue_per_person = self._solve_annual_cash_goal(
+                lambda x: get_monthly_cash(x)[1], target_bonus_pool,
             )
-            a = monthly_cash[-1] - self.get_cash_buffer(t1)
-
-            # calculate the target bonus pool size and make sure the actual
-            # bonus pool is close
-            monthly_salary = self.before_tax_annual_salary / 12.0
-            target_bonus = monthly_salary * self.n_months_before_tax_bonus
-            target_bonus_pool = n_average * target_bonus / \
-                (1.0 - self.fraction_profit_for_dividends)
-            b = bonus_pool - target_bonus_pool
-
-            # TODO: does this do the correct thing with Q4 taxes in january
-            # print monthly_revenue_per_person, bonus_pool, target_pool, a, b
-            return b * b
-
-        # optimize the function above to find the amount of revenue per person
-        # per month that is necessary to meet our target
-        # http://bit.ly/1q5XNE8
-        opt = scipy.optimize.minimize_scalar(
-            helper,
-            bounds=(5000, 30000),
-            method='bounded',
-        )
 
-        # get the cash goal by simulating this idealized revenue stream. be
-        # sure to add back the bonus pool to December in the monthly cash so
-        # that other calculations work correctly
-        revenues = constant_revenues(opt.x)
-        costs = constant_costs()
-        monthly_cash, bonus_pool, quarterly_taxes = self.get_monthly_cash(
-            t0, revenues, costs, cash=cash0,
-            ytd_revenue=0.0, ytd_cost=0.0, ytd_tax_draws=0.0,
-        )
-        monthly_cash[-1] += bonus_pool
-        result = [(datetime.date(t0.year, t0.month, 1), cash0)]
+            # get the cash goal by simulating this idealized revenue stream.
+            # be sure to add back the bonus pool to December in the monthly
+            # cash so that other calculations work correctly
+            monthly_cash, bonus_pool, quarterly_taxes = get_monthly_cash(
+                [monthly_revenue_per_person],
+            )
+            monthly_cash, bonus_pool = monthly_cash[0], bonus_pool[0]
+            monthly_cash[-1] += bonus_pool
+            result = [(datetime.date(t0.year, t0.month, 1), cash0)]
+            for t, cash in zip(utils.iter_end_of_months(t0, t1),
+                               monthly_cash.tolist()):
+                result.append((t, cash))
+            result.append((
+                t1 + datetime.timedelta(days=1),
+                monthly_cash[-1]-bonus_pool,
+            ))
+            _save_annual_cash_goal(key, {
+                'monthly_revenue_per_person': monthly_revenue_per_person,
+                'cash_goals': [
+                    (date.isoformat(), cash) for date, cash in result
+                ],
+            })
         self._annual_cash_goals[year] = result
-        for t, cash in zip(utils.iter_end_of_months(t0, t1), monthly_cash):
-            result.append((t, cash))
-        result.append((
-            t1 + datetime.timedelta(days=1),
-            monthly_cash[-1]-bonus_pool,
-        ))
 
         # print out some helpful statistics
-        r = sum(revenues)
+        r = n_people.sum() * monthly_revenue_per_person
         print "TARGET %d REVENUES" % year, utils.currency_str(r)
         print "...THAT's %s PER PERSON" % utils.currency_str(r / n_average)
 
         return result
 
-    def get_outcomes_in_month(self, month, monthly_cash_outcomes):
+    def _solve_annual_cash_goal(self, get_bonus_pools, target_bonus_pool,
+                                bounds=(5000, 30000), tolerance=0.01,
+                                n_grid=26, max_iterations=50):
+        """find the monthly revenue per person within `bounds` at which the
+        bonus pool is `target_bonus_pool` (to within `tolerance` dollars).
+        `get_bonus_pools` calculates the bonus pool for an array of monthly
+        revenues per person at once.
+
+        revenue is linear in the monthly revenue per person and the tax and
+        bonus calculations are piecewise linear (and non-decreasing) in
+        revenue, so the bonus pool is bracketed with one evaluation of a grid
+        and then found by interpolating within the bracket. each iteration
+        also bisects the bracket to guarantee progress across kinks. if the
+        target is out of reach, this returns the closest bound.
+        """
+        lower, upper = bounds
+        x = numpy.linspace(lower, upper, n_grid)
+        bonus_pools = get_bonus_pools(x)
+        if target_bonus_pool <= bonus_pools[0]:
+            return float(lower)
+        if target_bonus_pool >= bonus_pools[-1]:
+            return float(upper)
+
+        # bracket the target and refine the bracket
+        i = numpy.searchsorted(bonus_pools, target_bonus_pool)
+        x0, x1 = x[i-1], x[i]
+        b0, b1 = bonus_pools[i-1], bonus_pools[i]
+        for iteration in range(max_iterations):
+            slope = (x1 - x0) / (b1 - b0)
+            interpolated = x0 + (target_bonus_pool - b0) * slope
+            candidates = numpy.array([interpolated, (x0 + x1) / 2.0])
+            for candidate, b in zip(candidates, get_bonus_pools(candidates)):
+                if abs(b - target_bonus_pool) <= tolerance:
+                    return float(candidate)
+                if b < target_bonus_pool and candidate > x0:
+                    x0, b0 = candidate, b
+                elif b > target_bonus_pool and candidate < x1:
+                    x1, b1 = candidate, b
+        return float(interpolated)
+
+    def get_outcome_thresholds(self, month):
+        """get the cash thresholds that separate the `OUTCOMES` in `month`"""
         date = utils.date_in_n_months(month)
-        cash_goal = self.get_cash_goal(date)
-        keys = [
-            '>goal bonus',
-            'buffer+bonus',
-            'buffer low,\n no bonus',
-            'dip into credit',
-            'bye bye',
-        ]
-        outcomes = collections.OrderedDict.fromkeys(keys, 0.0)
-        cash_buffer = self.get_cash_buffer(date)
-        for i in range(len(monthly_cash_outcomes)):
-            monthly_cash = monthly_cash_outcomes[i]
-            cash = monthly_cash[month-1]
+        return (
+            self.get_cash_goal(date),
+            self.get_cash_buffer(date) - 0.001,  # rounding errors
+            0.0,
+            -self.line_of_credit,
+        )
+
+    def classify_outcomes(self, cash, thresholds):
+        """get the index in `OUTCOMES` for each value of `cash`"""
+        cash_goal, cash_buffer, zero, line_of_credit = thresholds
+        cash = numpy.asarray(cash)
+        return numpy.select(
+            [
+                cash > cash_goal,
+                cash >= cash_buffer,
+                cash > zero,
+                cash > line_of_credit,
+            ],
+            [0, 1, 2, 3],
+            default=4,
+        )
+
+    def get_outcomes_in_month(self, month, monthly_cash_outcomes):
+        thresholds = self.get_outcome_thresholds(month)
+        outcomes = collections.OrderedDict.fromkeys(OUTCOMES, 0.0)
+        if len(monthly_cash_outcomes):
             # TODO: do we need to use the bonus_pool_outcomes to properly
             # estimate things?
-            if cash > cash_goal:
-                outcomes[keys[0]] += 1
-            elif cash >= cash_buffer - 0.001:  # rounding errors
-                outcomes[keys[1]] += 1
-            elif cash > 0:
-                outcomes[keys[2]] += 1
-            elif cash > -self.line_of_credit:
-                outcomes[keys[3]] += 1
-            else:
-                outcomes[keys[4]] += 1
-        norm = sum(outcomes.values())
-        if norm > 0:
-            for k, v in outcomes.iteritems():
-                outcomes[k] = float(v) / norm
+            cash = numpy.asarray(monthly_cash_outcomes)[:, month-1]
+            counts = numpy.bincount(
+                self.classify_outcomes(cash, thresholds),
+                minlength=len(OUTCOMES),
+            )
+            for key, count in zip(OUTCOMES, counts):
+                outcomes[key] = float(count) / len(cash)
         return outcomes
 
     def get_cash_buffer(self, date=None):
@@ -0,0 +1,63 @@
+import numpy
+
+from .. import utils
+
+
+class HeadcountTimeline(object):
+    """Precomputed people x month matrices of who is active, who is a partner
+    and who is eligible for 401(k) contributions at the end of every month
+    between `start_date` and `end_date`. This makes headcount lookups for a
+    month O(1) instead of checking every person every time. Only end of month
+    dates are covered; `get_column` returns None for any other date.
+    """
+
+    def __init__(self, people, start_date, end_date):
+        self.dates = list(utils.iter_end_of_months(start_date, end_date))
+        self._columns = dict(
+            (date, column) for column, date in enumerate(self.dates)
+        )
+
+        # the same rules as Person.is_active, Person.is_partner and
+        # BaseCompany.iter_401k_eligible, evaluated once for every month
+        shape = (len(people), len(self.dates))
+        self.active = numpy.zeros(shape, dtype=bool)
+        self.partner = numpy.zeros(shape, dtype=bool)
+        self.eligible_401k = numpy.zeros(shape, dtype=bool)
+        for i, person in enumerate(people):
+            for column, date in enumerate(self.dates):
+                self.active[i, column] = person.is_active(date)
+                self.partner[i, column] = bool(person.is_partner(date))
+                dt = date - person.start_date
+                self.eligible_401k[i, column] = self.active[i, column] and \
+                    float(dt.days) / 30 > 6 and person.fraction_time == 1
+
+        # headcount in every month, weighted by the fraction of time that
+        # people work
+        fraction_time = numpy.array(
+            [person.fraction_time for person in people], dtype=float,
+        )
+        self.n_people = fraction_time.dot(self.active)
+        self.active_or_partner = self.active | self.partner
+        self.n_people_and_partners = fraction_time.dot(self.active_or_partner)
+        self.n_partners = fraction_time.dot(self.partner)
+        self.n_people_401k_eligible = fraction_time.dot(self.eligible_401k)
+
+    def get_column(self, date):
+        """get the column for `date` or None if `date` is not covered"""
+        return self._columns.get(date)
+
+    def get_columns(self, dates):
+        """get the columns for all `dates` or None if any of them is not
+        covered
+        """
+        columns = [self._columns.get(date) for date in dates]
+        if None in columns:
+            return None
+        return numpy.array(columns, dtype=int)
+
+    def iter_indices(self, matrix, date):
+        """iterate over the indices of the people that are flagged in `matrix`
+        on `date`
+        """
+        for i in numpy.flatnonzero(matrix[:, self.get_column(date)]):
+            yield i
@@ -0,0 +1,208 @@
+import os
+import collections
+
+import numpy
+
+from .goals import OUTCOMES
+from .summaries import get_outcome_error, get_percentile_error
+
+
+class SimulationResult(object):
+    """The universes from `ForecastCompanyMixin.simulate_monthly_cash` as
+    contiguous arrays: the cash in the bank at the end of every month with
+    shape (n_universes, n_months), the bonus pool with shape (n_universes,)
+    (or None if there is no December in the simulation) and the quarterly tax
+    draws with shape (n_universes, len(TAX_MONTHS)) (NaN for tax months that
+    are not simulated). The quarterly taxes can be given as a dictionary of
+    arrays keyed by month or as this array. `dates` are the simulated months.
+
+    Percentiles and outcome probabilities are calculated the first time they
+    are needed and cached. The outcome thresholds of each month are looked up
+    with `get_outcome_thresholds` and classified with `classify` (see
+    `GoalCompanyMixin`). Iterating over a result gives the (monthly cash, bonus
+    pool, quarterly taxes) lists that `simulate_monthly_cash` used to return,
+    so that existing code that unpacks them keeps working.
+    """
+
+    TAX_MONTHS = (1, 4, 6, 9)
+
+    def __init__(self, dates, monthly_cash, bonus_pool, quarterly_taxes,
+                 get_outcome_thresholds, classify):
+        self.dates = tuple(dates)
+        self.monthly_cash = numpy.ascontiguousarray(monthly_cash, dtype=float)
+        self.bonus_pool = bonus_pool
+        if bonus_pool is not None:
+            self.bonus_pool = numpy.asarray(bonus_pool, dtype=float)
+        if isinstance(quarterly_taxes, numpy.ndarray):
+            self.quarterly_taxes = quarterly_taxes
+        else:
+            self.quarterly_taxes = numpy.full(
+                (self.n_universes, len(self.TAX_MONTHS)), numpy.nan,
+            )
+            for i, month in enumerate(self.TAX_MONTHS):
+                if quarterly_taxes.get(month) is not None:
+                    self.quarterly_taxes[:, i] = quarterly_taxes[month]
+        self.bonus_month = None
+        for month, date in enumerate(self.dates):
+            if date.month == 12:
+                self.bonus_month = month
+        self._get_outcome_thresholds = get_outcome_thresholds
+        self._classify = classify
+        self._percentiles = {}
+        self._outcome_probabilities = None
+
+    @classmethod
+    def load(cls, dirname, dates, get_outcome_thresholds, classify):
+        """load a result that was saved in `dirname` with `save`, or return
+        None if there is none. the arrays are memory-mapped instead of read so
+        that results are shared between processes without copying them
+        """
+        arrays = {}
+        for name in ('monthly_cash', 'bonus_pool', 'quarterly_taxes'):
+            filename = os.path.join(dirname, name + '.npy')
+            if os.path.exists(filename):
+                try:
+                    arrays[name] = numpy.load(filename, mmap_mode='r')
+                except Exception:
+                    # unreadable results are simply simulated again
+                    return None
+        if 'monthly_cash' not in arrays or 'quarterly_taxes' not in arrays:
+            return None
+        return cls(
+            dates, arrays['monthly_cash'], arrays.get('bonus_pool'),
+            arrays['quarterly_taxes'], get_outcome_thresholds, classify,
+        )
+
+    def save(self, dirname):
+        """save the arrays of this result in `dirname` as .npy files (see
+        `load`)
+        """
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        arrays = {
+            'monthly_cash': self.monthly_cash,
+            'bonus_pool': self.bonus_pool,
+            'quarterly_taxes': self.quarterly_taxes,
+        }
+        for name, array in arrays.iteritems():
+            if array is not None:
+                numpy.save(os.path.join(dirname, name + '.npy'), array)
+
+    @property
+    def n_universes(self):
+        return self.monthly_cash.shape[0]
+
+    @property
+    def n_months(self):
+        return self.monthly_cash.shape[1]
+
+    def __iter__(self):
+        quarterly_taxes = collections.defaultdict(list)
+        for i, month in enumerate(self.TAX_MONTHS):
+            values = self.quarterly_taxes[:, i]
+            if numpy.isnan(values).all():
+                quarterly_taxes[month] = [None] * self.n_universes
+            else:
+                quarterly_taxes[month] = values.tolist()
+        bonus_pool = [None] * self.n_universes
+        if self.bonus_pool is not None:
+            bonus_pool = self.bonus_pool.tolist()
+        return iter((self.monthly_cash.tolist(), bonus_pool, quarterly_taxes))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    @property
+    def cash_before_bonus(self):
+        """the cash in the bank in December before the bonus is paid"""
+        if self.bonus_pool is None:
+            return None
+        return self.monthly_cash[:, self.bonus_month] + self.bonus_pool
+
+    def _get_percentile(self, key, values, p):
+        # the cached percentiles are read-only so that they can be shared
+        if (key, p) not in self._percentiles:
+            percentile = numpy.asarray(numpy.percentile(values, p, axis=0))
+            if percentile.ndim:
+                percentile.flags.writeable = False
+            else:
+                percentile = float(percentile)
+            self._percentiles[key, p] = percentile
+        return self._percentiles[key, p]
+
+    def get_monthly_cash_percentile(self, p):
+        """the `p`th percentile of the cash in the bank in every month"""
+        return self._get_percentile('monthly_cash', self.monthly_cash, p)
+
+    def get_percentile_band(self, lower=2.5, upper=97.5):
+        """the `lower` and `upper` percentiles of the cash in the bank in every
+        month
+        """
+        return (
+            self.get_monthly_cash_percentile(lower),
+            self.get_monthly_cash_percentile(upper),
+        )
+
+    def get_bonus_pool_percentile(self, p):
+        return self._get_percentile('bonus_pool', self.bonus_pool, p)
+
+    def get_cash_before_bonus_percentile(self, p):
+        return self._get_percentile(
+            'cash_before_bonus', self.cash_before_bonus, p,
+        )
+
+    def get_quarterly_tax_percentile(self, month, p):
+        """the `p`th percentile of the quarterly tax draw in `month` (one of
+        `TAX_MONTHS`)
+        """
+        i = self.TAX_MONTHS.index(month)
+        return self._get_percentile(
+            ('quarterly_taxes', month), self.quarterly_taxes[:, i], p,
+        )
+
+    def get_outcome_probabilities(self):
+        """the probability of each of the `OUTCOMES` (columns) in every month
+        (rows)
+        """
+        if self._outcome_probabilities is None:
+            thresholds = numpy.array([
+                self._get_outcome_thresholds(month)
+                for month in range(1, self.n_months+1)
+            ])
+            outcomes = self._classify(self.monthly_cash, thresholds.T)
+            self._outcome_probabilities = numpy.array([
+                (outcomes == i).mean(axis=0) for i in range(len(OUTCOMES))
+            ]).T
+        return self._outcome_probabilities
+
+    def get_outcome_error(self, confidence=0.95):
+        """half width of the widest (Agresti-Coull) confidence interval of any
+        outcome probability in any month, like
+        `SimulationSummary.get_outcome_error`
+        """
+        return get_outcome_error(
+            self.get_outcome_probabilities() * self.n_universes,
+            self.n_universes, confidence=confidence,
+        )
+
+    def get_bonus_pool_error(self, percentiles=(2.5, 50, 97.5),
+                             confidence=0.95):
+        """half width of the widest confidence interval of the bonus pool
+        `percentiles`, like `SimulationSummary.get_bonus_pool_error`
+        """
+        if self.bonus_pool is None:
+            return 0.0
+        return get_percentile_error(
+            lambda q: self.get_bonus_pool_percentile(100.0 * q),
+            self.n_universes, percentiles=percentiles, confidence=confidence,
+        )
+
+    def get_outcomes_in_month(self, month):
+        """same as `GoalCompanyMixin.get_outcomes_in_month` for these
+        universes, for 1 <= `month` <= `n_months`
+        """
+        if not 1 <= month <= self.n_months:
+            raise ValueError('month must be between 1 and %d' % self.n_months)
+        return collections.OrderedDict(
+            zip(OUTCOMES, self.get_outcome_probabilities()[month-1].tolist())
+        )
@@ -0,0 +1,301 @@
+"""Sampling strategies for simulating universes. The default 'pseudo' strategy
+draws independent pseudo-random numbers with a `numpy.random.RandomState`. The
+other strategies cover the space of random numbers more evenly so that fewer
+universes are needed for the same accuracy:
+
+* 'antithetic' pairs every universe with a mirror image universe that has the
+  complementary uniform random numbers (u and 1 - u)
+* 'sobol' uses a randomly scrambled Sobol sequence (randomized quasi-Monte
+  Carlo), where every universe is the next point of the sequence
+
+The samplers for these strategies have the same `randint`, `random_sample`
+and `multinomial` methods as `numpy.random.RandomState` (the only ones that
+`SimulationContext` uses), so they can be used in its place. Each call
+consumes the next dimensions of the uniform random numbers for every universe
+and maps them to the discrete distributions by inversion. Inversion only
+preserves the evenness of the uniform random numbers when the values that
+they index are in order, which is why `compile_simulation_context` sorts the
+per-person costs that `randint` resamples.
+"""
+
+import numpy
+import scipy.stats
+
+SAMPLINGS = ('pseudo', 'antithetic', 'sobol')
+
+# number of bits in each Sobol point and the degree of the largest primitive
+# polynomial that is used to construct Sobol dimensions. there are 1111
+# dimensions with a degree of 13 or less; any additional dimensions are padded
+# with pseudo-random numbers
+SOBOL_BITS = 32
+SOBOL_MAX_DEGREE = 13
+
+# the initial direction numbers m_k for each Sobol dimension, which are
+# computed from the primitive polynomials as they are needed (see
+# `_get_direction_numbers`)
+_direction_numbers = []
+
+
+def get_sampler(sampling, seed, universe, n_universes):
+    """Get the source of random numbers for the batch of `n_universes`
+    universes that starts with `universe`. The random numbers only depend on
+    `seed` and `universe`, so a batch gives the same result no matter which
+    process simulates it.
+    """
+    if sampling == 'pseudo':
+        return numpy.random.RandomState([seed, universe])
+    elif sampling == 'antithetic':
+        return AntitheticSampler(seed, universe, n_universes)
+    elif sampling == 'sobol':
+        return SobolSampler(seed, universe, n_universes)
+    raise ValueError('sampling must be one of %s' % ', '.join(SAMPLINGS))
+
+
+class UniformSampler(object):
+    """Base class for samplers that transform `n_universes` rows of uniform
+    random numbers (see `uniforms`) into the discrete random numbers that are
+    used in the simulation
+    """
+
+    def __init__(self, seed, universe, n_universes):
+        self.seed = seed
+        self.universe = universe
+        self.n_universes = n_universes
+        self.n_dimensions = 0
+        self.random_state = numpy.random.RandomState([seed, universe])
+
+    def uniforms(self, n_dimensions):
+        """the next `n_dimensions` uniform random numbers on [0, 1) for every
+        universe, as an array with shape (n_universes, n_dimensions)
+        """
+        raise NotImplementedError
+
+    def _get_n_dimensions(self, size):
+        if isinstance(size, int):
+            size = (size,)
+        if size[0] != self.n_universes:
+            raise ValueError(
+                'can only sample %d universes at a time' % self.n_universes
+            )
+        return int(numpy.prod(size[1:])), size
+
+    def randint(self, low, high, size):
+        """same as `numpy.random.RandomState.randint`, where the first axis of
+        `size` is the universe
+        """
+        n_dimensions, size = self._get_n_dimensions(size)
+        u = self.uniforms(n_dimensions).reshape(size)
+        n_values = high - low
+        return low + numpy.minimum((u * n_values).astype(int), n_values - 1)
+
+    def random_sample(self, size):
+        """same as `numpy.random.RandomState.random_sample`, where the first
+        axis of `size` is the universe
+        """
+        n_dimensions, size = self._get_n_dimensions(size)
+        return self.uniforms(n_dimensions).reshape(size)
+
+    def multinomial(self, n, pvals, size):
+        """same as `numpy.random.RandomState.multinomial` for `size`
+        universes. the counts are drawn one category at a time from the
+        binomial distribution of what is left over.
+        """
+        self._get_n_dimensions(size)
+        u = self.uniforms(len(pvals) - 1)
+        counts = numpy.zeros((self.n_universes, len(pvals)), dtype=int)
+        remaining = numpy.full(self.n_universes, n, dtype=int)
+        remaining_p = 1.0
+        for i, p in enumerate(pvals[:-1]):
+            q = min(1.0, max(0.0, p / remaining_p)) if remaining_p > 0 else 1
+            left = remaining > 0
+            counts[left, i] = numpy.maximum(0, scipy.stats.binom.ppf(
+                u[left, i], remaining[left], q,
+            ))
+            remaining -= counts[:, i]
+            remaining_p -= p
+        counts[:, -1] = remaining
+        return counts
+
+
+class AntitheticSampler(UniformSampler):
+    """Every other universe uses the complementary uniform random numbers of
+    the universe before it
+    """
+
+    def uniforms(self, n_dimensions):
+        self.n_dimensions += n_dimensions
+        n_pairs = (self.n_universes + 1) // 2
+        u = self.random_state.random_sample((n_pairs, n_dimensions))
+        uniforms = numpy.empty((2 * n_pairs, n_dimensions))
+        uniforms[0::2] = u
+        uniforms[1::2] = 1.0 - u
+        return uniforms[:self.n_universes]
+
+
+class SobolSampler(UniformSampler):
+    """Universe i is point i of a Sobol sequence that is scrambled with a
+    random linear matrix scramble and digital shift (see
+    `_get_scrambled_direction_numbers`). The scramble only depends on the
+    `seed`, so the batches of universes are all part of the same sequence and
+    simulating with different seeds gives independent randomizations.
+    """
+
+    def uniforms(self, n_dimensions):
+        start = self.n_dimensions
+        self.n_dimensions += n_dimensions
+
+        # the sobol points are the XOR of the direction numbers for every bit
+        # that is set in the index of the point
+        points = numpy.arange(
+            self.universe, self.universe + self.n_universes,
+            dtype=numpy.uint64,
+        )
+        directions, shifts = _get_scrambled_direction_numbers(
+            self.seed, start, n_dimensions,
+        )
+        n_sobol = len(directions)
+        x = numpy.tile(shifts, (self.n_universes, 1))
+        for bit in range(SOBOL_BITS):
+            has_bit = ((points >> numpy.uint64(bit)) & numpy.uint64(1)) \
+                .astype(bool)
+            x[has_bit] ^= directions[:, bit]
+        uniforms = x / float(2 ** SOBOL_BITS)
+
+        # pad with pseudo-random numbers beyond the available dimensions
+        n_padding = n_dimensions - n_sobol
+        if n_padding:
+            uniforms = numpy.hstack([
+                uniforms,
+                self.random_state.random_sample((self.n_universes, n_padding)),
+            ])
+        return uniforms
+
+
+def _multiply_polynomials(a, b, modulus, degree):
+    """multiply the polynomials over GF(2) `a` and `b` (as bits of an integer)
+    modulo the polynomial `modulus` with `degree`
+    """
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a >> degree & 1:
+            a ^= modulus
+    return result
+
+
+def _power_polynomial(a, exponent, modulus, degree):
+    result = 1
+    while exponent:
+        if exponent & 1:
+            result = _multiply_polynomials(result, a, modulus, degree)
+        a = _multiply_polynomials(a, a, modulus, degree)
+        exponent >>= 1
+    return result
+
+
+def _iter_prime_factors(n):
+    factor = 2
+    while factor * factor <= n:
+        if n % factor == 0:
+            yield factor
+            while n % factor == 0:
+                n //= factor
+        factor += 1
+    if n > 1:
+        yield n
+
+
+def _is_primitive(polynomial, degree):
+    """a polynomial over GF(2) is primitive when x has order 2^degree - 1
+    modulo the polynomial
+    """
+    order = 2 ** degree - 1
+    x = 2
+    if x >> degree & 1:
+        x ^= polynomial
+    if _power_polynomial(x, order, polynomial, degree) != 1:
+        return False
+    for factor in _iter_prime_factors(order):
+        if _power_polynomial(x, order // factor, polynomial, degree) == 1:
+            return False
+    return True
+
+
+def _iter_primitive_polynomials():
+    """iterate over the (degree, polynomial) of all primitive polynomials over
+    GF(2), in order of increasing degree, up to `SOBOL_MAX_DEGREE`
+    """
+    for degree in range(1, SOBOL_MAX_DEGREE + 1):
+        for polynomial in range(2 ** degree + 1, 2 ** (degree + 1), 2):
+            if _is_primitive(polynomial, degree):
+                yield degree, polynomial
+
+
+def _get_direction_numbers(n_dimensions):
+    """get the direction numbers of (at most) the first `n_dimensions` Sobol
+    dimensions as an array with shape (n_dimensions, SOBOL_BITS). The first
+    dimension is the van der Corput sequence and the others each have a
+    primitive polynomial. The initial direction numbers are random odd
+    integers that only depend on the dimension.
+    """
+    while len(_direction_numbers) < n_dimensions:
+        if not _direction_numbers:
+            _direction_numbers.append([1] * SOBOL_BITS)
+            continue
+        try:
+            degree, polynomial = next(_primitive_polynomials)
+        except StopIteration:
+            break
+        random_state = numpy.random.RandomState(len(_direction_numbers))
+        m = [
+            2 * random_state.randint(0, 2 ** (k - 1)) + 1
+            for k in range(1, degree + 1)
+        ]
+        for k in range(degree, SOBOL_BITS):
+            value = m[k - degree] ^ (m[k - degree] << degree)
+            for i in range(1, degree):
+                if polynomial >> (degree - i) & 1:
+                    value ^= m[k - i] << i
+            m.append(value)
+        _direction_numbers.append(m)
+    m = numpy.array(_direction_numbers[:n_dimensions], dtype=numpy.uint64)
+    shifts = numpy.arange(SOBOL_BITS - 1, -1, -1, dtype=numpy.uint64)
+    return (m << shifts).reshape(-1, SOBOL_BITS)
+
+
+def _get_scrambled_direction_numbers(seed, start, n_dimensions):
+    """scramble the direction numbers of (at most) `n_dimensions` dimensions
+    starting with dimension `start` with a random lower triangular matrix and
+    get a random digital shift for each dimension. the scramble of each
+    dimension only depends on the `seed` and the dimension.
+    """
+    directions = _get_direction_numbers(start + n_dimensions)[start:]
+    n_dimensions = len(directions)
+    powers = numpy.uint64(1) << numpy.arange(
+        SOBOL_BITS - 1, -1, -1, dtype=numpy.uint64,
+    )
+    scrambled = numpy.zeros_like(directions)
+    shifts = numpy.zeros(n_dimensions, dtype=numpy.uint64)
+    for i, dimension in enumerate(range(start, start + n_dimensions)):
+        # the third word separates these random numbers from the ones for
+        # the batches of universes (see `get_sampler`)
+        random_state = numpy.random.RandomState([seed, dimension, 1])
+        scramble = numpy.tril(
+            random_state.randint(0, 2, size=(SOBOL_BITS, SOBOL_BITS)), -1,
+        ) + numpy.eye(SOBOL_BITS, dtype=int)
+        shift = random_state.randint(0, 2, size=SOBOL_BITS)
+
+        # bits of the direction numbers with the most significant bit first
+        bits = (directions[i][:, numpy.newaxis] & powers) > 0
+        bits = numpy.dot(bits.astype(int), scramble.T) % 2
+        scrambled[i] = numpy.dot(bits.astype(numpy.uint64), powers)
+        shifts[i] = numpy.dot(shift.astype(numpy.uint64), powers)
+    return scrambled, shifts
+
+
+# the primitive polynomials for the Sobol dimensions that do not have direction
+# numbers yet
+_primitive_polynomials = _iter_primitive_polynomials()
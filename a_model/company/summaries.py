@@ -0,0 +1,210 @@
+import collections
+
+import numpy
+import scipy.stats
+
+from .goals import OUTCOMES
+from .. import utils
+
+
+def get_outcome_error(outcome_counts, n_universes, confidence=0.95):
+    """half width of the widest (Agresti-Coull) confidence interval of the
+    outcome probabilities from the `outcome_counts` in `n_universes` universes
+    """
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2.0)
+    n = n_universes + z * z
+    p = (numpy.asarray(outcome_counts) + z * z / 2.0) / n
+    return float((z * numpy.sqrt(p * (1.0 - p) / n)).max())
+
+
+def get_percentile_error(quantile, n, percentiles=(2.5, 50, 97.5),
+                         confidence=0.95):
+    """half width of the widest confidence interval of the `percentiles` of
+    `n` values with the `quantile` function, using the binomial distribution
+    of their ranks
+    """
+    if not n:
+        return 0.0
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2.0)
+    errors = []
+    for p in percentiles:
+        q = p / 100.0
+        dq = z * numpy.sqrt(q * (1.0 - q) / n)
+        lower = quantile(max(0.0, q - dq))
+        upper = quantile(min(1.0, q + dq))
+        errors.append((upper - lower) / 2.0)
+    return max(errors)
+
+
+def get_precision_str(simulation):
+    """describe the number of universes and the achieved error of a
+    `SimulationSummary` or `results.SimulationResult`
+    """
+    return (
+        "%d universes; outcome probabilities +/- %.3f, bonus pool "
+        "percentiles +/- %s"
+    ) % (
+        simulation.n_universes, simulation.get_outcome_error(),
+        utils.currency_str(simulation.get_bonus_pool_error()),
+    )
+
+
+class QuantileSketch(object):
+    """Mergeable, constant-memory summary of a distribution. Values are counted
+    in buckets that are `resolution` wide, so quantiles are accurate to within
+    half of `resolution` and the memory only depends on the range of the
+    values, not how many values there are.
+    """
+
+    def __init__(self, resolution=100.0):
+        self.resolution = resolution
+        self.counts = collections.Counter()
+        self.n = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def __len__(self):
+        return self.n
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=float).ravel()
+        if not len(values):
+            return
+        buckets = numpy.floor(values / self.resolution).astype(numpy.int64)
+        buckets, counts = numpy.unique(buckets, return_counts=True)
+        for bucket, count in zip(buckets.tolist(), counts.tolist()):
+            self.counts[bucket] += count
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def merge(self, other):
+        if self.resolution != other.resolution:
+            raise ValueError(
+                'can only merge sketches with the same resolution'
+            )
+        self.counts.update(other.counts)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """estimate the `q`th quantile, for 0 <= `q` <= 1"""
+        if not self.n:
+            raise ValueError('can not estimate quantiles without any values')
+        buckets = numpy.array(sorted(self.counts))
+        counts = numpy.array([self.counts[bucket] for bucket in buckets])
+        i = numpy.searchsorted(numpy.cumsum(counts), q * self.n)
+        i = min(i, len(buckets) - 1)
+        value = (buckets[i] + 0.5) * self.resolution
+        return min(max(value, self.min), self.max)
+
+    def percentile(self, p):
+        """estimate the `p`th percentile, for 0 <= `p` <= 100"""
+        return self.quantile(p / 100.0)
+
+
+class SimulationSummary(object):
+    """Streaming summary of simulated universes. This keeps quantile sketches
+    of the monthly cash, bonus pool and quarterly tax draws as well as counts
+    of the `OUTCOMES` in every month so that an arbitrary number of universes
+    can be summarized in constant memory. Summaries of different sets of
+    universes can be combined with `merge`.
+    """
+
+    def __init__(self, outcome_thresholds, bonus_month=None, resolution=100.0):
+        # `outcome_thresholds` has the thresholds for each simulated month
+        # (see `GoalCompanyMixin.get_outcome_thresholds`) and `bonus_month` is
+        # the index of the month in which bonuses are paid, if any
+        self.outcome_thresholds = numpy.array(outcome_thresholds, dtype=float)
+        self.bonus_month = bonus_month
+        self.resolution = resolution
+        n_months = len(self.outcome_thresholds)
+        self.n_universes = 0
+        self.monthly_cash = [
+            QuantileSketch(resolution) for _ in range(n_months)
+        ]
+        self.cash_before_bonus = QuantileSketch(resolution)
+        self.bonus_pool = QuantileSketch(resolution)
+        self.quarterly_taxes = {}
+        self.outcome_counts = numpy.zeros((n_months, len(OUTCOMES)), dtype=int)
+
+    @property
+    def n_months(self):
+        return len(self.monthly_cash)
+
+    def update(self, monthly_cash, bonus_pool, quarterly_taxes, classify):
+        """add a batch of universes to the summary. `classify` maps an array of
+        cash and the thresholds for a month to indices in `OUTCOMES` (see
+        `GoalCompanyMixin.classify_outcomes`).
+        """
+        self.n_universes += len(monthly_cash)
+        for month, sketch in enumerate(self.monthly_cash):
+            sketch.update(monthly_cash[:, month])
+            self.outcome_counts[month] += numpy.bincount(
+                classify(monthly_cash[:, month],
+                         self.outcome_thresholds[month]),
+                minlength=len(OUTCOMES),
+            )
+        if bonus_pool is not None:
+            self.bonus_pool.update(bonus_pool)
+            self.cash_before_bonus.update(
+                monthly_cash[:, self.bonus_month] + bonus_pool
+            )
+        for month, values in quarterly_taxes.iteritems():
+            if values is not None:
+                if month not in self.quarterly_taxes:
+                    self.quarterly_taxes[month] = \
+                        QuantileSketch(self.resolution)
+                self.quarterly_taxes[month].update(values)
+
+    def merge(self, other):
+        if self.n_months != other.n_months:
+            raise ValueError('can only merge summaries of the same months')
+        self.n_universes += other.n_universes
+        for sketch, other_sketch in zip(self.monthly_cash, other.monthly_cash):
+            sketch.merge(other_sketch)
+        self.cash_before_bonus.merge(other.cash_before_bonus)
+        self.bonus_pool.merge(other.bonus_pool)
+        for month, other_sketch in other.quarterly_taxes.iteritems():
+            if month not in self.quarterly_taxes:
+                self.quarterly_taxes[month] = QuantileSketch(self.resolution)
+            self.quarterly_taxes[month].merge(other_sketch)
+        self.outcome_counts += other.outcome_counts
+        return self
+
+    def get_outcomes_in_month(self, month):
+        """same as `GoalCompanyMixin.get_outcomes_in_month` for the summarized
+        universes, for 1 <= `month` <= `n_months`
+        """
+        if not 1 <= month <= self.n_months:
+            raise ValueError('month must be between 1 and %d' % self.n_months)
+        outcomes = collections.OrderedDict.fromkeys(OUTCOMES, 0.0)
+        if self.n_universes:
+            counts = self.outcome_counts[month-1]
+            for key, count in zip(OUTCOMES, counts):
+                outcomes[key] = float(count) / self.n_universes
+        return outcomes
+
+    def get_outcome_error(self, confidence=0.95):
+        """half width of the widest (Agresti-Coull) confidence interval of any
+        outcome probability in any month
+        """
+        return get_outcome_error(
+            self.outcome_counts, self.n_universes, confidence=confidence,
+        )
+
+    def get_bonus_pool_error(self, percentiles=(2.5, 50, 97.5),
+                             confidence=0.95):
+        """half width of the widest confidence interval of the bonus pool
+        `percentiles` (see `get_percentile_error`)
+        """
+        return get_percentile_error(
+            self.bonus_pool.quantile, self.bonus_pool.n,
+            percentiles=percentiles, confidence=confidence,
+        )
+
+    def get_monthly_cash_percentile(self, p):
+        """the `p`th percentile of the cash in the bank in every month"""
+        return [sketch.percentile(p) for sketch in self.monthly_cash]
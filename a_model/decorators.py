@@ -1,5 +1,6 @@
 from functools import wraps
 import cPickle as pickle
+import copy
 import os
 import time
 import md5
@@ -58,3 +59,30 @@ def read_or_run(method):
         return result
 
     return wrapped_method
+
+
+def derived(method):
+    """This decorator memoizes methods that derive values (like historical cost
+    series) from data that is loaded into an object. Results are cached per
+    call signature until `self.get_derived_version()` changes, which happens
+    whenever the underlying data is reloaded. A copy of the cached result is
+    returned so that callers can modify it without corrupting the cache.
+    """
+
+    @wraps(method)
+    def wrapped_method(self, *args, **kwargs):
+        version = self.get_derived_version()
+
+        # look the cache up in __dict__ to avoid any __getattr__ magic
+        version_cache = self.__dict__.get('_derived_cache')
+        if version_cache is None or version_cache[0] != version:
+            version_cache = (version, {})
+            self.__dict__['_derived_cache'] = version_cache
+        cache = version_cache[1]
+
+        cache_key = (method.func_name, args, tuple(sorted(kwargs.items())))
+        if cache_key not in cache:
+            cache[cache_key] = method(self, *args, **kwargs)
+        return copy.deepcopy(cache[cache_key])
+
+    return wrapped_method
@@ -4,6 +4,8 @@ import importlib
 import inspect
 
 from . import base
+from .scheduler import DownloadScheduler
+from .manifest import SyncManifest
 from ar_aging import ARAging
 from balance_sheet import BalanceSheet
 from profit_loss import ProfitLoss
@@ -62,8 +64,18 @@ for module_name in _iter_module_names():
             )
 
 
-def cache_quickbooks_locally(username, password, reports=None):
-    """Download data from various locations"""
+def cache_quickbooks_locally(username, password, reports=None, n_sessions=2,
+                             max_per_host=2,
+                             root_url=base.QUICKBOOKS_ROOT_URL,
+                             full_refresh=False, n_reclose_months=3):
+    """Download data from various locations. The quickbooks reports are
+    downloaded concurrently with `n_sessions` browser sessions (see
+    `DownloadScheduler`). Unless `full_refresh` is set, reports with a column
+    for every month only download the last `n_reclose_months` months and
+    merge them into the local cache (see `Report.set_incremental_window`) and
+    worksheets that have not changed since they were last downloaded are
+    skipped (see `SyncManifest`).
+    """
     reports = reports or AVAILABLE_REPORTS
 
     # determine which quickbooks reports need to be downloaded before
@@ -75,20 +87,69 @@ def cache_quickbooks_locally(username, password, reports=None):
 
     # these things all come from quickbooks and require selenium
     if download_quickbooks_reports:
-        with base.Browser() as browser:
-            browser.login_quickbooks(username, password)
-            for report_cls in download_quickbooks_reports:
-                report_cls().download_from_quickbooks(browser)
+        scheduler = DownloadScheduler(
+            username, password, n_sessions=n_sessions,
+            max_per_host=max_per_host, root_url=root_url,
+        )
+        quickbooks_reports = [
+            report_cls() for report_cls in download_quickbooks_reports
+        ]
+        if not full_refresh:
+            for report in quickbooks_reports:
+                report.set_incremental_window(n_reclose_months)
+        try:
+            scheduler.download(quickbooks_reports)
+        finally:
+            print scheduler.get_timing_report()
 
     # this is manually entered in a google spreadsheet
-    for report_cls in DOWNLOAD_GDRIVE_REPORTS:
-        if report_cls.report_name in reports:
-            report_cls().download_from_gdrive()
-
-
-def sync_local_cache_with_gdrive(reports=None):
-    """We only need to upload these reports to Google Drive"""
+    gdrive_reports = [
+        report_cls() for report_cls in DOWNLOAD_GDRIVE_REPORTS
+        if report_cls.report_name in reports
+    ]
+    if gdrive_reports:
+        manifest = SyncManifest()
+        google_workbook = gdrive_reports[0].open_google_workbook()
+        for report in gdrive_reports:
+            google_worksheet = report.open_google_worksheet(google_workbook)
+            revision = google_worksheet.updated
+            if not full_refresh and \
+                    manifest.is_unchanged('download', report, revision):
+                print report.filename, "is unchanged"
+                continue
+            report.download_from_gdrive(google_worksheet)
+            manifest.update('download', report, revision)
+
+
+def sync_local_cache_with_gdrive(reports=None, force=False):
+    """We only need to upload these reports to Google Drive. Unless `force` is
+    set, reports that have not changed since they were last uploaded (and
+    whose worksheets have not been edited since) are skipped (see
+    `SyncManifest`).
+    """
     reports = reports or AVAILABLE_REPORTS
-    for report_cls in UPLOAD_GDRIVE_REPORTS:
-        if report_cls.report_name in reports:
-            report_cls().upload_to_gdrive()
+    gdrive_reports = [
+        report_cls() for report_cls in UPLOAD_GDRIVE_REPORTS
+        if report_cls.report_name in reports
+    ]
+    if gdrive_reports:
+        manifest = SyncManifest()
+        google_workbook = gdrive_reports[0].open_google_workbook()
+        uploaded_reports = []
+        for report in gdrive_reports:
+            google_worksheet = report.open_google_worksheet(google_workbook)
+            if not force and manifest.is_unchanged(
+                    'upload', report, google_worksheet.updated):
+                print report.gsheet_tab_name, "is unchanged"
+                continue
+            report.upload_to_gdrive(google_worksheet)
+            uploaded_reports.append(report)
+
+        # the worksheets have new revisions after the upload. gspread caches
+        # the worksheets of a workbook, so the workbook is opened again to
+        # get them
+        if uploaded_reports:
+            google_workbook = gdrive_reports[0].open_google_workbook()
+        for report in uploaded_reports:
+            google_worksheet = report.open_google_worksheet(google_workbook)
+            manifest.update('upload', report, google_worksheet.updated)
@@ -15,4 +15,4 @@ class ARAging(Report):
 
     def get_total(self):
         self.load_table()
-        return self.cells[-1].value
+        return self.get_table().get_last_cell().value
@@ -6,6 +6,7 @@ class BalanceSheet(Report):
     gsheet_tab_name = 'Balance Sheet'
     download_method = 'quickbooks'
     upload_method = 'gdrive'
+    incremental = True
 
     def __init__(self, *args, **kwargs):
         super(BalanceSheet, self).__init__(*args, **kwargs)
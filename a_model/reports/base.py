@@ -6,21 +6,31 @@ import os
 import sys
 import datetime
 import time
-import itertools
-import operator
+import contextlib
 import json
 import re
 import csv
+import hashlib
+import cStringIO
+from xml.etree.ElementTree import Element, SubElement
 
 from bs4 import BeautifulSoup
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 import gspread
+from gspread.ns import ATOM_NS, SPREADSHEET_NS
+from gspread.urls import construct_url
 from oauth2client.client import SignedJwtAssertionCredentials
 from dateutil.relativedelta import relativedelta
+import numpy
 
 from .. import utils
 from . import exceptions
+from .table import Cell, Table, decode_date, parse_value, iter_month_cols, \
+    merge_monthly_tables
 
 
 QUICKBOOKS_ROOT_URL = 'http://qbo.intuit.com'
@@ -40,12 +50,20 @@ EXCEL_MIMETYPES = (
 class Browser(webdriver.Firefox):
     """
     This class is a context manager to be sure to close the browser when we're
-    all done.
+    all done. Pass `root_url` to log in somewhere other than
+    QUICKBOOKS_ROOT_URL (like a local stand-in server for testing) and
+    `headless=True` to run firefox without a window.
+
+    Instead of sleeping for a fixed amount of time, the browser waits until
+    the page is ready for the next step (see `wait_until`). How long each
+    step takes is recorded in `timings` (see `timed`).
     """
 
-    SLEEPING_TIME = 3  # seconds
+    TIMEOUT = 30  # seconds
 
     def __init__(self, *args, **kwargs):
+        root_url = kwargs.pop('root_url', QUICKBOOKS_ROOT_URL)
+        headless = kwargs.pop('headless', False)
 
         # create a firefox profile to automatically download files (like excel
         # files) without having to approve of the download
@@ -62,11 +80,16 @@ class Browser(webdriver.Firefox):
             ','.join(EXCEL_MIMETYPES)
         )
 
-        # instantiate a firefox instance and implicitly wait for find_element_*
-        # methods for 10 seconds in case content does not immediately appear
+        # instantiate a firefox instance. find_element_* methods do not wait
+        # for content to appear; use `wait_until` instead
         kwargs.update({'firefox_profile': profile})
+        if headless:
+            options = Options()
+            options.add_argument('-headless')
+            kwargs.update({'firefox_options': options})
         super(Browser, self).__init__(*args, **kwargs)
-        self.implicitly_wait(30)
+        self.root_url = root_url
+        self.timings = []
 
     # __enter__ and __exit__ make it a context manager
     # https://code.google.com/p/selenium/issues/detail?id=3228
@@ -74,55 +97,93 @@ class Browser(webdriver.Firefox):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        # quit instead of closing the window so that geckodriver does not
+        # outlive the session
+        self.quit()
+
+    def wait_until(self, condition, timeout=None):
+        """wait until `condition` (a function of the browser, like the ones in
+        `selenium.webdriver.support.expected_conditions`) is true for up to
+        `timeout` seconds (TIMEOUT by default) and return its value
+        """
+        return WebDriverWait(self, timeout or self.TIMEOUT).until(condition)
 
-    def login_quickbooks(self, username, password):
-        self.get(QUICKBOOKS_ROOT_URL)
-        self.find_element_by_name("Email").send_keys(username)
-        self.find_element_by_name("Password").send_keys(password)
-        # if you don't wait for a tiny bit before clicking the button,
-        # quickbooks will not let you sign in. sleeping after clicking also
-        # helps let quickbooks log you into the system before making the next
-        # request.
-        time.sleep(self.SLEEPING_TIME)
-        self.find_element_by_name("SignIn").click()
-        time.sleep(self.SLEEPING_TIME)
-
-    def get(self, *args, **kwargs):
-        # wrap these GET requests in SLEEPING_TIME to give poor qwuickbwooks
-        # some time to rest before asking it for more information.
-        time.sleep(self.SLEEPING_TIME)
-        result = super(Browser, self).get(*args, **kwargs)
-        time.sleep(self.SLEEPING_TIME)
-
-
-class Cell(object):
-    def __init__(self, row, col, value):
-        self.row = row
-        self.col = col
+    @contextlib.contextmanager
+    def timed(self, step, name=''):
+        """record how many seconds the `step` (like 'login' or 'navigate') of
+        `name` takes in `timings`
+        """
+        t0 = time.time()
         try:
-            self.value = float(value.replace('$', '').replace(',', ''))
-        except:
-            self.value = value
+            yield
+        finally:
+            self.timings.append((step, name, time.time() - t0))
 
-    @property
-    def colchr(self):
-        # TODO: if we ever get past 26*26 columsn, this won't work
-        c = ''
-        tens = self.col / 26
-        zero = ord('A')
-        # it goes A AA AB, AC, ... BA BB BC ...
-        if tens > 0:
-            c += chr(tens + zero - 1)
-        c += chr(self.col - tens * 26 + zero)
-        return c
+    def login_quickbooks(self, username, password):
+        with self.timed('login'):
+            self.get(self.root_url)
+            self.wait_until(EC.visibility_of_element_located(
+                (By.NAME, "Email"),
+            )).send_keys(username)
+            self.find_element_by_name("Password").send_keys(password)
+
+            # quickbooks will not let you sign in until the sign in button is
+            # ready. the login is complete once quickbooks has replaced the
+            # sign in page
+            sign_in = self.wait_until(
+                EC.element_to_be_clickable((By.NAME, "SignIn")),
+            )
+            sign_in.click()
+            self.wait_until(EC.staleness_of(sign_in))
+
+
+def _to_unicode(value):
+    """the text of a table or worksheet `value`. values read from the csvs are
+    utf-8 encoded byte strings
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
 
-    @property
-    def excel_coords(self):
-        return "%s%s" % (self.colchr, self.row + 1)
 
-    def __repr__(self):
-        return '<Cell %s: %s>' % (self.excel_coords, self.value)
+def _is_same_value(value, google_value):
+    """whether the cell of a worksheet with `google_value` already shows the
+    table `value`. numbers are compared to the cent to ignore the formatting
+    of the worksheet
+    """
+    google_value = parse_value(google_value)
+    if isinstance(value, float) and isinstance(google_value, float):
+        return abs(value - google_value) < 0.005
+    return _to_unicode(value).strip() == _to_unicode(google_value).strip()
+
+
+def _new_google_cell(google_worksheet, row, col, value):
+    """create the `gspread.Cell` for updating the cell of `google_worksheet` in
+    `row` and `col` to `value` without fetching it from google first. the
+    batch update only needs the url of the cell, which is also its edit link
+    """
+    url = construct_url(
+        'cells_cell_id', google_worksheet, cell_id='R%dC%d' % (row, col),
+    )
+    entry = Element('{%s}entry' % ATOM_NS)
+    SubElement(entry, '{%s}title' % ATOM_NS).text = \
+        google_worksheet.get_addr_int(row, col)
+    SubElement(entry, '{%s}id' % ATOM_NS).text = url
+    SubElement(entry, '{%s}link' % ATOM_NS, {
+        'rel': 'edit', 'type': 'application/atom+xml', 'href': url,
+    })
+    SubElement(entry, '{%s}cell' % SPREADSHEET_NS, {
+        'row': str(row), 'col': str(col),
+    })
+    google_cell = gspread.Cell(google_worksheet, entry)
+    google_cell.value = _to_unicode(value)
+    return google_cell
+
+
+def _is_report_present(browser):
+    """modern reports render tables and legacy reports render a legacyframe"""
+    return browser.find_elements_by_id('legacyframe') or \
+        browser.find_elements_by_tag_name('table')
 
 
 class Report(object):
@@ -141,12 +202,23 @@ class Report(object):
     # url for quickbooks QUICKBOOKS_ROOT_URL
     start_date = datetime.date(2014, 1, 1)
 
+    # date-range reports with a column for every month can be downloaded
+    # incrementally (see `set_incremental_window`)
+    incremental = False
+
     def __init__(self, today=None):
         self.end_date = utils.end_of_last_month(today)
         self.filename = os.path.join(
             utils.DATA_ROOT, self.report_name + self.report_ext
         )
-        self.cells = []
+        self.snapshot_filename = os.path.join(
+            utils.DATA_ROOT, self.report_name + '.npz'
+        )
+        self.content_hash = None
+        self.cached_table = None
+        self.table_version = 0
+        self.table = Table.from_rows([])
+        self._new_cells = []
 
     def _get_date_customized_params(self):
         return(
@@ -160,6 +232,32 @@ class Report(object):
             ('low_date', utils.qbo_date_str(self.start_date)),
         ) + self._get_date_customized_params()
 
+    def set_incremental_window(self, n_reclose_months):
+        """only download the last `n_reclose_months` months, which can still
+        change when the books are (re)closed, and any months that are newer
+        than the locally cached report. The downloaded months are merged into
+        the cached report (see `table.merge_monthly_tables`). Reports that
+        are not `incremental` or that are not cached yet are downloaded in
+        full.
+        """
+        if n_reclose_months < 1:
+            raise ValueError('n_reclose_months must be at least 1')
+        if not self.incremental or not os.path.exists(self.filename):
+            return
+        with open(self.filename) as stream:
+            cached_table = Table.from_rows(list(csv.reader(stream)))
+        dates = [date for col, date in iter_month_cols(cached_table)]
+        if not dates:
+            return
+        end_month = datetime.date(self.end_date.year, self.end_date.month, 1)
+        start_date = min(
+            end_month - relativedelta(months=n_reclose_months - 1),
+            max(dates) + datetime.timedelta(days=1),
+        )
+        if start_date > self.start_date:
+            self.start_date = start_date
+            self.cached_table = cached_table
+
     def get_report_date_customized_params(self):
         return (
             ('report_date', utils.qbo_date_str(self.end_date)),
@@ -171,30 +269,45 @@ class Report(object):
     @property
     def url(self):
         """convenience function for creating report urls"""
-        report_url = QUICKBOOKS_ROOT_URL + '/app/report'
+        return self.get_url()
+
+    def get_url(self, root_url=QUICKBOOKS_ROOT_URL):
+        report_url = root_url + '/app/report'
         return report_url + '?' + utils.urlencode(self.get_qbo_query_params())
 
     def download_from_quickbooks(self, browser):
-        browser.get(self.url)
-
-        # get the HTML out of the report
-        try:
-            browser.find_element_by_id('legacyframe')
-        except NoSuchElementException:
-            table_html = ''
-            for table in browser.find_elements_by_tag_name('table'):
-                table_html += table.get_attribute('innerHTML')
-        else:
-            iframe = browser.find_element_by_tag_name('iframe')
-            browser.switch_to_frame(iframe)
-            iframe2 = browser.find_element_by_tag_name('iframe')
-            browser.switch_to_frame(iframe2)
-            table = browser.find_element_by_id('rptBodyTable')
-            table_html = table.get_attribute('innerHTML')
-            browser.switch_to_default_content()
-
-        self.extract_table_from_html(table_html)
-        self.save_csv()
+        with browser.timed('navigate', self.report_name):
+            browser.get(self.get_url(browser.root_url))
+            browser.wait_until(_is_report_present)
+
+        # get the HTML out of the report. the report is already present, so
+        # whether it is a legacy report can be checked without waiting
+        with browser.timed('extract', self.report_name):
+            if not browser.find_elements_by_id('legacyframe'):
+                table_html = ''
+                for table in browser.find_elements_by_tag_name('table'):
+                    table_html += table.get_attribute('innerHTML')
+            else:
+                # the legacy report table is nested two iframes deep
+                iframe = (By.TAG_NAME, 'iframe')
+                for i in range(2):
+                    browser.wait_until(
+                        EC.frame_to_be_available_and_switch_to_it(iframe),
+                    )
+                table = browser.wait_until(
+                    EC.presence_of_element_located((By.ID, 'rptBodyTable')),
+                )
+                table_html = table.get_attribute('innerHTML')
+                browser.switch_to_default_content()
+            self.extract_table_from_html(table_html)
+            if self.cached_table is not None:
+                self.table = merge_monthly_tables(
+                    self.cached_table, self.get_table(), self.start_date,
+                )
+                self.table_version += 1
+
+        with browser.timed('save', self.report_name):
+            self.save_csv()
 
     def extract_table_from_html(self, table_html):
         soup = BeautifulSoup(table_html, 'html.parser')
@@ -230,47 +343,105 @@ class Report(object):
         # open spreadsheet and read all content as a list of lists
         return gdrive.open_by_url(key['url'])
 
-    def open_google_worksheet(self):
-        google_workbook = self.open_google_workbook()
+    def open_google_worksheet(self, google_workbook=None):
+        """open the worksheet of this report in `google_workbook`, which is
+        opened with `open_google_workbook` if it is not specified
+        """
+        google_workbook = google_workbook or self.open_google_workbook()
         return google_workbook.worksheet(self.gsheet_tab_name)
 
-    def download_from_gdrive(self):
-        google_worksheet = self.open_google_worksheet()
+    def get_file_hash(self):
+        """get the sha1 hash of the locally cached report, or None if it has
+        not been cached yet
+        """
+        try:
+            with open(self.filename) as stream:
+                return hashlib.sha1(stream.read()).hexdigest()
+        except IOError:
+            return None
+
+    def download_from_gdrive(self, google_worksheet=None):
+        google_worksheet = google_worksheet or self.open_google_worksheet()
         csv_str = google_worksheet.export('csv')
         with open(self.filename, 'w') as output:
             output.write(csv_str)
         print self.filename
 
-    def upload_to_gdrive(self):
-        # parse the resulting data from xls and upload it to a google
-        # spreadsheet
+    def upload_to_gdrive(self, google_worksheet=None):
+        """upload the table to the worksheet of this report. The worksheet is
+        read in bulk and only the cells that differ from the table are sent,
+        in a single batch, so that uploading a report where only the newest
+        month changed only sends that month. The worksheet is only resized
+        when the table does not fit.
+        """
         self.load_table()
-        max_cell = self.get_max_cell()
-        excel_dimensions = 'A1:%s' % max_cell.excel_coords
-
-        # clear the google doc contents
-        google_worksheet = self.open_google_worksheet()
-        not_empty_cells = google_worksheet.findall(re.compile(r'[a-zA-Z0-9]+'))
-        for cell in not_empty_cells:
-            cell.value = ''
-        google_worksheet.update_cells(not_empty_cells)
+        table = self.get_table()
+        google_worksheet = google_worksheet or self.open_google_worksheet()
+        google_values = google_worksheet.get_all_values()
+
+        # find the cells that differ from the worksheet, including cells in
+        # the worksheet that are no longer in the table. cells are numbered
+        # from 1 like in the worksheet
+        n_rows = max(table.shape[0], len(google_values))
+        n_cols = max([table.shape[1]] + [len(row) for row in google_values])
+        changes = {}
+        for row in range(n_rows):
+            for col in range(n_cols):
+                value = ''
+                if row < table.shape[0] and col < table.shape[1] and \
+                        table.present[row, col]:
+                    value = table.values[row, col]
+                google_value = ''
+                if row < len(google_values) and col < len(google_values[row]):
+                    google_value = google_values[row][col]
+                if not _is_same_value(value, google_value):
+                    changes[row + 1, col + 1] = value
+        if not changes:
+            return
 
         # add columns and rows as necessary
-        if google_worksheet.col_count <= max_cell.col + 1:
-            n_cols = max_cell.col + 1 - google_worksheet.col_count
-            google_worksheet.add_cols(n_cols)
-        if google_worksheet.row_count <= max_cell.row + 1:
-            n_rows = max_cell.row + 1 - google_worksheet.row_count
-            google_worksheet.add_rows(n_rows)
-
-        # upload the contents
-        google_cell_list = google_worksheet.range(excel_dimensions)
-        for google_cell, cell in zip(google_cell_list, self.cells):
-            google_cell.value = cell.value
-        google_worksheet.update_cells(google_cell_list)
+        max_row = max(row for row, col in changes)
+        max_col = max(col for row, col in changes)
+        if google_worksheet.row_count < max_row or \
+                google_worksheet.col_count < max_col:
+            google_worksheet.resize(
+                rows=max(google_worksheet.row_count, max_row),
+                cols=max(google_worksheet.col_count, max_col),
+            )
+
+        # the worksheet was already read in bulk, so the changed cells are
+        # created locally and uploaded in a single batch
+        google_worksheet.update_cells([
+            _new_google_cell(google_worksheet, row, col, value)
+            for (row, col), value in sorted(changes.iteritems())
+        ])
+
+    @property
+    def cells(self):
+        """all of the cells in the table, sorted by row and col"""
+        return list(self.get_table().iter_cells())
+
+    def get_table(self):
+        """get the `Table` with all of the cells, including any cells that were
+        added with `add_cell` since the table was last built
+        """
+        if self._new_cells:
+            cells = list(self.table.iter_cells()) + self._new_cells
+            self.table = Table.from_cells(cells)
+            self._new_cells = []
+            self.table_version += 1
+        return self.table
+
+    def get_derived_version(self):
+        """version of the loaded table, which changes whenever the table is
+        (re)loaded, for memoizing values that are derived from it (see
+        `decorators.derived`)
+        """
+        self.load_table()
+        return self.table_version
 
     def add_cell(self, *args):
-        self.cells.append(Cell(*args))
+        self._new_cells.append(Cell(*args))
 
     def load_table(self):
         """load the thing into memory in our own format to avoid b.s. with xls
@@ -278,68 +449,60 @@ class Report(object):
         """
         # save I/O time by exiting if this has already been called. otherwise
         # load in the table
-        if self.cells:
+        if self.get_table():
             return
         with open(self.filename) as stream:
-            reader = csv.reader(stream)
-            for row, values in enumerate(reader):
-                for col, value in enumerate(values):
-                    self.add_cell(row, col, value)
-        self.cells.sort(key=operator.attrgetter('row', 'col'))
+            content = stream.read()
+
+        # the parsed table is kept in a binary snapshot next to the csv. the
+        # snapshot is only used if it was made from exactly this csv content
+        self.content_hash = hashlib.sha1(content).hexdigest()
+        self.table = Table.load(self.snapshot_filename, self.content_hash)
+        if self.table is None:
+            reader = csv.reader(cStringIO.StringIO(content))
+            self.table = Table.from_rows(list(reader))
+            self.table.save(self.snapshot_filename, self.content_hash)
+        self.table_version += 1
 
     def get_max_cell(self):
-        max_cell = Cell(0, 0, None)
-        for cell in self.cells:
-            if cell.row >= max_cell.row:
-                max_cell.row = cell.row
-            if cell.col >= max_cell.col:
-                max_cell.col = cell.col
-        return max_cell
+        return self.get_table().get_max_cell()
 
     def _resolve_min_max(self, min_coord, max_coord):
         return min_coord or 0, max_coord or sys.maxint
 
     def iter_rows(self, min_row=None, max_row=None):
         min_row, max_row = self._resolve_min_max(min_row, max_row)
-        self.cells.sort(key=operator.attrgetter('row', 'col'))
-        rowgetter = operator.attrgetter('row')
-        for row, cells in itertools.groupby(self.cells, rowgetter):
-            if min_row <= row <= max_row:
-                yield list(cells)
+        return self.get_table().iter_rows(min_row, max_row)
 
     def _get_row_index(self, row_name, col=0):
         """Get the row index for a row named `row_name` in `col`"""
         if not isinstance(row_name, (str, unicode)):
             raise TypeError('please provide the row_name')
-        for cell in self.iter_cells_in_col(col):
-            if cell.value == row_name:
-                return cell.row
-        raise exceptions.RowNotFound(row_name)
+        row = self.get_table().get_row_index(row_name, col)
+        if row is None:
+            raise exceptions.RowNotFound(row_name)
+        return row
 
     def _get_col_index(self, col_name, row=0):
         """Get the col index for a col named `col_name` in `row`"""
         if not isinstance(col_name, (str, unicode)):
             raise TypeError('please provide the col_name')
-        for cell in self.iter_cells_in_row(row):
-            if cell.value == col_name:
-                return cell.col
-        raise exceptions.ColNotFound(col_name)
+        col = self.get_table().get_col_index(col_name, row)
+        if col is None:
+            raise exceptions.ColNotFound(col_name)
+        return col
 
     def iter_cells_in_row(self, row, min_col=None, max_col=None):
         if isinstance(row, (str, unicode)):
             row = self._get_row_index(row)
         min_col, max_col = self._resolve_min_max(min_col, max_col)
-        for cell in self.cells:
-            if cell.row == row and (min_col <= cell.col <= max_col):
-                yield cell
+        return self.get_table().iter_cells_in_row(row, min_col, max_col)
 
     def iter_cells_in_col(self, col, min_row=None, max_row=None):
         if isinstance(col, (str, unicode)):
             col = self._get_col_index(col)
         min_row, max_row = self._resolve_min_max(min_row, max_row)
-        for cell in self.cells:
-            if cell.col == col and (min_row <= cell.row <= max_row):
-                yield cell
+        return self.get_table().iter_cells_in_col(col, min_row, max_row)
 
     def get_historical_values(self, row_name, min_col=1, max_col=None):
         """get all of the historical values from row that starts with
@@ -359,15 +522,28 @@ class Report(object):
             ))
         return historical_values
 
+    def get_historical_series(self, row_names, min_col=1, max_col=None):
+        """get the dates from `min_col` to `max_col` along with an array of the
+        sum of the historical values in all of the rows named `row_names` on
+        each of those dates. this is the same as adding up the
+        `get_historical_values` of every row, but is done as a single sum over
+        the rows of the table.
+        """
+        self.load_table()
+        table = self.get_table()
+        max_col = max_col or self.get_max_cell().col
+        date_cells = list(self.iter_cells_in_row(1, min_col, max_col))
+        dates = [self.get_date_from_cell(cell) for cell in date_cells]
+        rows = [self._get_row_index(row_name) for row_name in row_names]
+        cols = [cell.col for cell in date_cells]
+        values = numpy.nansum(table.numeric[numpy.ix_(rows, cols)], axis=0)
+        return dates, values
+
     def get_date_from_cell(self, date_cell):
         if isinstance(date_cell.value, datetime.datetime):
-            date = date_cell.value
-        else:
-            try:
-                date = datetime.datetime.strptime(date_cell.value, '%b %Y')
-            except ValueError:
-                date = utils.qbo_date(date_cell.value)
-        return utils.end_of_month(date)
+            return utils.end_of_month(date_cell.value)
+        date = self.get_table().get_date(date_cell.row, date_cell.col)
+        return date or decode_date(date_cell.value)
 
     def get_now(self):
         return self.end_date
@@ -0,0 +1,58 @@
+import os
+import json
+import tempfile
+
+from .. import utils
+
+
+class SyncManifest(object):
+    """The sync manifest keeps track of the reports that were synced with
+    gdrive so that unchanged reports are not synced again. For every report
+    that was downloaded from or uploaded to gdrive, it records the content
+    hash of the local csv and the revision of the worksheet (the time it was
+    last updated) right after the sync. The manifest is kept in DATA_ROOT.
+    """
+
+    DIRECTIONS = ('download', 'upload')
+
+    def __init__(self):
+        self.filename = os.path.join(utils.DATA_ROOT, 'sync_manifest.json')
+        try:
+            with open(self.filename) as stream:
+                self.entries = json.load(stream)
+        except (IOError, ValueError):
+            self.entries = {}
+        for direction in self.DIRECTIONS:
+            self.entries.setdefault(direction, {})
+
+    def is_unchanged(self, direction, report, revision):
+        """whether neither the local csv of `report` nor its worksheet (with
+        `revision`) have changed since it was last synced in `direction`
+        """
+        content_hash = report.get_file_hash()
+        return content_hash is not None and \
+            self.entries[direction].get(report.report_name) == {
+                'content_hash': content_hash,
+                'revision': revision,
+            }
+
+    def update(self, direction, report, revision):
+        """record that `report` was synced in `direction` and that its
+        worksheet is now at `revision`
+        """
+        self.entries[direction][report.report_name] = {
+            'content_hash': report.get_file_hash(),
+            'revision': revision,
+        }
+        self.save()
+
+    def save(self):
+        """save the manifest. it is written to a temporary file first so that
+        it is never partially written
+        """
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename), suffix='.tmp',
+        )
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(self.entries, stream, indent=2, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
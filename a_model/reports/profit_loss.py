@@ -1,4 +1,7 @@
+import numpy
+
 from .base import Report
+from .. import decorators
 
 
 class ProfitLoss(Report):
@@ -6,6 +9,42 @@ class ProfitLoss(Report):
     gsheet_tab_name = 'P&L'
     download_method = 'quickbooks'
     upload_method = 'gdrive'
+    incremental = True
+
+    # rows of the report that are added up for the historical series
+    REVENUE_ROWS = (
+        'Gross Profit',
+        'Total Other Income',
+    )
+    EXPENSE_ROWS = (
+        'Total Expenses',
+        'Total Other Expenses',
+    )
+    EXCLUDED_EXPENSE_ROWS = (
+        'Outside Services',
+    )
+    OFFICE_COST_ROWS = (
+        'Rent Expense',
+        'Total Utilities',  # jacked by cloud computing resources
+        'Internet',
+    )
+    OTHER_FIXED_COST_ROWS = (
+        'Marketing',
+        'Public Relations',
+        'Bookkeeping',
+        'Accounting',
+        'Registered Agent',
+    )
+    SALARY_ROWS = (
+        'Total Payroll Expenses',
+        'Total Guaranteed Payments',
+    )
+    BENEFITS_ROWS = (
+        'Health Insurance',
+        '401(k) Profit Sharing Contribution',
+        '401(k) Safe Harbor Contribution',
+        '401(k) Safe Harbor Contribution - Partners',
+    )
 
     def get_historical_values(self, row_name):
         return super(ProfitLoss, self).get_historical_values(
@@ -13,6 +52,14 @@ class ProfitLoss(Report):
             max_col=self.get_max_cell().col-1,
         )
 
+    @decorators.derived
+    def get_historical_series(self, row_names):
+        self.load_table()
+        return super(ProfitLoss, self).get_historical_series(
+            row_names,
+            max_col=self.get_max_cell().col-1,
+        )
+
     def combine_historical_values_pair(self, result, another_result):
         assert len(result) == len(another_result)
         for i, (date, value) in enumerate(another_result):
@@ -21,44 +68,27 @@ class ProfitLoss(Report):
         return result
 
     def combine_historical_values(self, *row_names):
-        self.load_table()
-        result = self.get_historical_values(row_names[0])
-        result = map(list, result)
-        for row_name in row_names[1:]:
-            result = self.combine_historical_values_pair(
-                result,
-                self.get_historical_values(row_name),
-            )
-        return result
+        dates, values = self.get_historical_series(row_names)
+        return map(list, zip(dates, values.tolist()))
 
+    @decorators.derived
     def get_historical_revenues(self):
-        return self.combine_historical_values(
-            'Gross Profit',
-            'Total Other Income',
-        )
-
-    def get_historical_costs(self):
+        return self.combine_historical_values(*self.REVENUE_ROWS)
 
-        expenses = self.combine_historical_values(
-            'Total Expenses',
-            'Total Other Expenses',
+    @decorators.derived
+    def get_historical_costs_series(self):
+        dates, expenses = self.get_historical_series(self.EXPENSE_ROWS)
+        _, expenses_to_exclude = self.get_historical_series(
+            self.EXCLUDED_EXPENSE_ROWS,
         )
+        return dates, expenses - expenses_to_exclude
 
-        expenses_to_exclude = self.combine_historical_values(
-            'Outside Services',
-        )
-
-        assert len(expenses) == len(expenses_to_exclude)
-
-        adjusted_expenses = []
-
-        for i, (date,cost) in enumerate(expenses):
-            assert expenses_to_exclude[i][0] == date
-            adjusted_expense =  expenses[i][1] - expenses_to_exclude[i][1]
-            adjusted_expenses.append((date,adjusted_expense))
-
-        return adjusted_expenses
+    @decorators.derived
+    def get_historical_costs(self):
+        dates, costs = self.get_historical_costs_series()
+        return zip(dates, costs.tolist())
 
+    @decorators.derived
     def get_historical_retirement_costs(self):
 
         kk = self.get_historical_values('401(k) Profit Sharing Contribution')
@@ -89,65 +119,50 @@ class ProfitLoss(Report):
             ('column', 'monthly'),
         ) + self.get_date_range_customized_params()
 
-    def _get_ytd_value(self, historical_values, year=None):
+    def _get_ytd_mask(self, dates, year=None):
         now = self.get_now()
-        ytd_value = 0.0
         year = year or now.year
-        for date, value in reversed(historical_values):
-            if date.year == year and date.month <= now.month:
-                ytd_value += value
-        return ytd_value
+        return numpy.array([
+            date.year == year and date.month <= now.month for date in dates
+        ], dtype=bool)
+
+    def _get_ytd_value(self, historical_values, year=None):
+        if not historical_values:
+            return 0.0
+        dates, values = zip(*historical_values)
+        mask = self._get_ytd_mask(dates, year=year)
+        return float(numpy.array(values)[mask].sum())
 
     def get_ytd_revenue(self, year=None):
-        historical_revenues = self.get_historical_revenues()
-        return self._get_ytd_value(historical_revenues, year=year)
+        dates, revenues = self.get_historical_series(self.REVENUE_ROWS)
+        return float(revenues[self._get_ytd_mask(dates, year=year)].sum())
 
     def get_ytd_cost(self, year=None):
-        historical_costs = self.get_historical_costs()
-        return self._get_ytd_value(historical_costs, year=year)
+        dates, costs = self.get_historical_costs_series()
+        return float(costs[self._get_ytd_mask(dates, year=year)].sum())
 
     def get_ytd_margin(self, year=None):
         return self.get_ytd_revenue(year=year) - self.get_ytd_cost(year=year)
 
+    @decorators.derived
     def get_historical_office_costs(self):
-        return self.combine_historical_values(
-            'Rent Expense',
-            'Total Utilities',  # jacked by cloud computing resources
-            'Internet',
-        )
+        return self.combine_historical_values(*self.OFFICE_COST_ROWS)
 
+    @decorators.derived
     def get_historical_fixed_costs(self):
-        historical_other_fixed_costs = self.combine_historical_values(
-            'Marketing',
-            'Public Relations',
-            'Bookkeeping',
-            'Accounting',
-            'Registered Agent',
-        )
-        historical_office_costs = self.get_historical_office_costs()
-        return self.combine_historical_values_pair(
-            historical_other_fixed_costs,
-            historical_office_costs,
+        return self.combine_historical_values(
+            *(self.OTHER_FIXED_COST_ROWS + self.OFFICE_COST_ROWS)
         )
 
+    @decorators.derived
     def get_historical_personnel_costs(self):
-        salary = self.combine_historical_values(
-            'Total Payroll Expenses',
-            'Total Guaranteed Payments',
-        )
-        benefits = self.combine_historical_values(
-            'Health Insurance',
-            '401(k) Profit Sharing Contribution',
-            '401(k) Safe Harbor Contribution',
-            '401(k) Safe Harbor Contribution - Partners',
+        return self.combine_historical_values(
+            *(self.SALARY_ROWS + self.BENEFITS_ROWS)
         )
 
-
-        return self.combine_historical_values_pair(salary, benefits)
-
+    @decorators.derived
     def get_average_fixed_cost(self):
-        total, n = 0.0, 0
-        for date, amount in self.get_historical_fixed_costs():
-            total += amount
-            n += 1
-        return total / n
+        _, fixed_costs = self.get_historical_series(
+            self.OTHER_FIXED_COST_ROWS + self.OFFICE_COST_ROWS,
+        )
+        return float(fixed_costs.mean())
@@ -0,0 +1,125 @@
+import sys
+import collections
+import time
+import threading
+import Queue
+import urlparse
+
+# strptime imports _strptime the first time it is called, which is not thread
+# safe and fails in the sessions unless it was already imported
+# http://bugs.python.org/issue7980
+import _strptime  # noqa
+
+from . import base
+
+
+class DownloadScheduler(object):
+    """Download quickbooks reports concurrently with a bounded pool of
+    `n_sessions` headless browser sessions. Each session logs in once and then
+    downloads reports from a shared queue until it is empty. At most
+    `max_per_host` sessions load pages from the same host at a time so that
+    quickbooks is not overwhelmed.
+
+    `root_url` is where the sessions log in and download reports from, which
+    can be a local stand-in HTTP server that serves canned report pages for
+    testing. `browser_cls` creates the sessions and is called with the
+    `root_url` and `headless` keyword arguments (see `base.Browser`). The
+    `standin` module has both, which bin/check_download_scheduler.py uses to
+    check the scheduler without quickbooks.
+
+    The time that every session spends on each step (login, navigate,
+    extract and save) is collected in `timings` for the timing report (see
+    `get_timing_report`).
+    """
+
+    def __init__(self, username, password, n_sessions=2, max_per_host=2,
+                 root_url=base.QUICKBOOKS_ROOT_URL, headless=True,
+                 browser_cls=base.Browser):
+        self.username = username
+        self.password = password
+        self.n_sessions = n_sessions
+        self.max_per_host = max_per_host
+        self.root_url = root_url
+        self.headless = headless
+        self.browser_cls = browser_cls
+        self.timings = []
+        self.elapsed = None
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+
+    def get_host_semaphore(self, url):
+        """get the semaphore that limits the number of sessions that load
+        pages from the host of `url` at a time
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+            return self._host_semaphores[host]
+
+    def download(self, reports):
+        """download all of the `reports` from quickbooks and save them
+        locally. If any of the sessions fail, the first error is raised once
+        the other sessions have downloaded the rest of the reports.
+        """
+        t0 = time.time()
+        queue = Queue.Queue()
+        for report in reports:
+            queue.put(report)
+        errors = []
+        threads = [
+            threading.Thread(target=self._run_session, args=(queue, errors))
+            for session in range(min(self.n_sessions, len(reports)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - t0
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _run_session(self, queue, errors):
+        try:
+            browser = self.browser_cls(
+                root_url=self.root_url, headless=self.headless,
+            )
+            with browser:
+                try:
+                    self._download_in_session(browser, queue)
+                finally:
+                    with self._lock:
+                        self.timings.extend(browser.timings)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    def _download_in_session(self, browser, queue):
+        with self.get_host_semaphore(self.root_url):
+            browser.login_quickbooks(self.username, self.password)
+        while True:
+            try:
+                report = queue.get_nowait()
+            except Queue.Empty:
+                return
+            url = report.get_url(self.root_url)
+            with self.get_host_semaphore(url):
+                report.download_from_quickbooks(browser)
+
+    def get_timing_report(self):
+        """get a table with the number of seconds that every step took for
+        each report, the total of each step across all sessions and the
+        elapsed time of the whole download
+        """
+        lines = ['%-10s %-20s %8s' % ('step', 'report', 'seconds')]
+        totals = collections.OrderedDict()
+        for step, name, seconds in self.timings:
+            lines.append('%-10s %-20s %8.2f' % (step, name, seconds))
+            totals[step] = totals.get(step, 0.0) + seconds
+        for step, seconds in totals.iteritems():
+            lines.append('%-10s %-20s %8.2f' % (step, '(total)', seconds))
+        if self.elapsed is not None:
+            lines.append('%-10s %-20s %8.2f' % ('', '(elapsed)', self.elapsed))
+        return '\n'.join(lines)
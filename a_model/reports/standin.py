@@ -0,0 +1,241 @@
+"""A local stand-in for quickbooks online that serves canned report pages, and
+a browser that downloads from it without firefox, for checking the
+`DownloadScheduler` (see bin/check_download_scheduler.py).
+"""
+
+import cgi
+import contextlib
+import cookielib
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+import BaseHTTPServer
+import SocketServer
+
+from bs4 import BeautifulSoup
+from selenium.common.exceptions import NoSuchElementException, \
+    TimeoutException
+from selenium.webdriver.common.by import By
+
+LOGIN_PAGE = '''<html><body><form method="post">
+<input name="Email"><input name="Password" type="password">
+<button name="SignIn">Sign In</button>
+</form></body></html>'''
+
+
+def get_canned_page(rows):
+    """get a canned report page with a table of `rows` of values, like the
+    modern quickbooks reports
+    """
+    trs = []
+    for row in rows:
+        tds = ''.join('<td>%s</td>' % cgi.escape(str(v)) for v in row)
+        trs.append('<tr>%s</tr>' % tds)
+    return '<html><body><table>%s</table></body></html>' % ''.join(trs)
+
+
+class CannedReportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse.urlparse(self.path).path
+        if path == '/':
+            return self.respond(200, LOGIN_PAGE)
+        if not server.is_logged_in(self.headers.get('Cookie', '')):
+            return self.respond(403, 'please log in')
+        with server.track_request(self.headers.get('Host')):
+            if self.path in server.failing_paths:
+                return self.respond(500, 'canned failure')
+            if self.path not in server.pages:
+                return self.respond(404, 'no canned page for %s' % self.path)
+            self.respond(200, server.pages[self.path])
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        credentials = form.get('Email', [''])[0], form.get('Password', [''])[0]
+        if credentials != (self.server.username, self.server.password):
+            return self.respond(403, 'wrong username or password')
+        session = self.server.add_session()
+        self.respond(200, '<html><body>signed in</body></html>', headers={
+            'Set-Cookie': 'session=%s; Path=/' % session,
+        })
+
+    def respond(self, status, content, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class CannedReportServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """A local HTTP server that stands in for quickbooks online. It serves a
+    login page at / and the canned `pages` (keyed by the path and query of the
+    report urls, see `Report.get_url`) to sessions that logged in with
+    `username` and `password`. Every report page takes `delay` seconds to load
+    and pages in `failing_paths` fail with a server error.
+
+    The server keeps track of the number of `logins` and the maximum number
+    of report pages that were loading from the same host at once
+    (`max_concurrent`). Use it as a context manager to serve pages in a
+    background thread at `root_url`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pages, username='username', password='password',
+                 delay=0.2, failing_paths=()):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), CannedReportHandler,
+        )
+        self.pages = dict(pages)
+        self.username = username
+        self.password = password
+        self.delay = delay
+        self.failing_paths = set(failing_paths)
+        self.logins = 0
+        self.max_concurrent = 0
+        self._sessions = set()
+        self._concurrent = {}
+        self._lock = threading.Lock()
+
+    @property
+    def root_url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def add_session(self):
+        session = uuid.uuid4().hex
+        with self._lock:
+            self._sessions.add(session)
+            self.logins += 1
+        return session
+
+    def is_logged_in(self, cookie):
+        for item in cookie.split(';'):
+            key, _, value = item.strip().partition('=')
+            if key == 'session' and value in self._sessions:
+                return True
+        return False
+
+    @contextlib.contextmanager
+    def track_request(self, host):
+        with self._lock:
+            self._concurrent[host] = self._concurrent.get(host, 0) + 1
+            self.max_concurrent = max(
+                self.max_concurrent, self._concurrent[host],
+            )
+        try:
+            time.sleep(self.delay)
+            yield
+        finally:
+            with self._lock:
+                self._concurrent[host] -= 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInElement(object):
+    """the part of a selenium `WebElement` that reports use"""
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def get_attribute(self, name):
+        if name == 'innerHTML':
+            return ''.join(unicode(child) for child in self.tag.contents)
+        return self.tag.get(name)
+
+
+class StandInBrowser(object):
+    """A browser session for the `CannedReportServer` that can be used as the
+    `browser_cls` of a `DownloadScheduler`. It has the same methods as
+    `base.Browser` that the scheduler and the reports use, but loads pages
+    with urllib2 instead of firefox. Pages are static, so conditions are
+    checked once instead of polled.
+    """
+
+    def __init__(self, root_url, headless=True):
+        self.root_url = root_url
+        self.timings = []
+        self._opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
+        )
+        self._soup = BeautifulSoup('', 'html.parser')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def get(self, url, data=None):
+        """load `url`. server errors are raised as `urllib2.HTTPError`s"""
+        stream = self._opener.open(url, data)
+        try:
+            self._soup = BeautifulSoup(stream.read(), 'html.parser')
+        finally:
+            stream.close()
+
+    def wait_until(self, condition, timeout=None):
+        value = condition(self)
+        if not value:
+            raise TimeoutException('condition is not met by %s' % condition)
+        return value
+
+    @contextlib.contextmanager
+    def timed(self, step, name=''):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.timings.append((step, name, time.time() - t0))
+
+    def find_elements(self, by, value):
+        if by == By.ID:
+            tags = self._soup.find_all(id=value)
+        elif by == By.NAME:
+            tags = self._soup.find_all(attrs={'name': value})
+        elif by == By.TAG_NAME:
+            tags = self._soup.find_all(value)
+        else:
+            raise ValueError('can not find elements by %s' % by)
+        return [StandInElement(tag) for tag in tags]
+
+    def find_element(self, by, value):
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise NoSuchElementException('no element with %s %s' % (by, value))
+        return elements[0]
+
+    def find_elements_by_id(self, value):
+        return self.find_elements(By.ID, value)
+
+    def find_elements_by_tag_name(self, value):
+        return self.find_elements(By.TAG_NAME, value)
+
+    def login_quickbooks(self, username, password):
+        with self.timed('login'):
+            self.get(self.root_url)
+            self.find_element(By.NAME, 'Email')
+            self.get(self.root_url, urllib.urlencode({
+                'Email': username,
+                'Password': password,
+            }))
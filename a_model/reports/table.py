@@ -0,0 +1,381 @@
+import datetime
+import collections
+import os
+import tempfile
+import warnings
+
+import numpy
+
+from .. import utils
+
+
+def parse_value(value):
+    """cast report values like '$1,234.56' as floats and leave everything else
+    as is
+    """
+    try:
+        return float(value.replace('$', '').replace(',', ''))
+    except:
+        return value
+
+
+def decode_date(value):
+    """decode report dates like 'Jan 2016' or '01/15/2016' as the end of that
+    month
+    """
+    try:
+        date = datetime.datetime.strptime(value, '%b %Y')
+    except ValueError:
+        date = utils.qbo_date(value)
+    return utils.end_of_month(date)
+
+
+class Cell(object):
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = parse_value(value)
+
+    @classmethod
+    def from_parsed(cls, row, col, value):
+        """create a cell from a `value` that has already been parsed"""
+        cell = cls.__new__(cls)
+        cell.row = row
+        cell.col = col
+        cell.value = value
+        return cell
+
+    @property
+    def colchr(self):
+        # TODO: if we ever get past 26*26 columsn, this won't work
+        c = ''
+        tens = self.col / 26
+        zero = ord('A')
+        # it goes A AA AB, AC, ... BA BB BC ...
+        if tens > 0:
+            c += chr(tens + zero - 1)
+        c += chr(self.col - tens * 26 + zero)
+        return c
+
+    @property
+    def excel_coords(self):
+        return "%s%s" % (self.colchr, self.row + 1)
+
+    def __repr__(self):
+        return '<Cell %s: %s>' % (self.excel_coords, self.value)
+
+
+class Table(object):
+    """A grid of parsed cell values with known dimensions. `values` is a 2-D
+    object array with the value of every cell, `present` flags the cells that
+    actually exist (rows in a csv can have different lengths), `numeric` has
+    the float value of every numeric cell (and NaN elsewhere) and
+    `date_ordinals` has the decoded dates (see `decode_date`). Cells in a
+    row or column are accessed by slicing instead of scanning every cell, and
+    `Cell` objects are only created as a view when iterating.
+    """
+
+    def __init__(self, values, present, numeric=None, date_ordinals=None):
+        self.values = values
+        self.present = present
+        self._n_cells = int(present.sum())
+
+        # numeric values and decoded dates (as ordinals, 0 for cells that
+        # are not dates) are computed here unless they come from a snapshot
+        if numeric is None or date_ordinals is None:
+            numeric = numpy.full(values.shape, numpy.nan)
+            date_ordinals = numpy.zeros(values.shape, dtype=int)
+            for (row, col), value in numpy.ndenumerate(values):
+                if not present[row, col]:
+                    continue
+                if isinstance(value, float):
+                    numeric[row, col] = value
+                elif isinstance(value, (str, unicode)):
+                    try:
+                        date = decode_date(value)
+                    except ValueError:
+                        continue
+                    date_ordinals[row, col] = date.toordinal()
+        self.numeric = numeric
+        self.is_numeric = ~numpy.isnan(numeric)
+        self.date_ordinals = date_ordinals
+
+        # name -> index lookups for the rows (keyed by the column with the
+        # names) and the columns (keyed by the row with the names), which are
+        # built the first time a name is looked up
+        self._row_indexes = {}
+        self._col_indexes = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """create a table from rows of raw values, like the rows of a csv"""
+        n_rows = len(rows)
+        n_cols = max([len(row) for row in rows] or [0])
+        values = numpy.empty((n_rows, n_cols), dtype=object)
+        present = numpy.zeros((n_rows, n_cols), dtype=bool)
+        for row, raw_values in enumerate(rows):
+            for col, raw_value in enumerate(raw_values):
+                values[row, col] = parse_value(raw_value)
+            present[row, :len(raw_values)] = True
+        return cls(values, present)
+
+    @classmethod
+    def from_cells(cls, cells):
+        """create a table from `Cell` objects"""
+        n_rows = max([cell.row for cell in cells] or [-1]) + 1
+        n_cols = max([cell.col for cell in cells] or [-1]) + 1
+        values = numpy.empty((n_rows, n_cols), dtype=object)
+        present = numpy.zeros((n_rows, n_cols), dtype=bool)
+        for cell in cells:
+            values[cell.row, cell.col] = cell.value
+            present[cell.row, cell.col] = True
+        return cls(values, present)
+
+    @classmethod
+    def load(cls, filename, content_hash):
+        """load a snapshot that was saved with `save`, or return None if there
+        is no snapshot of the data with `content_hash`
+        """
+        try:
+            with open(filename, 'rb') as stream:
+                snapshot = numpy.load(stream, allow_pickle=True)
+                if str(snapshot['content_hash']) != content_hash:
+                    return None
+                return cls(
+                    snapshot['values'],
+                    snapshot['present'],
+                    snapshot['numeric'],
+                    snapshot['date_ordinals'],
+                )
+        except Exception:
+            # missing or unreadable snapshots are simply rebuilt
+            return None
+
+    def save(self, filename, content_hash):
+        """save a binary snapshot of the table for the data with
+        `content_hash`. the snapshot is written to a temporary file first so
+        that readers never see a partially written snapshot
+        """
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(filename), suffix='.tmp',
+        )
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                numpy.savez(
+                    stream,
+                    content_hash=numpy.array(content_hash),
+                    values=self.values,
+                    present=self.present,
+                    numeric=self.numeric,
+                    date_ordinals=self.date_ordinals,
+                )
+            os.rename(tmp_filename, filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        """number of cells in the table"""
+        return self._n_cells
+
+    def _cell(self, row, col):
+        row, col = int(row), int(col)
+        return Cell.from_parsed(row, col, self.values[row, col])
+
+    def get_max_cell(self):
+        max_cell = Cell.from_parsed(0, 0, None)
+        rows = numpy.flatnonzero(self.present.any(axis=1))
+        cols = numpy.flatnonzero(self.present.any(axis=0))
+        if len(rows):
+            max_cell.row = int(rows[-1])
+            max_cell.col = int(cols[-1])
+        return max_cell
+
+    def get_last_cell(self):
+        """get the last cell in the last row that has any cells"""
+        rows = numpy.flatnonzero(self.present.any(axis=1))
+        row = rows[-1]
+        col = numpy.flatnonzero(self.present[row])[-1]
+        return self._cell(row, col)
+
+    def get_date(self, row, col):
+        """get the decoded date in a cell or None if it is not a date"""
+        ordinal = self.date_ordinals[row, col]
+        if ordinal:
+            return datetime.date.fromordinal(ordinal)
+        return None
+
+    def _build_index(self, names):
+        """map `names`, an iterable of (name, index) pairs, to the first index
+        of each name and keep track of names that appear more than once
+        """
+        index, duplicates = {}, set()
+        for name, i in names:
+            if not isinstance(name, (str, unicode)):
+                continue
+            if name in index:
+                duplicates.add(name)
+            else:
+                index[name] = i
+        return index, duplicates
+
+    def _lookup(self, indexes, name):
+        index, duplicates = indexes
+        if name in duplicates:
+            warnings.warn('"%s" appears more than once; using the first one' %
+                          name)
+        return index.get(name)
+
+    def get_row_index(self, row_name, col=0):
+        """get the index of the first row named `row_name` in `col` or None if
+        there is no such row
+        """
+        if col not in self._row_indexes:
+            cells = self.iter_cells_in_col(col, 0, self.shape[0] - 1)
+            self._row_indexes[col] = self._build_index(
+                (cell.value, cell.row) for cell in cells
+            )
+        return self._lookup(self._row_indexes[col], row_name)
+
+    def get_col_index(self, col_name, row=0):
+        """get the index of the first col named `col_name` in `row` or None if
+        there is no such col
+        """
+        if row not in self._col_indexes:
+            cells = self.iter_cells_in_row(row, 0, self.shape[1] - 1)
+            self._col_indexes[row] = self._build_index(
+                (cell.value, cell.col) for cell in cells
+            )
+        return self._lookup(self._col_indexes[row], col_name)
+
+    def iter_cells_in_row(self, row, min_col, max_col):
+        n_rows, n_cols = self.shape
+        if not 0 <= row < n_rows:
+            return
+        max_col = min(max_col, n_cols - 1)
+        cols = numpy.flatnonzero(self.present[row, min_col:max_col+1])
+        for col in cols + min_col:
+            yield self._cell(row, col)
+
+    def iter_cells_in_col(self, col, min_row, max_row):
+        n_rows, n_cols = self.shape
+        if not 0 <= col < n_cols:
+            return
+        max_row = min(max_row, n_rows - 1)
+        rows = numpy.flatnonzero(self.present[min_row:max_row+1, col])
+        for row in rows + min_row:
+            yield self._cell(row, col)
+
+    def iter_rows(self, min_row, max_row):
+        """iterate over the cells in every row that has any cells"""
+        n_rows, n_cols = self.shape
+        for row in range(min_row, min(max_row, n_rows - 1) + 1):
+            cells = list(self.iter_cells_in_row(row, 0, n_cols - 1))
+            if cells:
+                yield cells
+
+    def iter_cells(self):
+        """iterate over all cells, sorted by row and col"""
+        for cells in self.iter_rows(0, self.shape[0] - 1):
+            for cell in cells:
+                yield cell
+
+
+# row of date-range reports (like the P&L) with the month of every column
+HEADER_ROW = 1
+
+
+def iter_month_cols(table):
+    """iterate over the (col, date) of every month in the `HEADER_ROW` of
+    `table`
+    """
+    for col in range(1, table.shape[1]):
+        if table.present[HEADER_ROW, col] and \
+                table.date_ordinals[HEADER_ROW, col]:
+            yield col, table.get_date(HEADER_ROW, col)
+
+
+def _iter_row_keys(table):
+    """iterate over the (row, key) of every row below the `HEADER_ROW`. rows
+    are keyed by their name and the number of rows before them with the same
+    name
+    """
+    counts = {}
+    for row in range(HEADER_ROW + 1, table.shape[0]):
+        name = table.values[row, 0] if table.present[row, 0] else ''
+        counts[name] = counts.get(name, -1) + 1
+        yield row, (name, counts[name])
+
+
+def merge_monthly_tables(cached, downloaded, start_date):
+    """merge the `downloaded` table of a date-range report with the months
+    from `start_date` onward into the `cached` table of the same report.
+    Months before `start_date` and the title row (the report name and date
+    range) come from `cached` and all other months come from `downloaded`.
+    Rows are matched by name and rows that only appear in one of the tables
+    are kept in order. Columns after the months that are not months
+    themselves (like the totals of the P&L) are recalculated as the sum of
+    every month.
+    """
+    start = start_date.toordinal()
+    cached_cols = [
+        col for col, date in iter_month_cols(cached)
+        if date.toordinal() < start
+    ]
+    downloaded_cols = [col for col, date in iter_month_cols(downloaded)]
+    summary_cols = [
+        col for col in range(max(downloaded_cols or [0]) + 1,
+                             downloaded.shape[1])
+        if downloaded.present[HEADER_ROW, col]
+    ]
+
+    # merge the rows in order, inserting rows that are only in the
+    # downloaded table after the row that they follow there
+    cached_rows = collections.OrderedDict(
+        (key, row) for row, key in _iter_row_keys(cached)
+    )
+    downloaded_rows = dict(
+        (key, row) for row, key in _iter_row_keys(downloaded)
+    )
+    keys = list(cached_rows)
+    position = 0
+    for row, key in _iter_row_keys(downloaded):
+        if key in cached_rows:
+            position = keys.index(key) + 1
+        else:
+            keys.insert(position, key)
+            position += 1
+
+    def get_values(table, row, cols):
+        return [
+            table.values[row, col] if row is not None and
+            col < table.shape[1] and table.present[row, col] else ''
+            for col in cols
+        ]
+
+    # the title row of the cached table describes the full history, whereas
+    # the downloaded one only covers the months from `start_date`
+    rows = [
+        get_values(cached, 0, range(cached.shape[1])),
+        get_values(cached, HEADER_ROW, [0] + cached_cols) +
+        get_values(downloaded, HEADER_ROW, downloaded_cols + summary_cols),
+    ]
+    for key in keys:
+        cached_row = cached_rows.get(key)
+        downloaded_row = downloaded_rows.get(key)
+        values = [key[0]]
+        values += get_values(cached, cached_row, cached_cols)
+        values += get_values(downloaded, downloaded_row, downloaded_cols)
+        numeric = [value for value in values[1:] if isinstance(value, float)]
+        values += [sum(numeric) if numeric else ''] * len(summary_cols)
+        rows.append(values)
+
+    # rows without any values do not have empty cells for every column
+    for values in rows:
+        while len(values) > 1 and values[-1] == '':
+            values.pop()
+    return Table.from_rows(rows)
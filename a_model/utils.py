@@ -41,6 +41,10 @@ def qbo_date(s):
     return datetime.datetime.strptime(s, QBO_DATE_FORMAT).date()
 
 
+def iso_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
 def end_of_last_month(today=None):
     today = today or datetime.date.today()
     first_of_month = datetime.date(today.year, today.month, 1)
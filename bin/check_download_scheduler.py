@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Check that the download scheduler downloads every quickbooks report, logs in
+once per session, respects the per-host concurrency limit and raises errors,
+using a local stand-in server with canned report pages instead of quickbooks.
+"""
+
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import urllib2
+import argparse
+
+from a_model import reports
+from a_model.reports.standin import CannedReportServer, StandInBrowser, \
+    get_canned_page
+
+# parse command line arguments
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument(
+    '--sessions',
+    metavar='N',
+    type=int,
+    help='the number of browser sessions that download reports',
+    default=3,
+)
+parser.add_argument(
+    '--delay',
+    metavar='T',
+    type=float,
+    help='the number of seconds that each canned report page takes to load',
+    default=0.2,
+)
+args = parser.parse_args()
+
+# the reports are saved in a temporary directory instead of DATA_ROOT so that
+# the locally cached reports are left alone
+data_root = tempfile.mkdtemp()
+quickbooks_reports = []
+pages, canned_rows = {}, {}
+for report_cls in sorted(reports.DOWNLOAD_QUICKBOOKS_REPORTS,
+                         key=lambda report_cls: report_cls.report_name):
+    report = report_cls()
+    report.filename = os.path.join(
+        data_root, os.path.basename(report.filename),
+    )
+    quickbooks_reports.append(report)
+    rows = [
+        [report.report_name],
+        ['', 'Jan 2016', 'Feb 2016'],
+        ['Total', '1234.56', '7.0'],
+    ]
+    pages[report.get_url('')] = get_canned_page(rows)
+    canned_rows[report.report_name] = rows
+
+
+def download(max_per_host, failing_paths=()):
+    """download all of the reports from a stand-in server and return the
+    server and the error of the download, if any
+    """
+    server = CannedReportServer(
+        pages, delay=args.delay, failing_paths=failing_paths,
+    )
+    with server:
+        scheduler = reports.DownloadScheduler(
+            server.username, server.password, n_sessions=args.sessions,
+            max_per_host=max_per_host, root_url=server.root_url,
+            browser_cls=StandInBrowser,
+        )
+        try:
+            scheduler.download(quickbooks_reports)
+        except urllib2.HTTPError as error:
+            return server, error
+    return server, None
+
+
+def read_rows(report):
+    if not os.path.exists(report.filename):
+        return None
+    with open(report.filename) as stream:
+        return list(csv.reader(stream))
+
+
+def remove_csvs():
+    for report in quickbooks_reports:
+        if os.path.exists(report.filename):
+            os.remove(report.filename)
+
+
+n_sessions = min(args.sessions, len(quickbooks_reports))
+checks = []
+try:
+    # every report is downloaded and no more than two sessions load pages
+    # from the stand-in server at the same time
+    server, error = download(max_per_host=2)
+    checks.append(('no errors', error is None))
+    checks.append((
+        'every report is saved', all(
+            read_rows(report) == canned_rows[report.report_name]
+            for report in quickbooks_reports
+        ),
+    ))
+    checks.append(('one login per session', server.logins == n_sessions))
+    checks.append((
+        'at most 2 pages at a time (saw %d)' % server.max_concurrent,
+        server.max_concurrent <= 2,
+    ))
+
+    # the per-host limit serializes the downloads
+    remove_csvs()
+    server, error = download(max_per_host=1)
+    checks.append((
+        'at most 1 page at a time (saw %d)' % server.max_concurrent,
+        server.max_concurrent == 1,
+    ))
+
+    # a failing report is raised once the other reports are downloaded
+    remove_csvs()
+    failing_report = quickbooks_reports[0]
+    server, error = download(
+        max_per_host=2, failing_paths=[failing_report.get_url('')],
+    )
+    checks.append((
+        'failing report is raised',
+        error is not None and error.code == 500,
+    ))
+    checks.append((
+        'other reports are still saved', all(
+            read_rows(report) == canned_rows[report.report_name]
+            for report in quickbooks_reports if report is not failing_report
+        ),
+    ))
+finally:
+    shutil.rmtree(data_root, ignore_errors=True)
+
+# report the checks
+for description, passed in checks:
+    print "%-45s %s" % (description, 'ok' if passed else 'FAILED')
+if not all(passed for description, passed in checks):
+    sys.exit(1)
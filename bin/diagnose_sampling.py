@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Measure how much the antithetic and Sobol sampling strategies reduce the
+variance of the outcome probabilities compared to pseudo-random sampling.
+"""
+
+from a_model.company import Company
+from a_model.argparsers import SamplingDiagnosticParser
+
+# parse command line arguments
+parser = SamplingDiagnosticParser(description=__doc__)
+args = parser.parse_args()
+
+# instantiate company
+company = Company(today=args.today)
+
+# simulate each sampling strategy several times. tolerances would make the
+# number of universes differ between strategies, so they are not used here
+kwargs = args.simulate_monthly_cash_kwargs()
+for key in ('sampling', 'tolerance', 'bonus_pool_tolerance', 'max_seconds'):
+    kwargs.pop(key)
+table = company.get_sampling_variance_reduction(
+    n_replications=args.n_replications, month=args.month, **kwargs
+)
+
+# report the variance reduction of every outcome
+print "%-12s %-22s %8s %8s %10s" % (
+    'sampling', 'outcome', 'mean', 'std', 'reduction',
+)
+for row in table:
+    reduction = row['variance_reduction']
+    print "%-12s %-22s %8.4f %8.4f %10s" % (
+        row['sampling'], row['outcome'], row['mean'], row['std'],
+        '-' if reduction is None else '%.2fx' % reduction,
+    )
@@ -12,6 +12,7 @@ import seaborn as sns
 import pandas as pd
 
 from a_model.company import Company
+from a_model.company.summaries import get_precision_str
 from a_model.argparsers import SimulationParser
 from a_model import utils
 
@@ -23,17 +24,17 @@ args = parser.parse_args()
 company = Company(today=args.today)
 
 # simulate cashflow for the rest of the year
-_, bonus_pool_outcomes, _ = company.simulate_monthly_cash(
+result = company.simulate_monthly_cash(
     **args.simulate_monthly_cash_kwargs()
 )
 
 # slice the data to get the eoy cash
 eoy = datetime.date(datetime.date.today().year, 12, 31)
 person_bonuses = []
-for bonus_pool in bonus_pool_outcomes:
-    for person in company.iter_people_and_partners(date=eoy):
-        bonus = bonus_pool * person.net_fraction_of_profits(eoy)
-        person_bonuses.append((person.name.split()[0].capitalize(), bonus))
+for person in company.iter_people_and_partners(date=eoy):
+    name = person.name.split()[0].capitalize()
+    bonuses = result.bonus_pool * person.net_fraction_of_profits(eoy)
+    person_bonuses.extend((name, bonus) for bonus in bonuses.tolist())
 
 # cast the data as a dataframe
 x, y = '', 'dividend + pre-tax bonus'
@@ -66,3 +67,4 @@ ax.yaxis.set_major_formatter(currency)
 filename = 'bonuses.png'
 plt.savefig(filename)
 print "results now available in", filename
+print "simulated", get_precision_str(result)
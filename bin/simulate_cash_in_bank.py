@@ -16,11 +16,12 @@ import matplotlib
 import matplotlib.patheffects as patheffects
 
 from a_model.company import Company
-from a_model.argparsers import SimulationParser
-from a_model.utils import iter_end_of_months, currency_str
+from a_model.company.summaries import get_precision_str
+from a_model.argparsers import CashInBankParser
+from a_model.utils import currency_str
 
 # parse command line arguments
-parser = SimulationParser(description=__doc__)
+parser = CashInBankParser(description=__doc__)
 args = parser.parse_args()
 
 # instantiate company
@@ -29,23 +30,9 @@ company = Company(today=args.today)
 # get past year's worth of cash in bank
 historical_cash_in_bank = company.balance_sheet.get_historical_cash_in_bank()
 
-# simulate cashflow for the rest of the year
-outcomes = company.simulate_monthly_cash(
-    **args.simulate_monthly_cash_kwargs()
-)
-monthly_cash_outcomes = outcomes[0]
-bonus_pool_outcomes = outcomes[1]
-quarterly_tax_outcomes = outcomes[2]
-
-# compute the outcomes of all the simulations at the end of this year. don't
-# plot the 'bye bye' one because it never happens and, even if it did, its
-# likelihood can always be inferred by adding the rest of them
+# the outcomes of all the simulations are reported at the end of this year
 eoy = datetime.date(args.today.year, 12, 31)
 months_until_eoy = company.profit_loss.get_months_from_now(eoy)
-outcomes = company.get_outcomes_in_month(
-    months_until_eoy, monthly_cash_outcomes,
-)
-outcomes.popitem()
 
 # transform the data in a convenient way for plotting
 historical_t, historical_cash = zip(*historical_cash_in_bank)
@@ -53,13 +40,66 @@ max_cash = max(historical_cash)
 monthly_t = [historical_t[-1]]
 monthly_t += [t for t in company.iter_future_months(args.n_months)]
 monthly_t.insert(months_until_eoy, eoy+datetime.timedelta(days=1))
-for monthly_cash, bp in zip(monthly_cash_outcomes, bonus_pool_outcomes):
-    monthly_cash.insert(0, historical_cash[-1])
-    monthly_cash.insert(months_until_eoy, monthly_cash[months_until_eoy] + bp)
-median_monthly_cash = []
-for month_of_cash in zip(*monthly_cash_outcomes):
-    median_monthly_cash.append(numpy.median(month_of_cash))
-    max_cash = max(max_cash, max(month_of_cash))
+
+# simulate cashflow for the rest of the year. when streaming, the universes are
+# only summarized by their percentiles to keep memory use constant
+if args.streaming:
+    summary = company.summarize_monthly_cash(
+        **args.simulate_monthly_cash_kwargs()
+    )
+    outcomes = summary.get_outcomes_in_month(months_until_eoy)
+
+    def monthly_cash_percentile(p):
+        monthly_cash = summary.get_monthly_cash_percentile(p)
+        monthly_cash.insert(0, historical_cash[-1])
+        monthly_cash.insert(
+            months_until_eoy, summary.cash_before_bonus.percentile(p),
+        )
+        return monthly_cash
+    median_monthly_cash = monthly_cash_percentile(50)
+    for sketch in summary.monthly_cash + [summary.cash_before_bonus]:
+        max_cash = max(max_cash, sketch.max)
+    bonus_pool_percentile = summary.bonus_pool.percentile
+    precision_str = get_precision_str(summary)
+    quarterly_tax_percentiles = [
+        (month, sketch.percentile)
+        for month, sketch in sorted(summary.quarterly_taxes.iteritems())
+    ]
+else:
+    result = company.simulate_monthly_cash(
+        **args.simulate_monthly_cash_kwargs()
+    )
+    outcomes = result.get_outcomes_in_month(months_until_eoy)
+
+    def monthly_cash_percentile(p):
+        monthly_cash = result.get_monthly_cash_percentile(p).tolist()
+        monthly_cash.insert(0, historical_cash[-1])
+        monthly_cash.insert(
+            months_until_eoy, result.get_cash_before_bonus_percentile(p),
+        )
+        return monthly_cash
+    median_monthly_cash = monthly_cash_percentile(50)
+
+    # every universe with the cash before the bonus is paid in December
+    monthly_cash_outcomes = numpy.insert(
+        result.monthly_cash, months_until_eoy - 1, result.cash_before_bonus,
+        axis=1,
+    )
+    monthly_cash_outcomes = numpy.insert(
+        monthly_cash_outcomes, 0, historical_cash[-1], axis=1,
+    )
+    max_cash = max(max_cash, monthly_cash_outcomes.max())
+    bonus_pool_percentile = result.get_bonus_pool_percentile
+    precision_str = get_precision_str(result)
+    quarterly_tax_percentiles = [
+        (month, lambda p, month=month:
+            result.get_quarterly_tax_percentile(month, p))
+        for month in result.TAX_MONTHS
+    ]
+
+# don't plot the 'bye bye' outcome because it never happens and, even if it
+# did, its likelihood can always be inferred by adding the rest of them
+outcomes.popitem()
 
 # set the domain of the graph
 t_domain = [
@@ -100,9 +140,17 @@ historical_params = {
 plt.plot(historical_t, historical_cash, **historical_params)
 
 # plot the simulations
-alpha = 0.3 / math.log(args.n_universes)
-for monthly_cash in monthly_cash_outcomes:
-    plt.plot(monthly_t, monthly_cash, color='w', alpha=alpha)
+if args.streaming:
+    plt.fill_between(
+        monthly_t,
+        monthly_cash_percentile(2.5),
+        monthly_cash_percentile(97.5),
+        facecolor='w', alpha=0.3, linewidth=0,
+    )
+else:
+    alpha = 0.3 / math.log(len(monthly_cash_outcomes))
+    for monthly_cash in monthly_cash_outcomes:
+        plt.plot(monthly_t, monthly_cash, color='w', alpha=alpha)
 
 # plot the median
 plt.plot(monthly_t, median_monthly_cash, linestyle='--', **historical_params)
@@ -122,15 +170,17 @@ plt.fill_between(
 # plot the buffer, buffer+bonus and goal bonus zones
 goal_dates, cash_buffers, cash_goals = [], [], []
 eoy_cash_buffer, eoy_cash_goal = None, None
-for date in iter_end_of_months(t_domain[0], t_domain[1]):
-    cash_buffer = company.get_cash_buffer(date)
+timeline = company.get_goal_timeline(
+    t_domain[0], t_domain[1], workers=args.workers,
+)
+for date, cash_buffer, cash_goal in zip(*timeline):
     if date.month == 1:
         goal_dates.append(datetime.date(date.year, date.month, 1))
         cash_buffers.append(cash_buffer)
         cash_goals.append(cash_buffer)
     goal_dates.append(date)
     cash_buffers.append(cash_buffer)
-    cash_goals.append(company.get_cash_goal(date))
+    cash_goals.append(cash_goal)
     if date == eoy:
         eoy_cash_buffer = cash_buffers[-1]
         eoy_cash_goal = cash_goals[-1]
@@ -195,12 +245,29 @@ plt.savefig(filename)
 print "results now available in", filename
 
 # report some helpful statistics
+print "simulated", precision_str
 print "2.5/50/97.5 percentile bonus pool size:", \
-    currency_str(numpy.percentile(bonus_pool_outcomes, 2.5)), \
-    currency_str(numpy.percentile(bonus_pool_outcomes, 50)), \
-    currency_str(numpy.percentile(bonus_pool_outcomes, 97.5))
-for month, values in sorted(quarterly_tax_outcomes.iteritems()):
+    currency_str(bonus_pool_percentile(2.5)), \
+    currency_str(bonus_pool_percentile(50)), \
+    currency_str(bonus_pool_percentile(97.5))
+for month, percentile in quarterly_tax_percentiles:
     print "2.5/50/97.5 percentile tax draw in month %d:" % month, \
-        currency_str(numpy.percentile(values, 2.5)), \
-        currency_str(numpy.percentile(values, 50)), \
-        currency_str(numpy.percentile(values, 97.5))
+        currency_str(percentile(2.5)), \
+        currency_str(percentile(50)), \
+        currency_str(percentile(97.5))
+
+# rare outcomes like 'dip into credit' and 'bye bye' hardly ever happen in the
+# simulated universes, so estimate their probabilities by importance sampling
+if args.tilt is not None:
+    kwargs = args.simulate_monthly_cash_kwargs()
+    for key in ('tolerance', 'bonus_pool_tolerance', 'max_seconds'):
+        kwargs.pop(key)
+    table = company.estimate_outcome_probabilities(
+        months_until_eoy, tilt=args.tilt, **kwargs
+    )
+    for row in table:
+        print "importance sampled probability of '%s' at end of year:" % \
+            row['outcome'], "%.2g (95%% CI %.2g-%.2g)" % (
+                row['probability'], row['lower'], row['upper'],
+            )
+    print "effective number of universes:", int(table[0]['n_effective'])
@@ -4,14 +4,16 @@ Simulate cashflow and estimate how risky it is to bring on a Datascoper.
 """
 
 import datetime
+import collections
 
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 from a_model.company import Company
+from a_model.company.goals import OUTCOMES
+from a_model.company.summaries import get_precision_str
 from a_model.argparsers import HiringParser
 from a_model import utils
-from a_model import decorators
 
 # parse command line arguments
 parser = HiringParser(description=__doc__)
@@ -22,31 +24,26 @@ company = Company(today=args.today)
 
 
 # simulate finances in our current situation and by adding up to n_n00bs new
-# datascopers
-# @decorators.read_or_run
+# datascopers. all of the scenarios share the same simulated revenues and
+# per-person costs so the differences between them are due to the n00bs.
+# seeded simulations are saved and reused (see `_read_or_simulate`)
 def get_all_n00b_outcomes():
-    all_n00b_outcomes = []
+    scenarios = []
     for n00b in range(0, args.n_n00bs+1):
-        if n00b > 0:
-            company.add_person("n00b_%d" % n00b)
-        monthly_cash_outputs, _, _ = company.simulate_monthly_cash(
-            **args.simulate_monthly_cash_kwargs()
-        )
-
-        # create a data structure to store the information in a relevant way
-        n00b_outcomes = company.get_outcomes_in_month(0, [])
-        all_n00b_outcomes.append(n00b_outcomes)
-        for k in n00b_outcomes:
-            n00b_outcomes[k] = []
-
-        # calculate the outcomes month by month
-        for month in range(args.n_months):
-            outcomes = company.get_outcomes_in_month(
-                month,
-                monthly_cash_outputs,
-            )
-            for outcome, value in outcomes.iteritems():
-                n00b_outcomes[outcome].append(value)
+        scenarios.append(["n00b_%d" % i for i in range(1, n00b+1)])
+    results = company.simulate_headcount_scenarios(
+        scenarios, **args.simulate_monthly_cash_kwargs()
+    )
+
+    # the probability of every outcome at the end of each simulated month
+    all_n00b_outcomes = []
+    for n00b, result in enumerate(results):
+        print "simulated %d n00bs with" % n00b, get_precision_str(result)
+        probabilities = result.get_outcome_probabilities()
+        all_n00b_outcomes.append(collections.OrderedDict(
+            (outcome, probabilities[:, i].tolist())
+            for i, outcome in enumerate(OUTCOMES)
+        ))
     return all_n00b_outcomes
 all_n00b_outcomes = get_all_n00b_outcomes()
 
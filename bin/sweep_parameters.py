@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Simulate cashflow for every combination of config.ini parameters (salary,
+bonus months, cash buffer, dividend fraction and tax rate) to see how they
+change the outcome probabilities and the bonus pool.
+"""
+
+import csv
+
+from a_model.company import Company
+from a_model.argparsers import SweepParser
+
+# parse command line arguments
+parser = SweepParser(description=__doc__)
+args = parser.parse_args()
+grid = args.parameter_grid()
+if not grid:
+    parser.error('specify the values of at least one parameter to sweep')
+
+# instantiate company
+company = Company(today=args.today)
+
+# simulate every grid point with the same simulated revenues and costs
+table = company.sweep_parameters(
+    grid, month=args.month, **args.simulate_monthly_cash_kwargs()
+)
+
+# save results to file
+with open(args.output_csv, 'w') as stream:
+    writer = csv.DictWriter(stream, fieldnames=table[0].keys())
+    writer.writeheader()
+    writer.writerows(table)
+print "results now available in", args.output_csv
@@ -19,5 +19,11 @@ username = company.config.get('quickbooks', 'username')
 password = company.config.get('quickbooks', 'password')
 
 # download and sync the reports
-reports.cache_quickbooks_locally(username, password, reports=args.reports)
-reports.sync_local_cache_with_gdrive(reports=args.reports)
+reports.cache_quickbooks_locally(
+    username, password, reports=args.reports, n_sessions=args.sessions,
+    max_per_host=args.max_per_host, root_url=args.quickbooks_url,
+    full_refresh=args.full_refresh, n_reclose_months=args.reclose_months,
+)
+reports.sync_local_cache_with_gdrive(
+    reports=args.reports, force=args.full_refresh,
+)